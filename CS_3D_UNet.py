@@ -20,11 +20,12 @@ from ms_segmentation.general.general import create_folder, list_folders, save_im
 from os.path import join as jp
 from ms_segmentation.plot.plot import shim_slice, shim_overlay_slice, shim, shim_overlay, plot_learning_curve
 from medpy.io import load
-from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
+from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, reconstruct_image_multiclass, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
 from ms_segmentation.architectures.unet3d import UNet_3D_alt
 from ms_segmentation.architectures.unet_c_gru import UNet_ConvGRU_3D_1, UNet_ConvGRU_3D_alt
 from ms_segmentation.architectures.cnn1 import CNN1, CNN2
 from torch.utils.data import DataLoader
+from ms_segmentation.data_generation.sampling import get_dataloader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
 import torchvision.transforms as transforms
@@ -75,6 +76,10 @@ options['optimizer'] = 'adam'
 options['patch_sampling'] = 'mask' # (mask, balanced or balanced+roi or non-uniform)
 options['loss'] = 'dice' # (dice, cross-entropy, categorical-cross-entropy)
 options['resample_each_epoch'] = False
+# Number of DataLoader worker processes (>0 needs the script body under if __name__ == '__main__' on Windows)
+options['num_workers'] = 0
+# Whether to shuffle patches by case so that each worker streams one volume at a time (for lazy loaders)
+options['case_affinity_sampling'] = False
 
 input_dictionary = create_training_validation_sets(options, dataset_mode="cs")
 
@@ -99,9 +104,11 @@ training_dataset = PatchLoader3DLoadAll(input_data=input_dictionary['input_train
                                        resample_epoch=options['resample_each_epoch'],
                                        transform=None)
 
-training_dataloader = DataLoader(training_dataset, 
+training_dataloader = get_dataloader(training_dataset, 
                                  batch_size=options['batch_size'],
-                                 shuffle=True)
+                                 shuffle=True,
+                                 num_workers=options['num_workers'],
+                                 case_affinity=options['case_affinity_sampling'])
 
 
 print('Validation data: ')
@@ -116,9 +123,11 @@ validation_dataset = PatchLoader3DLoadAll(input_data=input_dictionary['input_val
                                         resample_epoch=options['resample_each_epoch'],
                                         transform=None)
 
-validation_dataloader = DataLoader(validation_dataset, 
+validation_dataloader = get_dataloader(validation_dataset, 
                                    batch_size=options['batch_size'],
-                                   shuffle=True)
+                                   shuffle=True,
+                                   num_workers=options['num_workers'],
+                                   case_affinity=options['case_affinity_sampling'])
 """
 
 lesion_model = UNet_3D_alt(n_channels=len(options['input_data']), n_classes=options['num_classes'], bilinear = False)
@@ -418,12 +427,7 @@ for case in test_images:
         lesion_out = build_image(infer_patches, lesion_model, device, options['num_classes'], options)
 
         scan_numpy = nib.load(jp(scan_path, options['brain_mask'])).get_fdata()
-        all_probs = np.zeros((scan_numpy.shape[0], scan_numpy.shape[1], scan_numpy.shape[2], options['num_classes']))
-
-        for i in range(options['num_classes']):
-            all_probs[:,:,:,i] = reconstruct_image(lesion_out[:,i], 
-                                            coordenates, 
-                                            scan_numpy.shape)
+        all_probs = reconstruct_image_multiclass(lesion_out, coordenates, scan_numpy.shape)
                                 
         labels = np.argmax(all_probs, axis=3).astype(np.uint8)
 
@@ -20,11 +20,12 @@ from ms_segmentation.general.general import create_folder, list_folders, save_im
 from os.path import join as jp
 from ms_segmentation.plot.plot import shim_slice, shim_overlay_slice, shim, shim_overlay, plot_learning_curve
 from medpy.io import load
-from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DTime, PatchLoader3DTimeLoadAll, PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
+from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DTime, PatchLoader3DTimeLoadAll, PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, reconstruct_image_multiclass, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
 from ms_segmentation.architectures.unet3d import Unet_orig, UNet3D_1, UNet3D_2
 from ms_segmentation.architectures.unet_c_gru import UNet_ConvGRU_3D_1, UNet_ConvGRU_3D_alt
 from ms_segmentation.architectures.cnn1 import CNN1
 from torch.utils.data import DataLoader
+from ms_segmentation.data_generation.sampling import get_dataloader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
 import torchvision.transforms as transforms
@@ -98,6 +99,10 @@ options['patch_sampling'] = 'mask' # (mask, balanced or balanced+roi or non-unif
 options['loss'] = 'categorical-cross-entropy' # (dice, cross-entropy, categorical-cross-entropy)
 # Whether or not to re-sample each epoch for training patches
 options['resample_each_epoch'] = False
+# Number of DataLoader worker processes (>0 needs the script body under if __name__ == '__main__' on Windows)
+options['num_workers'] = 0
+# Whether to shuffle patches by case so that each worker streams one volume at a time (for lazy loaders)
+options['case_affinity_sampling'] = False
 
 
 
@@ -139,10 +144,12 @@ training_dataset = PatchLoader3DTimeLoadAll(input_data=input_dictionary['input_t
 
 #hola = training_dataset.__getitem__(2200)
 
-training_dataloader = DataLoader(training_dataset, 
+training_dataloader = get_dataloader(training_dataset, 
                                  batch_size=options['batch_size'],
                                  shuffle=True,
-                                 drop_last=True)
+                                 drop_last=True,
+                                 num_workers=options['num_workers'],
+                                 case_affinity=options['case_affinity_sampling'])
 
 print('Validation data: ')
 validation_dataset = PatchLoader3DTimeLoadAll(input_data=input_dictionary['input_val_data'],
@@ -157,10 +164,12 @@ validation_dataset = PatchLoader3DTimeLoadAll(input_data=input_dictionary['input
                                         labels_mode='lesion_patch',
                                         transform=None)
 
-validation_dataloader = DataLoader(validation_dataset, 
+validation_dataloader = get_dataloader(validation_dataset, 
                                    batch_size=options['batch_size'],
                                    shuffle=True,
-                                   drop_last= True)
+                                   drop_last=True,
+                                   num_workers=options['num_workers'],
+                                   case_affinity=options['case_affinity_sampling'])
 
 
 
@@ -542,12 +551,7 @@ for case in test_images:
         lesion_out = build_image(infer_patches, lesion_model, device, options['num_classes'], options)
 
         scan_numpy = nib.load(jp(path_test, case, os.listdir(scan_path)[0])).get_fdata()
-        all_probs = np.zeros((scan_numpy.shape[0], scan_numpy.shape[1], scan_numpy.shape[2], options['num_classes']))
-
-        for i in range(options['num_classes']):
-            all_probs[:,:,:,i] = reconstruct_image(lesion_out[:,i], 
-                                            coordenates, 
-                                            scan_numpy.shape)
+        all_probs = reconstruct_image_multiclass(lesion_out, coordenates, scan_numpy.shape)
                                 
         labels = np.argmax(all_probs, axis=3).astype(np.uint8)
 
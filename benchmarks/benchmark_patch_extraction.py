@@ -0,0 +1,74 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Benchmark of the vectorized patch extraction against the previous per-center slicing
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Runs on synthetic volumes of ISBI size (181x217x181), 3 timepoints and 4 modalities
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import time
+import numpy as np
+from ms_segmentation.data_generation.patch_extraction import pad_block, gather_patches
+from ms_segmentation.data_generation.patch_manager_3d import get_voxel_coordenates, apply_padding
+
+volume_shape = (181, 217, 181)
+num_timepoints = 3
+num_modalities = 4
+num_repetitions = 3
+
+# (patch size, sampling step): longitudinal U-Net patches and dense patches of the center-voxel CNN
+scenarios = [((32, 32, 32), (16, 16, 16)),
+             ((9, 9, 9), (6, 6, 6))]
+
+
+def per_center_extraction(volumes, centers, patch_size):
+    """
+    Previous extraction: one slice list per center and one np.stack per patch and modality
+    """
+    padded = [[apply_padding(v, patch_size) for v in volumes_tp] for volumes_tp in volumes]
+    all_patches = np.zeros((len(centers), len(volumes), len(volumes[0])) + tuple(patch_size), dtype='float32')
+    for idx, center in enumerate(centers):
+        # after padding, a patch starts at the original center coordenates
+        slice_ = [slice(c_idx, c_idx+s_idx) for (c_idx, s_idx) in zip(center, patch_size)]
+        for i_t in range(len(volumes)):
+            all_patches[idx, i_t] = np.stack([padded[i_t][m][tuple(slice_)] for m in range(len(volumes[i_t]))], axis=0)
+    return all_patches
+
+
+def vectorized_extraction(volumes, centers, patch_size):
+    """
+    New extraction: all patches gathered at once from a padded (timepoints, modalities, x, y, z) block
+    """
+    block = pad_block(np.stack([np.stack(volumes_tp) for volumes_tp in volumes]), patch_size)
+    return gather_patches(block, centers, patch_size)
+
+
+def time_function(function, *args):
+    times = []
+    for _ in range(num_repetitions):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    rng = np.random.RandomState(0)
+    brain_mask = np.zeros(volume_shape, dtype=np.uint8)
+    brain_mask[20:-20, 20:-20, 20:-20] = 1
+    volumes = [[(rng.rand(*volume_shape)*brain_mask).astype('float32') for _ in range(num_modalities)] for _ in range(num_timepoints)]
+
+    for patch_size, sampling_step in scenarios:
+        centers = get_voxel_coordenates(brain_mask, brain_mask > 0, step_size=sampling_step)
+
+        t_old, patches_old = time_function(per_center_extraction, volumes, centers, patch_size)
+        t_new, patches_new = time_function(vectorized_extraction, volumes, centers, patch_size)
+
+        print("Number of patches:", len(centers), "- patch size:", patch_size)
+        print("    Per-center extraction:  {:.3f} s".format(t_old))
+        print("    Vectorized extraction:  {:.3f} s".format(t_new))
+        print("    Speed-up: {:.2f}x, identical output: {}".format(t_old/t_new, np.array_equal(patches_old, patches_new)))
@@ -0,0 +1,246 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  CPU benchmark suite of the data, model and evaluation hot paths
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Synthetic cases (volumes of ISBI size by default, 181x217x181, see synthetic_cohort) are written to a
+#               temporary folder. Every benchmark is run several times and the minimum and median times are written to
+#               a JSON file. With --baseline, the results are compared with a previous JSON file and benchmarks that
+#               became slower than the tolerance are reported (exit code 1)
+#
+#               Usage: python -m benchmarks.benchmark_suite --output results.json [--baseline baseline.json]
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+import nibabel as nib
+import torch
+import torch.nn.functional as F
+from os.path import join as jp
+from ms_segmentation.general.general import get_dictionary_with_paths
+from ms_segmentation.data_generation import preprocessing_cache
+from ms_segmentation.data_generation.synthetic_cohort import generate_cohort, modalities
+from ms_segmentation.data_generation.patch_extraction import pad_block, gather_patches
+from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, PatchLoader3DTimeLoadAll, get_voxel_coordenates, reconstruct_image_multiclass
+from ms_segmentation.architectures.unet3d import UNet_3D_alt
+from ms_segmentation.architectures.unet_c_gru import UNet_ConvLSTM_3D_alt_bidirectional
+from ms_segmentation.evaluation.metrics import compute_metrics
+from ms_segmentation.evaluation.ensemble_voting import vote_masks
+from ms_segmentation.evaluation.probability_maps import save_probability_map, soft_vote
+
+volume_shapes = {"isbi": (181, 217, 181), "small": (96, 112, 96)}
+
+
+def get_environment():
+    """
+    Information about the machine and library versions, stored with the results
+    """
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads()}
+
+
+def time_function(function, repetitions):
+    """
+    Run a function several times (plus one warm-up run that is not timed). Output printed by the function is hidden
+
+    outputs:
+    - dictionary with the minimum, median and all times (s)
+    """
+    times = []
+    for i_rep in range(repetitions + 1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        if i_rep > 0:
+            times.append(elapsed)
+    return {"min": min(times), "median": float(np.median(times)), "times": times}
+
+
+def get_benchmarks(path_data, args):
+    """
+    Build all benchmarks on the synthetic cases in <path_data>
+
+    outputs:
+    - list of (name, function without arguments)
+    """
+    rng = np.random.RandomState(0)
+    volume_shape = volume_shapes[args.size]
+    patch_size = (32, 32, 32)
+    sampling_step = (16, 16, 16)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cases = generate_cohort(path_data, args.cases, args.timepoints, volume_shape, 20, "l", num_workers=1)
+    input_data = get_dictionary_with_paths(cases, path_data, modalities)
+    labels = get_dictionary_with_paths(cases, path_data, ["mask1"])
+    rois = get_dictionary_with_paths(cases, path_data, ["brain_mask"])
+    first_case = {"images": input_data[cases[0]], "labels": labels[cases[0]], "rois": rois[cases[0]]}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cs_loader = PatchLoader3DLoadAll(input_data, labels, rois, patch_size, sampling_step, normalize=True)
+        l_loader = PatchLoader3DTimeLoadAll(input_data, labels, rois, patch_size, sampling_step, normalize=True,
+                                            num_timepoints=3) # cases need more than 3 timepoints
+
+    # data: patch indexes, extraction of the patches of one case and loading of all patches
+    block = pad_block(np.stack([np.stack([nib.load(p).get_fdata(dtype=np.float32) for p in images]) for images in first_case["images"]]), patch_size)
+    brain_mask = nib.load(first_case["rois"][0][0]).get_fdata(dtype=np.float32)
+    centers = get_voxel_coordenates(brain_mask, brain_mask > 0, step_size=sampling_step)
+    corners = np.asarray(centers) - np.array([s // 2 for s in patch_size])
+
+    # model: one training step (forward, backward and update) on a batch of patches
+    device = torch.device('cpu')
+    def get_training_step(model, x):
+        optimizer = torch.optim.Adam(model.parameters())
+        y = torch.from_numpy(rng.randint(0, 2, (x.shape[0],) + patch_size)).long()
+        model.train()
+        def training_step():
+            optimizer.zero_grad()
+            pred = model(x)
+            loss = F.cross_entropy(torch.log(torch.clamp(pred, 1E-7, 1.0)), y)
+            loss.backward()
+            optimizer.step()
+        return training_step
+
+    torch.manual_seed(0)
+    unet = UNet_3D_alt(n_channels=len(modalities), n_classes=2, bilinear=False).to(device)
+    unet_x = torch.rand((args.batch_size, len(modalities)) + patch_size)
+    convlstm = UNet_ConvLSTM_3D_alt_bidirectional(n_channels=len(modalities), n_classes=2, bilinear=False).to(device)
+    convlstm_x = torch.rand((args.batch_size, 3, len(modalities)) + patch_size)
+
+    def forward_only(model, x):
+        model.eval()
+        def forward():
+            with torch.no_grad():
+                model(x)
+        return forward
+
+    # evaluation: reconstruction of the output of all patches of a case, metrics and ensembling of several models
+    patch_probs = rng.rand(len(centers), 2, *patch_size).astype(np.float32)
+    gt = nib.load(first_case["labels"][0][0]).get_fdata().astype(np.uint8)
+    pred = gt.copy()
+    pred[np.roll(gt, 2, axis=0) > 0] = 1 # shifted lesions: partial overlap, false positives and false negatives
+    path_models = jp(path_data, "models")
+    os.makedirs(path_models, exist_ok=True)
+    mask_paths, map_paths = [], []
+    for i_model in range(args.models):
+        probs = np.clip(gt + rng.normal(0, 0.3, volume_shape), 0, 1).astype(np.float32)
+        mask_paths.append(jp(path_models, "model" + str(i_model) + "_segm.nii.gz"))
+        nib.save(nib.Nifti1Image((probs > 0.5).astype(np.uint8), np.eye(4)), mask_paths[-1])
+        map_paths.append(save_probability_map(probs, jp(path_models, "model" + str(i_model)), "01", 1, "uint8"))
+
+    return [("patch_indexes_cs", cs_loader.generate_patch_indexes),
+            ("patch_indexes_longitudinal", l_loader.generate_patch_indexes),
+            ("patch_extraction", lambda: gather_patches(block, corners, patch_size)),
+            ("load_all_patches_cs", cs_loader.load_all_patches),
+            ("load_all_patches_longitudinal", l_loader.load_all_patches),
+            ("unet3d_forward", forward_only(unet, unet_x)),
+            ("unet3d_forward_backward", get_training_step(unet, unet_x)),
+            ("convlstm_bidirectional_forward", forward_only(convlstm, convlstm_x)),
+            ("convlstm_bidirectional_forward_backward", get_training_step(convlstm, convlstm_x)),
+            ("reconstruction", lambda: reconstruct_image_multiclass(patch_probs, centers, volume_shape)),
+            ("metrics", lambda: compute_metrics(gt, pred)),
+            ("ensemble_majority_vote", lambda: vote_masks(mask_paths)),
+            ("ensemble_soft_vote", lambda: soft_vote(map_paths))]
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compare the median times of two runs
+
+    inputs:
+    - results: results of the current run (see run_benchmarks)
+    - baseline: results of a previous run
+    - tolerance: relative change that is reported as a regression or an improvement (e.g. 0.1 -> 10 %)
+
+    outputs:
+    - list with the names of the benchmarks that are slower than the baseline
+    """
+    regressions = []
+    print("{:<42}{:>12}{:>12}{:>10}".format("Benchmark", "Baseline", "Current", "Ratio"))
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            print("{:<42}{:>12}{:>12.4f}{:>10}".format(name, "-", result["median"], "new"))
+            continue
+        ratio = result["median"] / baseline["results"][name]["median"]
+        if ratio > 1 + tolerance:
+            status = "slower"
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            status = "faster"
+        else:
+            status = ""
+        print("{:<42}{:>12.4f}{:>12.4f}{:>10.2f}  {}".format(name, baseline["results"][name]["median"], result["median"], ratio, status))
+    if baseline.get("config") != results["config"]:
+        print("Warning: the baseline was run with a different configuration:", baseline.get("config"))
+    return regressions
+
+
+def run_benchmarks(args):
+    """
+    Run all benchmarks (or the ones selected with --only) and return the results as a dictionary
+    """
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    preprocessing_cache.set_cache_dir(None) # volumes are decoded in every run, as in a first epoch without cache
+    path_data = tempfile.mkdtemp(prefix="ms_benchmark_")
+    try:
+        config = {"size": args.size, "volume_shape": list(volume_shapes[args.size]), "cases": args.cases, "timepoints": args.timepoints,
+                  "batch_size": args.batch_size, "models": args.models, "repetitions": args.repetitions}
+        results = {"config": config, "environment": get_environment(), "results": {}}
+        for name, function in get_benchmarks(path_data, args):
+            if args.only and name not in args.only:
+                continue
+            results["results"][name] = time_function(function, args.repetitions)
+            print("{:<42}{:>10.4f} s (min {:.4f} s)".format(name, results["results"][name]["median"], results["results"][name]["min"]))
+    finally:
+        shutil.rmtree(path_data, ignore_errors=True)
+    return results
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="CPU benchmarks of the data, model and evaluation hot paths")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file where the results are written")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slow-down reported as a regression")
+    parser.add_argument("--size", default="isbi", choices=sorted(volume_shapes), help="size of the synthetic volumes")
+    parser.add_argument("--cases", type=int, default=2, help="number of synthetic cases")
+    parser.add_argument("--timepoints", type=int, default=4, help="number of timepoints per case (at least 4)")
+    parser.add_argument("--batch-size", type=int, default=4, help="batch size of the model benchmarks")
+    parser.add_argument("--models", type=int, default=5, help="number of models of the ensembling benchmarks")
+    parser.add_argument("--repetitions", type=int, default=3, help="timed runs of each benchmark")
+    parser.add_argument("--threads", type=int, default=None, help="number of torch threads")
+    parser.add_argument("--only", nargs="+", default=None, help="names of the benchmarks to run")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    results = run_benchmarks(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print("Slower than the baseline:", ", ".join(regressions))
+            sys.exit(1)
@@ -25,11 +25,12 @@ from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAl
 from ms_segmentation.architectures.unet_c_gru import UNet_ConvGRU_2D_alt, UNet_ConvLSTM_2D_alt, UNet_ConvLSTM_Goku, UNet_ConvLSTM_Vegeta
 from ms_segmentation.architectures.unet2d import UNet2D
 from torch.utils.data import DataLoader
+from ms_segmentation.data_generation.preprocessing_cache import set_cache_dir
+from ms_segmentation.data_generation.sampling import get_dataloader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
 import torchvision.transforms as transforms
-from ms_segmentation.general.training_helper import EarlyStopping, exp_lr_scheduler, dice_loss_2d, create_training_validation_sets
-from sklearn.metrics import jaccard_score as jsc
+from ms_segmentation.general.training_helper import EarlyStopping, TrainingTimer, SegmentationMetrics, exp_lr_scheduler, dice_loss_2d, create_training_validation_sets
 from ms_segmentation.evaluation.metrics import compute_dices, compute_hausdorf
 
 
@@ -49,15 +50,22 @@ options['norm_type'] = 'zero_one'
 options['batch_size'] = 10
 options['patience'] =  20 #Patience for the early stopping
 options['gpu_use'] = True
+options['log_timing'] = True # time the stages of the training loop and log them per epoch (timing.jsonl in the fold folder)
+options['print_batch_metrics'] = False # print loss and Jaccard of every mini-batch (copies the counts of each batch to the host)
+options['clear_console'] = False # clear the console at the start of every epoch (on Windows, starts a shell every epoch)
 options['num_epochs'] = 200
 options['optimizer'] = 'adam'
 options['patch_sampling'] = 'mask' # (mask, balanced or balanced+roi or non-uniform)
 options['loss'] = 'dice' # (dice, cross-entropy)
 options['resample_each_epoch'] = False
+# Number of DataLoader worker processes (>0 needs the script body under if __name__ == '__main__' on Windows). Slices
+# are all loaded before training, so there is no case-affinity sampling
+options['num_workers'] = 0
 
 
 path_base = r'D:\dev\ms_data\Challenges\ISBI2015\ISBI_L'
 path_data = jp(path_base, 'isbi_train')
+set_cache_dir(jp(path_base, 'preprocessing_cache')) # decoded and normalized volumes are shared by all folds and experiments
 options['path_data'] = path_data
 path_res = jp(path_base, "cross_validation")
 all_patients = list_folders(path_data)
@@ -108,9 +116,10 @@ for curr_test_patient in all_patients:
 
 
 
-    training_dataloader = DataLoader(training_dataset, 
+    training_dataloader = get_dataloader(training_dataset, 
                                     batch_size=options['batch_size'],
-                                    shuffle=True)
+                                    shuffle=True,
+                                    num_workers=options['num_workers'])
 
     print('Validation data: ')
     validation_dataset = SlicesLoaderLoadAll(input_data=input_dictionary['input_val_data'],
@@ -119,9 +128,10 @@ for curr_test_patient in all_patients:
                                         normalize=options['normalize'],
                                         norm_type=options['norm_type'])
 
-    validation_dataloader = DataLoader(validation_dataset, 
+    validation_dataloader = get_dataloader(validation_dataset, 
                                     batch_size=options['batch_size'],
-                                    shuffle=True)
+                                    shuffle=True,
+                                    num_workers=options['num_workers'])
 
 
     
@@ -182,6 +192,9 @@ for curr_test_patient in all_patients:
     lesion_model = lesion_model.to(device)
 
     early_stopping = EarlyStopping(patience=options['patience'], verbose=True)
+    timer = TrainingTimer(jp(path_results, "timing.jsonl"), device, enabled=options['log_timing'])
+    train_metrics = SegmentationMetrics(device) # confusion counts of the epoch, kept on the device
+    val_metrics = SegmentationMetrics(device)
 
     train_losses = []
     val_losses = []
@@ -199,12 +212,13 @@ for curr_test_patient in all_patients:
 
     try:
         while training:
-            cls()
+            if options['clear_console']:
+                cls()
             # epoch specific metrics
             train_loss = 0
             val_loss = 0
-            jaccs_train = []
-            jaccs_val = []
+            train_metrics.reset()
+            val_metrics.reset()
             
             # -----------------------------
             # training samples
@@ -212,7 +226,8 @@ for curr_test_patient in all_patients:
             
             # set the model into train mode
             lesion_model.train() #Put in train mode
-            for b_t, (data, target) in enumerate(training_dataloader):
+            timer.start("training", fold=fold, epoch=epoch)
+            for b_t, (data, target) in enumerate(timer.iterate(training_dataloader)):
                     print("Training. Mini-batch ", b_t+1, "/", len(training_dataloader))
                     # process batches: each batch is composed by training (x) and labels (y)
                     # x = [batch_size, num_modalities, patch_dim1, patch_dim2, patch_dim3]
@@ -220,12 +235,14 @@ for curr_test_patient in all_patients:
         
                     x = data.type('torch.cuda.FloatTensor').to(device)
                     y = target.type('torch.cuda.FloatTensor').to(device)
+                    timer.lap("to_device")
                     
                     # clear gradients
                     optimizer.zero_grad() #Set gradients to zero for every new batch so that no accummulation takes place
                     
                     # infer the current batch 
                     pred = lesion_model(x)
+                    timer.lap("forward")
                     
                     # pred = [batch_size, num_classes, patch_dim1, patch_dim2, patch_dim3]
 
@@ -248,38 +265,44 @@ for curr_test_patient in all_patients:
                         raise ValueError("Unknown loss")
                     
                     train_loss += loss.item()
+                    timer.lap("loss")
                     
                     # backward loss and next step
                     loss.backward()
+                    timer.lap("backward")
                     optimizer.step()
+                    timer.lap("optimizer")
 
                     # compute the accuracy
                     # compute the accuracy
-                    lbl = y.cpu().numpy().reshape(-1)
-                    pred_labels = pred.detach().cpu().numpy().astype('float32')
-                    pred_labels = np.argmax(pred_labels, axis=1).reshape(-1).astype(np.uint8)
-                    batch_jacc = jsc(pred_labels,lbl, average = 'binary')
-                    print("Training Loss: ", loss.item())
-                    print("Training - Batch JSC: ", batch_jacc)
-                    print("Num 1s: ", len(pred_labels[pred_labels>0]))
-                    jaccs_train.append(batch_jacc)
+                    batch_counts = train_metrics.update(pred, y)
+                    if options['print_batch_metrics']:
+                        batch_jacc = train_metrics.get_scores(batch_counts)["jaccard"]
+                        print("Training Loss: ", loss.item())
+                        print("Training - Batch JSC: ", batch_jacc)
+                        print("Num 1s: ", int(batch_counts[0] + batch_counts[1]))
                     
                     
+            timer.stop(loss=train_loss/(b_t+1))
+
             # -----------------------------
             # validation samples
             # -----------------------------
         
             # set the model into train mode
             lesion_model.eval() #Put in evaluation mode. Eg so that things like dropout don't occur during evaluation
-            for b_v, (data, target) in enumerate(validation_dataloader):
+            timer.start("validation", fold=fold, epoch=epoch)
+            for b_v, (data, target) in enumerate(timer.iterate(validation_dataloader)):
                     
                     print("Validation. Mini-batch ", b_v+1, "/", len(validation_dataloader))
                     x = data.type('torch.cuda.FloatTensor').to(device)
                     y = target.type('torch.cuda.FloatTensor').to(device)
+                    timer.lap("to_device")
                     
                     # infer the current batch 
                     with torch.no_grad(): #Don't consider the gradients
                         pred = lesion_model(x)
+                        timer.lap("forward")
                     
                         # compute the loss. 
                         # we ignore the index=2
@@ -302,20 +325,21 @@ for curr_test_patient in all_patients:
                         
                         
                         val_loss += loss.item()
+                        timer.lap("loss")
                     
-                        lbl = y.cpu().numpy().reshape(-1)
-                        pred_labels = pred.detach().cpu().numpy().astype('float32')
-                        pred_labels = np.argmax(pred_labels, axis=1).reshape(-1).astype(np.uint8)
-                        batch_jacc = jsc(pred_labels,lbl, average = 'binary')
-                        print("Validation - Loss: ", loss.item())
-                        print("Validation - Batch JSC: ", batch_jacc)
-                        jaccs_val.append(batch_jacc)
+                        batch_counts = val_metrics.update(pred, y)
+                        if options['print_batch_metrics']:
+                            batch_jacc = val_metrics.get_scores(batch_counts)["jaccard"]
+                            print("Validation - Loss: ", loss.item())
+                            print("Validation - Batch JSC: ", batch_jacc)
             
+            timer.stop(loss=val_loss/(b_v+1))
+
             # compute mean metrics
             train_loss /= (b_t + 1)
             val_loss /= (b_v + 1)
-            train_jacc = np.mean(np.array(jaccs_train))
-            val_jacc = np.mean(np.array(jaccs_val))
+            train_jacc = train_metrics.get_scores()["jaccard"]
+            val_jacc = val_metrics.get_scores()["jaccard"]
 
             train_losses.append(train_loss)
             val_losses.append(val_loss)
@@ -20,18 +20,20 @@ from ms_segmentation.general.general import print_line, save_this, create_folder
 from os.path import join as jp
 from ms_segmentation.plot.plot import shim_slice, shim_overlay_slice, shim, shim_overlay, plot_learning_curve
 from medpy.io import load
-from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
+from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, reconstruct_image_multiclass, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
 from ms_segmentation.architectures.unet3d import UNet_3D_alt, UNet_3D_double_skip_hybrid
 from ms_segmentation.architectures.unet_c_gru import UNet_ConvGRU_3D_1, UNet_ConvLSTM_3D_alt
 from ms_segmentation.architectures.cnn1 import CNN1, CNN2
 from torch.utils.data import DataLoader
+from ms_segmentation.data_generation.preprocessing_cache import set_cache_dir
+from ms_segmentation.data_generation.sampling import get_dataloader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
 import torchvision.transforms as transforms
-from ms_segmentation.general.training_helper import EarlyStopping, exp_lr_scheduler, dice_loss, create_training_validation_sets, get_dictionary_with_paths_cs
-from sklearn.metrics import jaccard_score as jsc
+from ms_segmentation.general.training_helper import EarlyStopping, TrainingTimer, SegmentationMetrics, exp_lr_scheduler, dice_loss, create_training_validation_sets, get_dictionary_with_paths_cs
 from sklearn.metrics import accuracy_score as acc
 from ms_segmentation.evaluation.metrics import compute_metrics
+from ms_segmentation.evaluation.probability_maps import save_probability_map
 from torch.optim import Adadelta, Adam
 
 debug = False
@@ -52,14 +54,24 @@ options['norm_type'] = 'standard' # 'zero_one'
 options['batch_size'] = 16
 options['patience'] =  20 #Patience for the early stopping
 options['gpu_use'] = True
+options['log_timing'] = True # time the stages of the training loop and log them per epoch (timing.jsonl in the fold folder)
+options['print_batch_metrics'] = False # print loss and Jaccard of every mini-batch (copies the counts of each batch to the host)
+options['clear_console'] = False # clear the console at the start of every epoch (on Windows, starts a shell every epoch)
 options['num_epochs'] = 200
 options['optimizer'] = 'adam'
 options['patch_sampling'] = 'mask' # (mask, balanced or balanced+roi or non-uniform)
 options['loss'] = 'dice' # (dice, cross-entropy, categorical-cross-entropy)
 options['resample_each_epoch'] = False
+# Number of DataLoader worker processes (>0 needs the script body under if __name__ == '__main__' on Windows)
+options['num_workers'] = 0
+# Whether to shuffle patches by case so that each worker streams one volume at a time (for lazy loaders)
+options['case_affinity_sampling'] = False
+# Type of the stored lesion probability maps, to re-threshold or re-ensemble without inference (None, 'uint8' or 'float16')
+options['save_probabilities'] = None
 
 path_base = r'D:\dev\ms_data\Challenges\ISBI2015\ISBI_CS'
 path_data = jp(path_base, 'isbi_cs') #cs_normalized_images                         ## ACHTUUUUUNG
+set_cache_dir(jp(path_base, 'preprocessing_cache')) # decoded and normalized volumes are shared by all folds and experiments
 options['path_data'] = path_data
 path_res = jp(path_base, "cross_validation")
 all_patients = list_folders(path_data)
@@ -122,9 +134,11 @@ for curr_test_patient in all_patients:
                                         resample_epoch=options['resample_each_epoch'],
                                         transform=options["transforms"])
 
-    training_dataloader = DataLoader(training_dataset, 
+    training_dataloader = get_dataloader(training_dataset, 
                                     batch_size=options['batch_size'],
-                                    shuffle=True)
+                                    shuffle=True,
+                                    num_workers=options['num_workers'],
+                                    case_affinity=options['case_affinity_sampling'])
 
 
     print('Validation data: ')
@@ -139,9 +153,11 @@ for curr_test_patient in all_patients:
                                             resample_epoch=options['resample_each_epoch'],
                                             transform=options["transforms"])
 
-    validation_dataloader = DataLoader(validation_dataset, 
+    validation_dataloader = get_dataloader(validation_dataset, 
                                     batch_size=options['batch_size'],
-                                    shuffle=True)
+                                    shuffle=True,
+                                    num_workers=options['num_workers'],
+                                    case_affinity=options['case_affinity_sampling'])
     
 
     lesion_model = UNet_3D_alt(n_channels=len(options['input_data']), n_classes=options['num_classes'], bilinear = False)
@@ -165,6 +181,9 @@ for curr_test_patient in all_patients:
     lesion_model = lesion_model.to(device)
 
     early_stopping = EarlyStopping(patience=options['patience'], verbose=True)
+    timer = TrainingTimer(jp(path_results, "timing.jsonl"), device, enabled=options['log_timing'])
+    train_metrics = SegmentationMetrics(device) # confusion counts of the epoch, kept on the device
+    val_metrics = SegmentationMetrics(device)
 
     train_losses = []
     val_losses = []
@@ -180,12 +199,13 @@ for curr_test_patient in all_patients:
 
     try:
         while training:
-            cls()
+            if options['clear_console']:
+                cls()
             # epoch specific metrics
             train_loss = 0
             val_loss = 0
-            jaccs_train = []
-            jaccs_val = []
+            train_metrics.reset()
+            val_metrics.reset()
             acc_train = []
             acc_val = []
             
@@ -195,13 +215,15 @@ for curr_test_patient in all_patients:
             
             # set the model into train mode
             lesion_model.train() #Put in train mode
-            for b_t, (data, target) in enumerate(training_dataloader):
+            timer.start("training", fold=fold, epoch=epoch)
+            for b_t, (data, target) in enumerate(timer.iterate(training_dataloader)):
                     # process batches: each batch is composed by training (x) and labels (y)
                     # x = [batch_size, num_modalities, patch_dim1, patch_dim2, patch_dim3]
                     # y = [batch_size, 1, patch_dim1, patch_dim2, patch_dim3]
         
                     x = data.to(device)
                     y = target.to(device)
+                    timer.lap("to_device")
 
                     #save_batch(x, y)
 
@@ -210,6 +232,7 @@ for curr_test_patient in all_patients:
                     
                     # infer the current batch 
                     pred = lesion_model(x)
+                    timer.lap("forward")
                     
                     # pred = [batch_size, num_classes, patch_dim1, patch_dim2, patch_dim3]
 
@@ -231,10 +254,13 @@ for curr_test_patient in all_patients:
                         raise ValueError("Unknown loss")
                     
                     train_loss += loss.item()
+                    timer.lap("loss")
                     
                     # backward loss and next step
                     loss.backward()
+                    timer.lap("backward")
                     optimizer.step()
+                    timer.lap("optimizer")
 
                     # compute the accuracy
                     # compute the accuracy
@@ -247,34 +273,37 @@ for curr_test_patient in all_patients:
                         print("Training - Batch Acc: ", accuracy)
                         acc_train.append(accuracy)
                     else:
-                        lbl = y.cpu().numpy().reshape(-1)
-                        pred_labels = pred.detach().cpu().numpy().astype('float32')
-                        pred_labels = np.argmax(pred_labels, axis=1).reshape(-1).astype(np.uint8)
-                        batch_jacc = jsc(pred_labels,lbl, average = 'binary')
-                        print("*** Fold:", fold, "  , Epoch:", epoch, " ***")
-                        print("Training. Mini-batch ", b_t+1, "/", len(training_dataloader))
-                        print("Training Loss: {:.4f}, Jacc: {:.4f}".format(loss.item(), batch_jacc))
-                        print_line()
-                        #print("Num 1s: ", len(pred_labels[pred_labels>0]))
-                        jaccs_train.append(batch_jacc)
+                        batch_counts = train_metrics.update(pred, y)
+                        if options['print_batch_metrics']:
+                            batch_jacc = train_metrics.get_scores(batch_counts)["jaccard"]
+                            print("*** Fold:", fold, "  , Epoch:", epoch, " ***")
+                            print("Training. Mini-batch ", b_t+1, "/", len(training_dataloader))
+                            print("Training Loss: {:.4f}, Jacc: {:.4f}".format(loss.item(), batch_jacc))
+                            print_line()
+                            #print("Num 1s: ", int(batch_counts[0] + batch_counts[1]))
                     
                     
+            timer.stop(loss=train_loss/(b_t+1))
+
             # -----------------------------
             # validation samples
             # -----------------------------
         
             # set the model into train mode
             lesion_model.eval() #Put in evaluation mode. Eg so that things like dropout don't occur during evaluation
-            for b_v, (data, target) in enumerate(validation_dataloader):
+            timer.start("validation", fold=fold, epoch=epoch)
+            for b_v, (data, target) in enumerate(timer.iterate(validation_dataloader)):
                     
                 print("Validation. Mini-batch ", b_v+1, "/", len(validation_dataloader))
                 x = data.to(device)
                 
                 y = target.to(device)
+                timer.lap("to_device")
                 
                 # infer the current batch 
                 with torch.no_grad(): #Don't consider the gradients
                     pred = lesion_model(x)
+                    timer.lap("forward")
                 
                     # compute the loss. 
                     # we ignore the index=2
@@ -297,6 +326,7 @@ for curr_test_patient in all_patients:
                     
                     
                     val_loss += loss.item()
+                    timer.lap("loss")
                 
                     if options['loss'] == 'categorical-cross-entropy':
                         lbl = y.cpu().numpy()
@@ -307,16 +337,16 @@ for curr_test_patient in all_patients:
                         print("Validation - Batch Acc: ", accuracy)
                         acc_val.append(accuracy)
                     else:
-                        lbl = y.cpu().numpy().reshape(-1)
-                        pred_labels = pred.detach().cpu().numpy().astype('float32')
-                        pred_labels = np.argmax(pred_labels, axis=1).reshape(-1).astype(np.uint8)
-                        batch_jacc = jsc(pred_labels,lbl, average = 'binary')
-                        print("*** Fold:", fold, "  , Epoch:", epoch, " ***")
-                        print("Validation. Mini-batch ", b_v+1, "/", len(training_dataloader))
-                        print("Training Loss: {:.4f}, Jacc: {:.4f}".format(loss.item(), batch_jacc))
-                        print_line()
-                        jaccs_val.append(batch_jacc)
+                        batch_counts = val_metrics.update(pred, y)
+                        if options['print_batch_metrics']:
+                            batch_jacc = val_metrics.get_scores(batch_counts)["jaccard"]
+                            print("*** Fold:", fold, "  , Epoch:", epoch, " ***")
+                            print("Validation. Mini-batch ", b_v+1, "/", len(training_dataloader))
+                            print("Training Loss: {:.4f}, Jacc: {:.4f}".format(loss.item(), batch_jacc))
+                            print_line()
             
+            timer.stop(loss=val_loss/(b_v+1))
+
             # compute mean metrics
             train_loss /= (b_t + 1)
             val_loss /= (b_v + 1)
@@ -330,8 +360,8 @@ for curr_test_patient in all_patients:
                 train_accs.append(train_acc)
                 val_accs.append(val_acc)
             else:
-                train_jacc = np.mean(np.array(jaccs_train))
-                val_jacc = np.mean(np.array(jaccs_val))
+                train_jacc = train_metrics.get_scores()["jaccard"]
+                val_jacc = val_metrics.get_scores()["jaccard"]
                 train_jaccs.append(train_jacc)
                 val_jaccs.append(val_jacc)
             print('Epoch {:d} train_loss {:.4f} train_acc {:.4f} val_loss {:.4f} val_acc {:.4f}'.format(
@@ -429,13 +459,10 @@ for curr_test_patient in all_patients:
             lesion_out = build_image(infer_patches, lesion_model, device, options['num_classes'], options)
 
             scan_numpy = nib.load(jp(scan_path, options['brain_mask'])).get_fdata()
-            all_probs = np.zeros((scan_numpy.shape[0], scan_numpy.shape[1], scan_numpy.shape[2], options['num_classes']))
-
-            for i in range(options['num_classes']):
-                all_probs[:,:,:,i] = reconstruct_image(lesion_out[:,i], 
-                                                coordenates, 
-                                                scan_numpy.shape)
+            all_probs = reconstruct_image_multiclass(lesion_out, coordenates, scan_numpy.shape)
                                     
+            if options['save_probabilities'] is not None:
+                save_probability_map(all_probs[:,:,:,1], jp(path_segmentations, case), case, tp+1, options['save_probabilities'])
             labels = np.argmax(all_probs, axis=3).astype(np.uint8)
 
             #Compute metrics
@@ -13,6 +13,7 @@
 import os
 import torch
 from torch import nn
+import torch.nn.functional as F
 from torch.autograd import Variable
 
 
@@ -247,6 +248,7 @@ class ConvGRUCell3D(nn.Module):
         super(ConvGRUCell3D, self).__init__()
         self.height, self.width, self.depth = input_size
         self.padding = kernel_size[0] // 2, kernel_size[1] // 2, kernel_size[2] // 2
+        self.input_dim = input_dim
         self.hidden_dim = hidden_dim
         self.bias = bias
         self.dtype = dtype
@@ -263,8 +265,37 @@ class ConvGRUCell3D(nn.Module):
                               padding=self.padding,
                               bias=self.bias)
 
-    def init_hidden(self, batch_size):
-        return (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth)).type(self.dtype))
+    def init_hidden(self, batch_size, device=None, dtype=None):
+        return torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth, device=device, dtype=dtype)
+
+    def input_conv(self, input_tensor):
+        """
+        Input-to-hidden part of both convolutions (gates and candidate) in a single call. The weights of conv_gates
+        and conv_can are split along the input channels, so trained models can still be loaded
+        :return: pre-activations (b, 3*c_hidden, h, w, d): reset, update and candidate
+        """
+        weight = torch.cat([self.conv_gates.weight[:, :self.input_dim], self.conv_can.weight[:, :self.input_dim]], dim=0)
+        bias = torch.cat([self.conv_gates.bias, self.conv_can.bias]) if self.bias else None
+        return F.conv3d(input_tensor, weight, bias, padding=self.padding)
+
+    def step(self, input_conv, h_cur):
+        """
+        One recurrent step from the precomputed input-to-hidden pre-activations. h_cur=None means a zero hidden state
+        """
+        gates_x, can_x = input_conv[:, :2*self.hidden_dim], input_conv[:, 2*self.hidden_dim:]
+        if h_cur is None:
+            # with a zero hidden state the reset gate has no effect and the hidden-to-hidden terms vanish
+            update_gate = torch.sigmoid(gates_x[:, self.hidden_dim:])
+            return (1 - update_gate) * torch.tanh(can_x)
+
+        gates = gates_x + F.conv3d(h_cur, self.conv_gates.weight[:, self.input_dim:], None, padding=self.padding)
+        reset_gate, update_gate = torch.split(torch.sigmoid(gates), self.hidden_dim, dim=1)
+
+        cnm = torch.tanh(can_x + F.conv3d(reset_gate*h_cur, self.conv_can.weight[:, self.input_dim:], None, padding=self.padding))
+
+        #h_next = (1 - update_gate) * h_cur + update_gate * cnm
+        h_next = (1 - update_gate) * cnm + update_gate * h_cur
+        return h_next
 
     def forward(self, input_tensor, h_cur):
         """
@@ -276,6 +307,9 @@ class ConvGRUCell3D(nn.Module):
         :return: h_next,
             next hidden state
         """
+        if h_cur is None:
+            return self.step(self.input_conv(input_tensor), h_cur)
+
         combined = torch.cat([input_tensor, h_cur], dim=1)
         combined_conv = self.conv_gates(combined)
 
@@ -291,6 +325,30 @@ class ConvGRUCell3D(nn.Module):
         h_next = (1 - update_gate) * cnm + update_gate * h_cur
         return h_next
 
+    def forward_sequence(self, input_tensor, h_cur=None):
+        """
+        Run the cell over a whole sequence. The input-to-hidden convolutions of all timesteps are computed in one
+        batched call and only the hidden-to-hidden convolutions run inside the loop. On CPU, convolutions with half of
+        the input channels are not twice as fast, so there each step uses the full convolutions (see forward)
+        :param input_tensor: (b, t, c, h, w, d)
+        :param h_cur: initial hidden state or None (zero state)
+        :return: outputs (b, t, c_hidden, h, w, d), last hidden state
+        """
+        batch_size, seq_len = input_tensor.shape[:2]
+        batched = input_tensor.is_cuda
+        if batched:
+            input_convs = self.input_conv(input_tensor.reshape((batch_size*seq_len,) + input_tensor.shape[2:]))
+            input_convs = input_convs.reshape((batch_size, seq_len) + input_convs.shape[1:])
+
+        output_inner = []
+        for t in range(seq_len):
+            if batched:
+                h_cur = self.step(input_convs[:, t], h_cur)
+            else:
+                h_cur = self(input_tensor[:, t], h_cur)
+            output_inner.append(h_cur)
+        return torch.stack(output_inner, dim=1), h_cur
+
 
 
 
@@ -367,24 +425,16 @@ class ConvGRU3D(nn.Module):
         if hidden_state is not None:
             raise NotImplementedError()
         else:
-            hidden_state = self._init_hidden(batch_size=input_tensor.size(0))
+            # zero initial states are not allocated, the cells start from an empty state
+            hidden_state = [None]*self.num_layers
 
         layer_output_list = []
         last_state_list   = []
 
-        seq_len = input_tensor.size(1)
         cur_layer_input = input_tensor
 
         for layer_idx in range(self.num_layers):
-            h = hidden_state[layer_idx]
-            output_inner = []
-            for t in range(seq_len):
-                # input current hidden and cell state then compute the next hidden and cell state through ConvLSTMCell forward function
-                h = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :, :], # (b,t,c,h,w,d)
-                                              h_cur=h)
-                output_inner.append(h)
-
-            layer_output = torch.stack(output_inner, dim=1)
+            layer_output, h = self.cell_list[layer_idx].forward_sequence(cur_layer_input, hidden_state[layer_idx]) # (b,t,c,h,w,d)
             cur_layer_input = layer_output
 
             layer_output_list.append(layer_output)
@@ -396,10 +446,10 @@ class ConvGRU3D(nn.Module):
 
         return layer_output_list, last_state_list
 
-    def _init_hidden(self, batch_size):
+    def _init_hidden(self, batch_size, device=None, dtype=None):
         init_states = []
         for i in range(self.num_layers):
-            init_states.append(self.cell_list[i].init_hidden(batch_size))
+            init_states.append(self.cell_list[i].init_hidden(batch_size, device, dtype))
         return init_states
 
     @staticmethod
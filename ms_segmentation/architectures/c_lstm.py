@@ -117,7 +117,7 @@ class ConvLSTM(nn.Module):
 
 
         if hidden_state is None:
-            hidden_state = self.get_init_states(batch_size=input.size(0))
+            hidden_state = self.get_init_states(batch_size=input.size(0), cuda=input.is_cuda)
 
         layer_output_list = []
         last_state_list   = []
@@ -204,29 +204,70 @@ class ConvLSTMCell3D(nn.Module):
                               padding=self.padding,
                               bias=self.bias)
 
-    def forward(self, input, prev_state):
-        h_prev, c_prev = prev_state
-        combined = torch.cat((input, h_prev), dim=1)  # concatenate along channel axis
+    def input_conv(self, input):
+        """
+        Input-to-hidden part of the gates convolution (the bias is added here). conv(cat(x, h)) = conv_x(x) + conv_h(h),
+        so the weights of self.conv are split along the input channels and trained models can still be loaded
+        """
+        return F.conv3d(input, self.conv.weight[:, :self.input_dim], self.conv.bias, padding=self.padding)
 
-        combined_conv = self.conv(combined)
-        cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1)
+    def hidden_conv(self, h_prev):
+        """
+        Hidden-to-hidden part of the gates convolution
+        """
+        return F.conv3d(h_prev, self.conv.weight[:, self.input_dim:], None, padding=self.padding)
 
-        i = F.sigmoid(cc_i)
-        f = F.sigmoid(cc_f)
-        o = F.sigmoid(cc_o)
-        g = F.tanh(cc_g)
+    def update_state(self, gates, c_prev):
+        """
+        Compute the new states from the pre-activation gates (i, f, o, g). c_prev=None means a zero cell state
+        """
+        i, f, o = torch.split(torch.sigmoid(gates[:, :3*self.hidden_dim]), self.hidden_dim, dim=1)
+        g = torch.tanh(gates[:, 3*self.hidden_dim:])
 
-        c_cur = f * c_prev + i * g
-        h_cur = o * F.tanh(c_cur)
+        c_cur = i * g if c_prev is None else torch.addcmul(i * g, f, c_prev)
+        h_cur = o * torch.tanh(c_cur)
 
         return h_cur, c_cur
 
-    def init_hidden(self, batch_size, cuda=True):
-        state = (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth)),
-                 Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth)))
-        if cuda:
-            state = (state[0].cuda(), state[1].cuda())
-        return state
+    def forward(self, input, prev_state):
+        h_prev, c_prev = prev_state
+        return self.update_state(self.input_conv(input) + self.hidden_conv(h_prev), c_prev)
+
+    def forward_sequence(self, input, prev_state=None):
+        """
+        Run the cell over a whole sequence (b, t, c, h, w, d). The input-to-hidden convolution of all timesteps is
+        computed in one batched call and only the hidden-to-hidden convolution runs inside the loop.
+        If prev_state is None, the initial states are zero and the first hidden-to-hidden convolution is skipped.
+        On CPU, convolutions with half of the input channels are not twice as fast, so there the gates are computed
+        with the full convolution on cat(x, h) at each step instead
+
+        Returns
+        -------
+        outputs (b, t, hidden_dim, h, w, d), (h, c) of the last timestep
+        """
+        batch_size, seq_len = input.shape[:2]
+        batched = input.is_cuda
+        if batched:
+            input_gates = self.input_conv(input.reshape((batch_size*seq_len,) + input.shape[2:]))
+            input_gates = input_gates.reshape((batch_size, seq_len) + input_gates.shape[1:])
+
+        h, c = prev_state if prev_state is not None else (None, None)
+        output_inner = []
+        for t in range(seq_len):
+            if h is None:
+                gates = input_gates[:, t] if batched else self.input_conv(input[:, t])
+            elif batched:
+                gates = input_gates[:, t] + self.hidden_conv(h)
+            else:
+                gates = self.conv(torch.cat((input[:, t], h), dim=1))
+            h, c = self.update_state(gates, c)
+            output_inner.append(h)
+
+        return torch.stack(output_inner, dim=1), (h, c)
+
+    def init_hidden(self, batch_size, device=None, dtype=None):
+        return (torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth, device=device, dtype=dtype),
+                torch.zeros(batch_size, self.hidden_dim, self.height, self.width, self.depth, device=device, dtype=dtype))
 
 
 class ConvLSTM3D(nn.Module):
@@ -283,23 +324,16 @@ class ConvLSTM3D(nn.Module):
 
 
         if hidden_state is None:
-            hidden_state = self.get_init_states(batch_size=input.size(0))
+            # zero initial states are not allocated, the cells start from an empty state
+            hidden_state = [None]*self.num_layers
 
         layer_output_list = []
         last_state_list   = []
 
-        seq_len = input.size(1)
         cur_layer_input = input
 
         for layer_idx in range(self.num_layers):
-            h, c = hidden_state[layer_idx]
-            output_inner = []
-            for t in range(seq_len):
-                h, c = self.cell_list[layer_idx](input=cur_layer_input[:, t, :, :, :, :],
-                                                 prev_state=[h, c])
-                output_inner.append(h)
-
-            layer_output = torch.stack(output_inner, dim=1)
+            layer_output, (h, c) = self.cell_list[layer_idx].forward_sequence(cur_layer_input, hidden_state[layer_idx])
             cur_layer_input = layer_output
 
             layer_output_list.append(layer_output)
@@ -312,10 +346,10 @@ class ConvLSTM3D(nn.Module):
 
         return layer_output, last_state_list
 
-    def get_init_states(self, batch_size, cuda=True):
+    def get_init_states(self, batch_size, device=None, dtype=None):
         init_states = []
         for i in range(self.num_layers):
-            init_states.append(self.cell_list[i].init_hidden(batch_size, cuda))
+            init_states.append(self.cell_list[i].init_hidden(batch_size, device, dtype))
         return init_states
 
     @staticmethod
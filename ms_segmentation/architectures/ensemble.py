@@ -0,0 +1,91 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Ensemble of several models (e.g. the models of all cross-validation folds) that behaves as one model
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Every batch goes through all member models and their outputs (class probabilities) are averaged in
+#               place, so that patch extraction and reconstruction are done only once for the whole ensemble. With
+#               keep_members, the outputs of the members are concatenated along the class axis instead, so that the
+#               probabilities of every member can be reconstructed (and stored) from the same pass
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import torch
+import torch.nn as nn
+
+
+class ModelEnsemble(nn.Module):
+    """
+    Average of the outputs of several models with the same input and output shapes. If keep_members is True, the
+    output is (B, num_members*C, ...) with the outputs of all members (member i in channels i*C to (i+1)*C)
+    """
+    def __init__(self, members, keep_members=False):
+        super(ModelEnsemble, self).__init__()
+        self.members = nn.ModuleList(members)
+        self.keep_members = keep_members
+
+    def forward(self, x):
+        if self.keep_members:
+            return torch.cat([member(x) for member in self.members], dim=1)
+        out = None
+        for member in self.members:
+            if out is None:
+                out = member(x)
+            else:
+                out += member(x) # in place, only one output of the size of the batch is kept
+        return out.div_(len(self.members))
+
+    def forward_windows(self, x, time_windows):
+        """
+        Predict several temporal windows of the same patches with every member. Members that provide forward_windows
+        share the encoder features of each timepoint between windows, the others are called once per window
+
+        inputs:
+        - x: (B, T, C, x, y, z) with all timepoints of the case
+        - time_windows: list with the timepoint indexes of each window
+
+        outputs:
+        - list with the averaged output of each window (concatenated outputs of the members if keep_members is True)
+        """
+        outs = None
+        all_preds = []
+        for member in self.members:
+            if hasattr(member, "forward_windows"):
+                preds = member.forward_windows(x, time_windows)
+            else:
+                preds = [member(x[:, time_indexes]) for time_indexes in time_windows]
+            if self.keep_members:
+                all_preds.append(preds)
+            elif outs is None:
+                outs = preds
+            else:
+                for out, pred in zip(outs, preds):
+                    out += pred
+        if self.keep_members:
+            return [torch.cat(preds, dim=1) for preds in zip(*all_preds)]
+        return [out.div_(len(self.members)) for out in outs]
+
+
+def load_ensemble(model_function, checkpoint_paths, device, keep_members=False, **model_args):
+    """
+    Create one model per checkpoint and group them in a ModelEnsemble
+
+    inputs:
+    - model_function: class (or function) that creates a model, e.g. eval(parameters_dict["model_name"])
+    - checkpoint_paths: list with the paths to the state dictionaries of all members
+    - device: device where the ensemble is placed
+    - keep_members: if True, the outputs of all members are returned instead of their average (see ModelEnsemble)
+    - model_args: arguments of model_function (e.g. n_channels, n_classes, bilinear)
+
+    outputs:
+    - ModelEnsemble in evaluation mode
+    """
+    members = []
+    for checkpoint_path in checkpoint_paths:
+        member = model_function(**model_args)
+        member.load_state_dict(torch.load(checkpoint_path, map_location=device))
+        members.append(member)
+    return ModelEnsemble(members, keep_members).to(device).eval()
@@ -8,6 +8,27 @@ from .unet2d import DoubleConv, Down, Up, OutConv, SUp
 from .unet3d import DoubleConv3D, Down3D, Up3D, OutConv3D
 
 
+def time_distributed(layer, inputs, time_folded=True):
+    """
+    Apply a block shared by all timepoints to inputs with shape (B, T, C, ...)
+
+    inputs:
+    - layer: block (e.g. Down3D, Up3D) applied to every timepoint
+    - inputs: list of tensors (B, T, C, ...). All of them are passed to <layer> (e.g. upsampled input and skip connection)
+    - time_folded: if True, timepoints are folded into the batch dimension (B*T, C, ...) and the block runs once.
+                   Otherwise the block is run once per timepoint
+
+    outputs:
+    - tensor (B, T, C', ...) on the same device as the inputs
+    """
+    batch_size, num_time_steps = inputs[0].shape[:2]
+    if time_folded:
+        the_output = layer(*[x.reshape((batch_size*num_time_steps,) + x.shape[2:]) for x in inputs])
+        return the_output.reshape((batch_size, num_time_steps) + the_output.shape[1:])
+    return torch.stack([layer(*[x[:, i_tp] for x in inputs]) for i_tp in range(num_time_steps)], dim=1)
+
+
+
 class UNet_ConvGRU_2D(nn.Module):
     """
     Basic U-net+ConvGRU model. UNet layers built with basic blocks without batch normalization.
@@ -595,13 +616,16 @@ class UNet_ConvLSTM_3D_alt(nn.Module):
         Blocks implemented according to class blocks defined in unet3d file
     """
 
-    def __init__(self, n_channels, n_classes, bilinear=True):
+    def __init__(self, n_channels, n_classes, bilinear=True, time_folded=True, time_folded_training=False):
 
         super(UNet_ConvLSTM_3D_alt, self).__init__()
 
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
+        # run each shared block once on (B*T, C, ...) instead of once per timepoint. Always exact in eval mode
+        self.time_folded = time_folded
+        self.time_folded_training = time_folded_training
 
         self.inc = DoubleConv3D(n_channels, 32)
         self.down1 = Down3D(32, 64)
@@ -633,37 +657,52 @@ class UNet_ConvLSTM_3D_alt(nn.Module):
 
 
         # Define wrappers
+    def use_time_folding(self):
+        # BatchNorm statistics of the folded batch mix all timepoints, so in training this is only done if requested
+        return self.time_folded and (not self.training or self.time_folded_training)
+
     def wrapper_conv(self, the_input, layer, out_channels, layer_type= "Down"):
-        num_time_steps = the_input.size(1)
-        if layer_type == "DoubleConv":
-            the_output = torch.zeros(the_input.size(0), num_time_steps, out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1), device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), num_time_steps, out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1))).cuda()
-        elif layer_type == "Down":
-            the_output = torch.zeros(the_input.size(0), num_time_steps, out_channels, the_input.size(-3)//2, the_input.size(-2)//2, the_input.size(-1)//2, device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), num_time_steps, out_channels, the_input.size(-3)//2, the_input.size(-2)//2, the_input.size(-1)//2)).cuda()
-        else: #layer_type == OutConv
-            the_output = torch.zeros(the_input.size(0), out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1), device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1))).cuda()
-            the_output = layer(the_input)
-            return the_output
-        for i_tp in range(num_time_steps):
-            the_output[:,i_tp,:,:,:,:] = layer(the_input[:,i_tp,:,:,:,:])
-        return the_output
+        if layer_type == "OutConv":
+            return layer(the_input)
+        return time_distributed(layer, [the_input], self.use_time_folding())
 
     def wrapper_up(self, the_input1, the_input2, layer, out_channels):
+        return time_distributed(layer, [the_input1, the_input2], self.use_time_folding())
 
-        num_time_steps = the_input1.size(1)
-        the_output = torch.zeros(the_input1.size(0), num_time_steps, out_channels, int(2*the_input1.size(-3)), int(2*the_input1.size(-2)), int(2*the_input1.size(-1)), device = "cuda")
-        for i_tp in range(num_time_steps):
-            the_output[:,i_tp,:,:,:,:] = layer(the_input1[:,i_tp,:,:,:,:], the_input2[:,i_tp,:,:,:,:])
-        return the_output
-
-    def forward(self, x):
+    def encode(self, x):
+        """
+        Encoder shared by all timepoints. Returns the skip features (B, T, C, ...) of every level
+        """
         #x eg (5,3,2,32,32,32)
         x1 = self.wrapper_conv(x, self.inc, 32, layer_type = "DoubleConv") # (5,3,32,32,32,32)
         x2 = self.wrapper_conv(x1, self.down1, 64) # (5,3,64,16,16,16)
         x3 = self.wrapper_conv(x2, self.down2, 128) # (5,3,128,8,8,8)
         x4 = self.wrapper_conv(x3, self.down3, 256) # (5,3,256,4,4,4)
+        return x1, x2, x3, x4
+
+    def forward_windows(self, x, time_windows):
+        """
+        Predict several temporal windows of the same patches. The encoder runs once per timepoint and its features
+        are shared by all windows that contain that timepoint. Only the temporal and decoder stages run per window
+
+        inputs:
+        - x: (B, T, C, x, y, z) with all timepoints of the case
+        - time_windows: list with the timepoint indexes of each window, e.g. [[0,0,1], [0,1,2], [1,2,2]]
+
+        outputs:
+        - list with the output of each window
+        """
+        features = self.encode(x)
+        return [self.decode([f[:, time_indexes] for f in features]) for time_indexes in time_windows]
+
+    def forward(self, x):
+        return self.decode(self.encode(x))
+
+    def decode(self, features):
+        """
+        Temporal (ConvLSTM) and decoder stages from the encoder features of one window
+        """
+        x1, x2, x3, x4 = features
         x5_ = self.convLSTM1(x4)[0] # (5,3,256,4,4,4)
         x5 = self.wrapper_conv(x5_, self.down4, 256) # (5,3,256,2,2,2)
         #
@@ -686,13 +725,16 @@ class UNet_ConvLSTM_3D_alt_bidirectional(nn.Module):
         Blocks implemented according to class blocks defined in unet3d file. Bi-directional version
     """
 
-    def __init__(self, n_channels, n_classes, bilinear=True):
+    def __init__(self, n_channels, n_classes, bilinear=True, time_folded=True, time_folded_training=False):
 
         super(UNet_ConvLSTM_3D_alt_bidirectional, self).__init__()
 
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.bilinear = bilinear
+        # run each shared block once on (B*T, C, ...) instead of once per timepoint. Always exact in eval mode
+        self.time_folded = time_folded
+        self.time_folded_training = time_folded_training
 
         self.inc = DoubleConv3D(n_channels, 32)
         self.down1 = Down3D(32, 64)
@@ -724,48 +766,66 @@ class UNet_ConvLSTM_3D_alt_bidirectional(nn.Module):
 
 
         # Define wrappers
+    def use_time_folding(self):
+        # BatchNorm statistics of the folded batch mix all timepoints, so in training this is only done if requested
+        return self.time_folded and (not self.training or self.time_folded_training)
+
     def wrapper_conv(self, the_input, layer, out_channels, layer_type= "Down"):
-        num_time_steps = the_input.size(1)
-        if layer_type == "DoubleConv":
-            the_output = torch.zeros(the_input.size(0), num_time_steps, out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1), device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), num_time_steps, out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1))).cuda()
-        elif layer_type == "Down":
-            the_output = torch.zeros(the_input.size(0), num_time_steps, out_channels, the_input.size(-3)//2, the_input.size(-2)//2, the_input.size(-1)//2, device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), num_time_steps, out_channels, the_input.size(-3)//2, the_input.size(-2)//2, the_input.size(-1)//2)).cuda()
-        else: #layer_type == OutConv
-            the_output = torch.zeros(the_input.size(0), out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1), device = "cuda")
-            #the_output = torch.zeros_like(torch.Tensor(the_input.size(0), out_channels, the_input.size(-3), the_input.size(-2), the_input.size(-1))).cuda()
-            the_output = layer(the_input)
-            return the_output
-        for i_tp in range(num_time_steps):
-            the_output[:,i_tp,:,:,:,:] = layer(the_input[:,i_tp,:,:,:,:])
-        return the_output
+        if layer_type == "OutConv":
+            return layer(the_input)
+        return time_distributed(layer, [the_input], self.use_time_folding())
 
     def wrapper_up(self, the_input1, the_input2, layer, out_channels):
-
-        num_time_steps = the_input1.size(1)
-        the_output = torch.zeros(the_input1.size(0), num_time_steps, out_channels, int(2*the_input1.size(-3)), int(2*the_input1.size(-2)), int(2*the_input1.size(-1)), device = "cuda")
-        for i_tp in range(num_time_steps):
-            the_output[:,i_tp,:,:,:,:] = layer(the_input1[:,i_tp,:,:,:,:], the_input2[:,i_tp,:,:,:,:])
-        return the_output
-
-    def forward(self, x):
+        return time_distributed(layer, [the_input1, the_input2], self.use_time_folding())
+
+    def wrapper_bidirectional(self, the_input, layer):
+        # both directions share the weights, so the flipped sequences are appended to the batch and the
+        # recurrent layer runs once: [forward; backward] -> forward + backward
+        batch_size = the_input.size(0)
+        the_output = layer(torch.cat([the_input, torch.flip(the_input, (1,))], dim=0))[0]
+        return the_output[:batch_size] + the_output[batch_size:]
+
+    def encode(self, x):
+        """
+        Encoder shared by all timepoints. Returns the skip features (B, T, C, ...) of every level
+        """
         #x eg (5,3,2,32,32,32)
         x1 = self.wrapper_conv(x, self.inc, 32, layer_type = "DoubleConv") # (5,3,32,32,32,32)
         x2 = self.wrapper_conv(x1, self.down1, 64) # (5,3,64,16,16,16)
         x3 = self.wrapper_conv(x2, self.down2, 128) # (5,3,128,8,8,8)
         x4 = self.wrapper_conv(x3, self.down3, 256) # (5,3,256,4,4,4)
-        x5_f = self.convLSTM1(x4)[0] # (5,3,256,4,4,4)
-        x5_b = self.convLSTM1(torch.flip(x4, (1,)))[0]
-        x5 = self.wrapper_conv(x5_f+x5_b, self.down4, 256) # (5,3,256,2,2,2)
+        return x1, x2, x3, x4
+
+    def forward_windows(self, x, time_windows):
+        """
+        Predict several temporal windows of the same patches. The encoder runs once per timepoint and its features
+        are shared by all windows that contain that timepoint. Only the temporal and decoder stages run per window
+
+        inputs:
+        - x: (B, T, C, x, y, z) with all timepoints of the case
+        - time_windows: list with the timepoint indexes of each window, e.g. [[0,0,1], [0,1,2], [1,2,2]]
+
+        outputs:
+        - list with the output of each window
+        """
+        features = self.encode(x)
+        return [self.decode([f[:, time_indexes] for f in features]) for time_indexes in time_windows]
+
+    def forward(self, x):
+        return self.decode(self.encode(x))
+
+    def decode(self, features):
+        """
+        Temporal (ConvLSTM) and decoder stages from the encoder features of one window
+        """
+        x1, x2, x3, x4 = features
+        x5 = self.wrapper_conv(self.wrapper_bidirectional(x4, self.convLSTM1), self.down4, 256) # (5,3,256,2,2,2)
         #
         x = self.wrapper_up(x5, x4, self.up1,128) # (5,3,128,4,4,4)
         x = self.wrapper_up(x, x3, self.up2, 64) # (5,3,64,8,8,8)
         x = self.wrapper_up(x, x2, self.up3, 32) # (5,3,32,16,16,16)
         x = self.wrapper_up(x, x1, self.up4, 32) # (5,3,32,32,32,32)
-        x_f = self.convLSTM2(x)[0]
-        x_b = self.convLSTM2(torch.flip(x, (1,)))[0]
-        x = x_f + x_b
+        x = self.wrapper_bidirectional(x, self.convLSTM2)
         #x = self.convGRU2(x)[0][0].permute(0,2,1,3,4,5) #(5,32,3,32,32,32)
 
         x = x[:,-2,:,:,:,:] # (5,32,32,32,32)
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 from operator import add
+from ..patch_extraction import pad_block, gather_patches
 
 
 class MRI_DataPatchLoader(Dataset):
@@ -364,7 +365,7 @@ def get_voxel_coordenates(input_data,
     - random_pad: initial random padding applied to indexes
 
     output:
-    - list of voxel coordenates
+    - (N, 3) np.array of voxel coordenates
     """
 
     # compute initial padding
@@ -372,19 +373,14 @@ def get_voxel_coordenates(input_data,
     c_pad = np.random.randint(random_pad[1]+1) if random_pad[1] > 0 else 0
     s_pad = np.random.randint(random_pad[2]+1) if random_pad[2] > 0 else 0
 
-    # precompute the sampling points based on the input
-    sampled_data = np.zeros_like(input_data)
-    for r in range(r_pad, input_data.shape[0], step_size[0]):
-        for c in range(c_pad, input_data.shape[1], step_size[1]):
-            for s in range(s_pad, input_data.shape[2], step_size[2]):
-                sampled_data[r, c, s] = 1
+    # the sampling grid is a strided view of the roi: only the grid points are checked
+    # and their indexes are mapped back to volume coordenates
+    offset = np.array([r_pad, c_pad, s_pad])
+    step = np.array(step_size[:3])
+    sampled_roi = np.asarray(roi)[r_pad::step[0], c_pad::step[1], s_pad::step[2]]
 
-    # apply sampled points to roi and extract sample coordenates
-    # [x, y, z] = np.where(input_data * roi * sampled_data)
-    [x, y, z] = np.where(roi * sampled_data)
-
-    # return as a list of tuples
-    return [(x_, y_, z_) for x_, y_, z_ in zip(x, y, z)]
+    # return as an (N, 3) array of coordenates
+    return np.stack(np.nonzero(sampled_roi), axis=1)*step + offset
 
 
 def get_patches(input_data, centers, patch_size=(15, 15, 15)):
@@ -402,27 +398,10 @@ def get_patches(input_data, centers, patch_size=(15, 15, 15)):
     # If the size has even numbers, the patch will be centered. If not,
     # it will try to create an square almost centered. By doing this we allow
     # pooling when using encoders/unets.
-    patches = []
-    list_of_tuples = all([isinstance(center, tuple) for center in centers])
-    sizes_match = [len(center) == len(patch_size) for center in centers]
-
-    if list_of_tuples and sizes_match:
-        # apply padding to the input image and re-compute the voxel coordenates
-        # according to the new dimension
-        padded_image = apply_padding(input_data, patch_size)
-        patch_half = tuple([idx // 2 for idx in patch_size])
-        new_centers = [map(add, center, patch_half) for center in centers]
-        # compute patch locations
-        slices = [[slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                   for (c_idx, p_idx, s_idx) in zip(center,
-                                                    patch_half,
-                                                    patch_size)]
-                  for center in new_centers]
-
-        # extact patches
-        patches = [padded_image[tuple(idx)] for idx in slices]
-
-    return np.array(patches)
+    # After padding, the first voxel of each patch coincides with the original center coordenates
+    padded_image = pad_block(input_data, patch_size)
+
+    return gather_patches(padded_image, centers, patch_size)
 
 
 def reconstruct_image(input_data, centers, output_size):
@@ -0,0 +1,304 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with intensity normalization of longitudinal images: every timepoint is scaled so that the
+#               histogram of its white matter matches a reference histogram (chi-square distance), or its intensities
+#               are mapped so that its histogram matches the one of a reference volume (quantile matching)
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      The reference histogram is computed once per modality and the WM voxels of a target are extracted and
+#               sorted once. The histogram of the scaled voxels is then obtained for every evaluation of the 1-D
+#               search with a search of the (scaled) bin edges in the sorted voxels, so no voxel is touched again.
+#               Patients and modalities can be processed by a pool of processes (run_chi_square_normalization)
+#               For histogram matching, each volume is summarized once by a fixed-size table of quantiles. Matching a
+#               target to a reference is then a piecewise linear map between both tables (np.interp). Matched volumes
+#               are memoized per (input file, reference file) for the life of the process (matched_volumes) and, if the
+#               preprocessing cache is enabled, persisted on disk, so training loaders and inference share them
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+from multiprocessing import Pool
+from scipy.optimize import fmin
+from ..general.general import save_image
+from . import preprocessing_cache
+from .preprocessing_cache import load_volume, load_cached_array, get_array_key, get_file_hash
+from .volume_cache import VolumeCache
+
+matched_volumes = VolumeCache(max_bytes=2*1024**3) # (file, reference file, preprocessing) -> histogram-matched volume
+quantile_tables = {} # (file, preprocessing) -> quantile table of the normalized volume
+
+
+def get_density_histogram(values, num_bins=256, value_range=(0, 1)):
+    """
+    Density histogram of <values>, as np.histogram(values, num_bins, value_range, density=True)[0], computed with a
+    bincount. Values outside the range are ignored
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    values = values[(values >= value_range[0]) & (values <= value_range[1])]
+    if len(values) == 0:
+        return np.zeros(num_bins)
+    bin_width = (value_range[1] - value_range[0]) / num_bins
+    indexes = np.minimum(((values - value_range[0]) / bin_width).astype(np.int64), num_bins - 1) # last bin includes the upper edge
+    return np.bincount(indexes, minlength=num_bins) / (len(values) * bin_width)
+
+
+def get_scaled_histogram(sorted_values, scale, num_bins=256, value_range=(0, 1)):
+    """
+    Density histogram of scale*values for sorted (ascending) non-negative values. Bin edges are divided by the scale
+    and searched in the sorted values, so the cost does not depend on the number of voxels
+
+    outputs:
+    - density histogram, or None if no scaled value falls in the range
+    """
+    if scale <= 0:
+        return None
+    edges = np.linspace(value_range[0], value_range[1], num_bins + 1) / scale
+    positions = np.searchsorted(sorted_values, edges, side='left')
+    positions[-1] = np.searchsorted(sorted_values, edges[-1], side='right') # last bin includes the upper edge
+    counts = np.diff(positions)
+    total = positions[-1] - positions[0]
+    if total == 0:
+        return None
+    return counts / (total * (value_range[1] - value_range[0]) / num_bins)
+
+
+def chi_square_distance(reference_histogram, histogram):
+    """
+    Chi-square distance between two histograms, as cv2.compareHist(reference, histogram, cv2.HISTCMP_CHISQR):
+    sum over the bins with non-zero reference of (reference - histogram)^2 / reference
+    """
+    reference_histogram = np.asarray(reference_histogram, dtype=np.float64)
+    valid = np.abs(reference_histogram) > np.finfo(np.float64).eps
+    diff = reference_histogram[valid] - np.asarray(histogram, dtype=np.float64)[valid]
+    return np.sum(diff * diff / reference_histogram[valid])
+
+
+def get_reference_histogram(reference_image, reference_mask, num_bins=256, mask_threshold=0):
+    """
+    Histogram of the reference image inside the mask (e.g. WM). Computed once per modality
+    """
+    return get_density_histogram(reference_image[reference_mask > mask_threshold], num_bins).astype(np.float32)
+
+
+def find_chi_square_scale(reference_histogram, values, x0=0.5, num_bins=256):
+    """
+    Scale factor that minimizes the chi-square distance between the histogram of scale*values and the reference
+
+    inputs:
+    - reference_histogram: see get_reference_histogram
+    - values: intensities of the target inside the mask (e.g. WM voxels), in [0, 1]
+    - x0: initial scale of the search
+    - num_bins: number of bins of the histograms
+
+    outputs:
+    - optimal scale
+    """
+    sorted_values = np.sort(np.asarray(values, dtype=np.float64).ravel())
+    reference_histogram = np.asarray(reference_histogram, dtype=np.float32)
+
+    def objective(x):
+        histogram = get_scaled_histogram(sorted_values, x[0], num_bins)
+        if histogram is None:
+            return np.inf
+        return chi_square_distance(reference_histogram, histogram.astype(np.float32))
+
+    return fmin(func=objective, x0=[x0], disp=False)[0]
+
+
+def chi_square_normalize(image, mask, reference_histogram, x0=0.5, mask_threshold=0.5, num_bins=256):
+    """
+    Scale an image (normalized to [0, 1]) so that the histogram inside the mask matches the reference histogram
+
+    inputs:
+    - image: image normalized to [0, 1]
+    - mask: mask of the tissue used for the matching (e.g. WM)
+    - reference_histogram: see get_reference_histogram
+    - x0: initial scale of the search
+    - mask_threshold: voxels with mask > mask_threshold are used
+
+    outputs:
+    - normalized image clipped to [0, 1] and scale factor
+    """
+    scale = find_chi_square_scale(reference_histogram, image[mask > mask_threshold], x0=x0, num_bins=num_bins)
+    return np.clip(scale * image, 0, 1), scale
+
+
+def get_quantile_table(volume, num_quantiles=1024, threshold=None):
+    """
+    Intensities of a volume at <num_quantiles> equally spaced quantile levels (from 0 to 1)
+
+    inputs:
+    - volume: np.array with the volume
+    - num_quantiles: size of the table
+    - threshold: if not None, only voxels with intensity > threshold are considered (e.g. 0 to ignore the background)
+
+    outputs:
+    - np.array (num_quantiles,) with the quantiles, or None if there are no voxels above the threshold
+    """
+    values = np.ravel(volume) if threshold is None else volume[volume > threshold]
+    if len(values) == 0:
+        return None
+    positions = np.round(np.linspace(0, len(values) - 1, num_quantiles)).astype(np.int64)
+    return np.sort(values)[positions].astype(np.float64)
+
+
+def match_quantile_table(target, ref_table, target_table=None, threshold=None):
+    """
+    Map the intensities of <target> so that its histogram matches the one of the reference volume summarized by
+    <ref_table>. Voxels between two quantiles of the target are interpolated linearly between the corresponding
+    quantiles of the reference
+
+    inputs:
+    - target: np.array with the volume to modify
+    - ref_table: quantile table of the reference (see get_quantile_table)
+    - target_table: quantile table of the target. Computed if None
+    - threshold: voxels with intensity <= threshold are not used for the tables and keep their value. Must be the
+                 same that was used for ref_table
+
+    outputs:
+    - matched volume (float32)
+    """
+    if target_table is None:
+        target_table = get_quantile_table(target, len(ref_table), threshold)
+    if target_table is None or ref_table is None:
+        return target.astype(np.float32)
+
+    # repeated intensities (e.g. background) take the highest quantile they cover, as in a cumulative histogram
+    last = np.append(target_table[1:] != target_table[:-1], True)
+    matched = np.interp(target, target_table[last], ref_table[last]).astype(np.float32)
+    if threshold is not None:
+        matched[target <= threshold] = target[target <= threshold]
+    return matched
+
+
+def get_file_quantile_table(path, dtype='float32', norm_type='zero_one', num_quantiles=1024):
+    """
+    Quantile table of the normalized volume of a file (background ignored). Computed once per file
+    """
+    from .patch_manager_3d import normalize_data
+
+    key = (os.path.abspath(path), None if dtype is None else np.dtype(dtype).str, norm_type, num_quantiles)
+    if key not in quantile_tables:
+        quantile_tables[key] = get_quantile_table(load_volume(path, dtype, None, normalize_data, norm_type), num_quantiles, threshold=0)
+    return quantile_tables[key]
+
+
+def load_matched_volume(path, ref_path, dtype='float32', patch_size=None, norm_type='zero_one', num_quantiles=1024):
+    """
+    Read a normalized volume whose histogram is matched to the one of a reference volume (e.g. first timepoint).
+    Background voxels (<= 0) are not modified. Volumes are memoized in matched_volumes and, if the preprocessing cache
+    is enabled, persisted on disk
+
+    inputs:
+    - path: path to the NIfTI file of the volume
+    - ref_path: path to the NIfTI file of the reference. If it is the same file, the volume is only normalized
+    - dtype, patch_size, norm_type: see preprocessing_cache.preprocess_volume (the volume is normalized with normalize_data)
+    - num_quantiles: size of the quantile tables
+
+    outputs:
+    - matched volume (read-only, float32)
+    """
+    from .patch_manager_3d import normalize_data
+
+    if os.path.abspath(path) == os.path.abspath(ref_path):
+        return load_volume(path, dtype, patch_size, normalize_data, norm_type)
+
+    def match():
+        return match_quantile_table(load_volume(path, dtype, patch_size, normalize_data, norm_type),
+                                    get_file_quantile_table(ref_path, dtype, norm_type, num_quantiles),
+                                    get_file_quantile_table(path, dtype, norm_type, num_quantiles), threshold=0)
+
+    def load():
+        if preprocessing_cache.cache_dir is None:
+            volume = match()
+            volume.setflags(write=False) # shared by all callers
+            return volume
+        params = {"operation": "histogram_matching",
+                  "file": get_file_hash(path),
+                  "reference": get_file_hash(ref_path),
+                  "dtype": None if dtype is None else np.dtype(dtype).str,
+                  "patch_size": None if patch_size is None else [int(s) for s in patch_size],
+                  "norm_type": norm_type,
+                  "num_quantiles": num_quantiles}
+        volume = load_cached_array(get_array_key(params), match)
+        volume.setflags(write=False) # shared by all callers
+        return volume
+
+    key = (os.path.abspath(path), os.path.abspath(ref_path), None if dtype is None else np.dtype(dtype).str,
+           None if patch_size is None else tuple(patch_size), norm_type, num_quantiles)
+    return matched_volumes.get(key, load)
+
+
+def normalize_work_item(work_item):
+    """
+    Normalize all timepoints of one patient and one modality
+
+    inputs:
+    - work_item: dictionary with
+        - "key": identifier of the work item, e.g. (patient, modality)
+        - "image_paths": paths to the images of all timepoints
+        - "mask_paths": paths to the masks (e.g. WM) of all timepoints
+        - "output_paths": paths where the normalized images are saved
+        - "reference_histogram": see get_reference_histogram
+        - "x0", "mask_threshold": see chi_square_normalize
+        - "tissue_paths" (optional): dictionary {tissue name: paths of all timepoints}. The histograms of the images
+                                     inside these masks are returned, e.g. for plotting
+
+    outputs:
+    - key of the work item and dictionary with the scales and the histograms (brain, and tissues) before and after
+      the normalization of every timepoint
+    """
+    from .patch_manager_3d import normalize_data
+
+    result = {"scales": [], "histograms": [], "histograms_aligned": [], "tissue_histograms": {}, "tissue_histograms_aligned": {}}
+    tissue_paths = work_item.get("tissue_paths", {})
+    for tissue in tissue_paths:
+        result["tissue_histograms"][tissue] = []
+        result["tissue_histograms_aligned"][tissue] = []
+
+    for i_tp, (image_path, mask_path, output_path) in enumerate(zip(work_item["image_paths"], work_item["mask_paths"], work_item["output_paths"])):
+        image = load_volume(image_path, None, normalize_function=normalize_data, fdata=True)
+        mask = load_volume(mask_path, None, fdata=True)
+        image_aligned, scale = chi_square_normalize(image, mask, work_item["reference_histogram"], x0=work_item["x0"],
+                                                    mask_threshold=work_item["mask_threshold"])
+        save_image(image_aligned, output_path)
+
+        result["scales"].append(scale)
+        result["histograms"].append(get_density_histogram(image[image > 0]))
+        result["histograms_aligned"].append(get_density_histogram(image_aligned[image_aligned > 0]))
+        for tissue, paths in tissue_paths.items():
+            tissue_mask = load_volume(paths[i_tp], None, fdata=True) > 0
+            result["tissue_histograms"][tissue].append(get_density_histogram(image[tissue_mask]))
+            result["tissue_histograms_aligned"][tissue].append(get_density_histogram(image_aligned[tissue_mask]))
+    return work_item["key"], result
+
+
+def run_chi_square_normalization(work_items, num_workers=None):
+    """
+    Normalize all work items (see normalize_work_item) with a pool of processes
+
+    inputs:
+    - work_items: list of work items
+    - num_workers: number of processes. If None, the number of CPUs is used. If 1, items are processed serially
+
+    outputs:
+    - dictionary {key of the work item: result}
+    """
+    num_workers = num_workers or os.cpu_count()
+    results = {}
+    if num_workers == 1:
+        for i_item, work_item in enumerate(work_items):
+            key, result = normalize_work_item(work_item)
+            results[key] = result
+            print("Normalized", i_item+1, "/", len(work_items), key)
+        return results
+
+    with Pool(num_workers) as pool:
+        for i_item, (key, result) in enumerate(pool.imap_unordered(normalize_work_item, work_items)):
+            results[key] = result
+            print("Normalized", i_item+1, "/", len(work_items), key)
+    return results
@@ -0,0 +1,65 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with vectorized extraction of patches from (multi-timepoint, multi-modal) volumes
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      All patches of a block are gathered with a single fancy-indexing operation on a sliding window view
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def pad_block(block, patch_size, mode='constant', value=0):
+    """
+    Apply padding to the last len(patch_size) axes of <block> in order to avoid overflow.
+    Leading axes (e.g. timepoints, modalities) are not padded
+
+    inputs:
+    - block: np.array (..., x, y, z)
+    - patch_size: patch size (x,y,z)
+
+    outputs:
+    - padded block
+    """
+    patch_half = tuple([idx // 2 for idx in patch_size])
+    padding = ((0, 0),)*(block.ndim - len(patch_size)) + tuple((idx, size-idx)
+                                                            for idx, size in zip(patch_half, patch_size))
+    return np.pad(block, padding, mode=mode, constant_values=value)
+
+
+def gather_patches(block, corners, patch_size):
+    """
+    Get all patches of a block in one vectorized operation
+
+    inputs:
+    - block: np.array (..., x, y, z). The last len(patch_size) axes are the spatial ones, e.g. (T, M, x, y, z)
+    - corners: (N, len(patch_size)) array with the first voxel of each patch (center - patch_half)
+    - patch_size: patch size (x,y,z)
+
+    outputs:
+    - patches: np.array (N, ..., px, py, pz). Patches that do not fit in the block are filled with zeros
+    """
+    num_dims = len(patch_size)
+    spatial_axes = tuple(range(block.ndim - num_dims, block.ndim))
+    corners = np.asarray(corners, dtype=np.intp).reshape(-1, num_dims)
+
+    # check that all patches are inside the block
+    max_corner = np.array(block.shape[-num_dims:]) - np.array(patch_size)
+    valid = np.all((corners >= 0) & (corners <= max_corner), axis=1)
+    if not np.all(valid):
+        print('error in patch', np.count_nonzero(~valid), 'patches out of bounds, filling them with zeros')
+        corners = np.where(valid[:, np.newaxis], corners, 0)
+
+    windows = sliding_window_view(block, patch_size, axis=spatial_axes) # (..., x', y', z', px, py, pz)
+    index = (slice(None),)*(block.ndim - num_dims) + tuple(corners[:, d] for d in range(num_dims))
+    patches = np.moveaxis(windows[index], block.ndim - num_dims, 0)
+
+    if not np.all(valid):
+        patches[~valid] = 0
+
+    return patches
@@ -4,8 +4,12 @@ import numpy as np
 import torch
 import random
 from torch.utils.data import Dataset
-from operator import add 
+from itertools import groupby
 from ..general.general import list_folders
+from .preprocessing_cache import load_volume
+from .patch_extraction import gather_patches
+from .patch_reconstruction import overlap_add
+from .volume_cache import VolumeCache, CachedVolumeLoader
 from os.path import join as jp
 
 
@@ -14,7 +18,7 @@ from os.path import join as jp
 #----------------------------------------------------------------------------------------------------------------------
 
 
-class PatchLoader2D_slow(Dataset):
+class PatchLoader2D_slow(CachedVolumeLoader, Dataset):
     """
     Dataset class for loading MRI patches from multiple modalities. Based on script utils.py provided by Sergi Valverde. 
     Each patch is loaded when it is needed, therefore it is slow. Use class PatchLoader2D (below) for a faster performance.
@@ -34,7 +38,8 @@ class PatchLoader2D_slow(Dataset):
                  min_sampling_th=0, # 
                  num_pos_samples=5000, # Maximum number of samples
                  resample_epoch=False, # Whether or not to resample after each epoch
-                 transform=None): # Transforms to be applied to the patches
+                 transform=None, # Transforms to be applied to the patches
+                 cache_max_bytes=2*1024**3): # Memory budget (bytes) of the LRU cache of padded and normalized volumes
 
         self.input_data = list(input_data.values()) # Extract image paths from dictionary
         self.input_labels = list(labels.values()) # Extract labels paths from dictionary
@@ -51,9 +56,8 @@ class PatchLoader2D_slow(Dataset):
         self.resample_epoch = resample_epoch
         self.transform = transform
         self.num_pos_samples = num_pos_samples
-        self.prev_im_ = None
-        self.prev_input_data = None
-        self.prev_labels = None
+        self.volume_cache = VolumeCache(max_bytes=cache_max_bytes)
+        self.normalize_function = normalize_data # used by read_volume (see CachedVolumeLoader)
 
         #Check that number of images coincide 
         if not len(input_data) == len(labels) == len(rois):
@@ -88,33 +92,10 @@ class PatchLoader2D_slow(Dataset):
                                                    self.patch_half,
                                                    self.patch_size)]
 
-        #Read images -> Super slow, reads image for every patch
-        if self.pad_or_not:
-            if self.prev_im_ == im_:
-                s = self.prev_input_data
-                l = self.prev_labels
-            else:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[im_][k]).get_data().astype('float32'))
-                                for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[im_][0]).get_data().astype('float32'))]
-        else:
-            if self.prev_im_ == im_:
-                s = self.prev_input_data
-                l = self.prev_labels
-            else:
-                s = [nib.load(
-                        self.input_data[im_][k]).get_data().astype('float32')
-                                for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[im_][0]).get_data().astype('float32')]
-
-        if self.normalize: #Normalize image
-            s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
-
-        self.prev_input_data = s.copy()
-        self.prev_labels = l.copy()
+        #Read images through the volume cache (only read from disk if not cached)
+        s = [self.read_volume(self.input_data[im_][k], (im_, 0, k), normalize=self.normalize)
+                        for k in range(self.num_modalities)]
+        l = [self.read_volume(self.input_labels[im_][0], (im_, 0, 'label'))]
 
         # get current patches for both training data and labels
         input_train = np.stack([s[m][:,:,center[2]][tuple(slice_)]
@@ -134,9 +115,6 @@ class PatchLoader2D_slow(Dataset):
             input_train, input_label = self.transform([input_train,
                                                        input_label])
 
-        self.prev_im_ = im_
-
-
         return input_train, input_label
 
     # def remove_percentage(self, percentage):
@@ -155,22 +133,16 @@ class PatchLoader2D_slow(Dataset):
         for i in range(len(self.input_data)): # Process one image at a time
             #Padding
             if self.pad_or_not:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[i][k]).get_data().astype('float32'))
+                s = [load_volume(self.input_data[i][k], 'float32', self.patch_size)
                               for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32'))]
-                r = [self.apply_padding(nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32'))]
+                l = [load_volume(self.input_labels[i][0], 'float32', self.patch_size)]
+                r = [load_volume(self.input_rois[i][0], 'float32', self.patch_size)]
             #No pading
             else:
-                s = [nib.load(
-                        self.input_data[i][k]).get_data().astype('float32')
+                s = [load_volume(self.input_data[i][k], 'float32')
                               for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32')]
-                r = [nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32')]                
+                l = [load_volume(self.input_labels[i][0], 'float32')]
+                r = [load_volume(self.input_rois[i][0], 'float32')]                
 
 
             candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -327,66 +299,31 @@ class PatchLoader2D(Dataset):
         # all_patches = [num_patches, num_modalities + 1, patch_side, patch_side]
         all_patches = np.zeros((len(self.patch_indexes), len(self.input_data[0]) + len(self.input_labels[0]), self.patch_size[0], self.patch_size[1]), dtype='float32')
 
-        for idx in range(len(self.patch_indexes)):
-            print(idx, "/", len(self.patch_indexes))
-            im_ = self.patch_indexes[idx][0]
-            center = self.patch_indexes[idx][1]
+        # Patches of the same image are consecutive, so all patches of an image are extracted at once
+        for im_, group in groupby(range(len(self.patch_indexes)), key=lambda i: self.patch_indexes[i][0]):
+            group = list(group)
+            print(group[-1], "/", len(self.patch_indexes))
 
-            slice_ = [slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                    for (c_idx, p_idx, s_idx) in zip(center[:-1],
-                                                    self.patch_half,
-                                                    self.patch_size)]
+            # decoded, padded and normalized volumes are read through the preprocessing cache
+            padding = self.patch_size if self.pad_or_not else None
+            s = [load_volume(self.input_data[im_][k], 'float32', padding, normalize_data if self.normalize else None, self.norm_type)
+                            for k in range(self.num_modalities)]
+            l = [load_volume(self.input_labels[im_][0], 'float32', padding)]
 
-            #Read images -> Super slow, reads image for every patch
-            if self.pad_or_not:
-                if self.prev_im_ == im_:
-                    s = self.prev_input_data
-                    l = self.prev_labels
-                else:
-                    s = [self.apply_padding(nib.load(
-                            self.input_data[im_][k]).get_data().astype('float32'))
-                                    for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[im_][0]).get_data().astype('float32'))]
-            else:
-                if self.prev_im_ == im_:
-                    s = self.prev_input_data
-                    l = self.prev_labels
-                else:
-                    s = [nib.load(
-                            self.input_data[im_][k]).get_data().astype('float32')
-                                    for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[im_][0]).get_data().astype('float32')]
-
-            if self.normalize: #Normalize image
-                s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
-
-            self.prev_input_data = s.copy()
-            self.prev_labels = l.copy()
-
-            # get current patches for both training data and labels
-            input_train = np.stack([s[m][:,:,center[2]][tuple(slice_)]
-                                    for m in range(self.num_modalities)], axis=0)
-            input_label = np.expand_dims(
-                l[0][:,:,center[2]][tuple(slice_)], axis=0)
-
-            # check dimensions and put zeros if necessary
-            if input_train.shape != self.input_train_dim:
-                print('error in patch', input_train.shape, self.input_train_dim)
-                input_train = np.zeros(self.input_train_dim).astype('float32')
-            if input_label.shape != self.input_label_dim:
-                print('error in label', input_label.shape, self.input_label_dim)
-                input_label = np.zeros(self.input_label_dim).astype('float32')
+            # get current patches for both training data and labels. 2D patches are (x, y, 1) windows of the volume
+            centers = np.array([self.patch_indexes[i][1] for i in group])
+            corners = centers - np.array(self.patch_half + (0,))
+            patch_size = tuple(self.patch_size[:2]) + (1,)
+            input_train = gather_patches(np.stack(s), corners, patch_size)[..., 0] # (patches, modalities, x, y)
+            input_label = gather_patches(l[0], corners, patch_size)[:, np.newaxis, :, :, 0]
 
             if self.transform:
-                input_train, input_label = self.transform([input_train,
-                                                        input_label])
-
-            self.prev_im_ = im_
+                for i_p in range(len(group)):
+                    input_train[i_p], input_label[i_p] = self.transform([input_train[i_p],
+                                                                        input_label[i_p]])
 
-            all_patches[idx,:-1, :, :] = input_train.astype('float32')
-            all_patches[idx,-1, :, :] = input_label.astype('float32')
+            all_patches[group[0]:group[-1]+1,:-1, :, :] = input_train
+            all_patches[group[0]:group[-1]+1,-1, :, :] = input_label[:, 0]
 
         return all_patches
     # def remove_percentage(self, percentage):
@@ -405,22 +342,16 @@ class PatchLoader2D(Dataset):
         for i in range(len(self.input_data)): # Process one image at a time
             #Padding
             if self.pad_or_not:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[i][k]).get_data().astype('float32'))
+                s = [load_volume(self.input_data[i][k], 'float32', self.patch_size)
                               for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32'))]
-                r = [self.apply_padding(nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32'))]
+                l = [load_volume(self.input_labels[i][0], 'float32', self.patch_size)]
+                r = [load_volume(self.input_rois[i][0], 'float32', self.patch_size)]
             #No pading
             else:
-                s = [nib.load(
-                        self.input_data[i][k]).get_data().astype('float32')
+                s = [load_volume(self.input_data[i][k], 'float32')
                               for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32')]
-                r = [nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32')]                
+                l = [load_volume(self.input_labels[i][0], 'float32')]
+                r = [load_volume(self.input_rois[i][0], 'float32')]                
 
 
             candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -513,7 +444,7 @@ def get_voxel_coordenates(input_data,
     - uniform: old way of selecting patches or new one (non-uniform)
 
     output:
-    - list of voxel coordenates
+    - (N, 3) np.array of voxel coordenates
     """
     if uniform:
         dims = [0,1,2] 
@@ -525,16 +456,10 @@ def get_voxel_coordenates(input_data,
         c_pad = np.random.randint(random_pad[1]+1) if random_pad[1] > 0 else 0
         #s_pad = np.random.randint(random_pad[2]+1) if random_pad[2] > 0 else 0
 
-        # precompute the sampling points for each axial slice
-        sampled_data = np.zeros_like(input_data) # Mask of centroids of patches
-        for i_slice in range(input_data.shape[2]):
-            for r in range(r_pad, input_data.shape[0], step_size[0]):
-                for c in range(c_pad, input_data.shape[1], step_size[1]):
-                        sampled_data[r, c, i_slice] = 1
-
-        # apply sampled points to roi and extract sample coordenates
-        # [x, y, z] = np.where(input_data * roi * sampled_data)
-        [x, y, z] = np.where(roi * sampled_data)
+        # the sampling points of each axial slice are a strided view of the roi (every slice is kept)
+        offset = np.array([r_pad, c_pad, 0])
+        step = np.array([step_size[0], step_size[1], 1])
+        sampled_roi = np.asarray(roi)[r_pad::step[0], c_pad::step[1], :]
 
         # prod = roi*sampled_data
         # nib_img = nib.Nifti1Image(prod.astype(np.uint8), np.eye(4))
@@ -542,8 +467,8 @@ def get_voxel_coordenates(input_data,
         # nib_brain = nib.Nifti1Image(brain.astype(np.uint8), np.eye(4))
         # nib.save(nib_brain, "brain_" + str(i) + ".nii.gz")
 
-        # return as a list of tuples
-        return [(x_, y_, z_) for x_, y_, z_ in zip(x, y, z)]
+        # return as an (N, 3) array of coordenates
+        return np.stack(np.nonzero(sampled_roi), axis=1)*step + offset
     else:
         pseudo_roi = input_data>0 #Brain mask approximation
         sampled_data = np.zeros_like(input_data)
@@ -554,8 +479,8 @@ def get_voxel_coordenates(input_data,
         chosen_neg = np.random.permutation(negatives)[:chosen_pos.shape[0],:]
         all_ = np.random.permutation(np.concatenate((chosen_pos, chosen_neg), axis=0))
 
-        # return as a list of tuples
-        return [(x_, y_, z_) for x_, y_, z_ in all_]
+        # return as an (N, 3) array of coordenates
+        return all_
 
 
 def normalize_data(im,
@@ -615,9 +540,9 @@ def get_inference_patches(scan_path, input_data, roi, patch_shape, step, normali
 
 
     # get candidate voxels
-    mask_image = nib.load(os.path.join(scan_path, roi))
+    mask_image = load_volume(os.path.join(scan_path, roi), None)
 
-    ref_mask, ref_voxels = get_candidate_voxels(mask_image.get_data(),
+    ref_mask, ref_voxels = get_candidate_voxels(mask_image,
                                                 step,
                                                 sel_method='all')
 
@@ -683,10 +608,7 @@ def get_input_patches(scan_path,
     get current patches for a given scan
     """
     # current_scan = nib.as_closest_canonical(nib.load(scan_path)).get_data()
-    current_scan = nib.load(scan_path).get_data()
-
-    if normalize:
-        current_scan = normalize_data(current_scan, norm_type = norm_type)
+    current_scan = load_volume(scan_path, None, normalize_function=normalize_data if normalize else None, norm_type=norm_type)
 
     patches, ref_voxels = extract_patches(current_scan,
                                           voxel_coords=ref_voxels,
@@ -751,30 +673,11 @@ def get_patches(input_data, centers, patch_size=(15, 15, 15)):
     # If the size has even numbers, the patch will be centered. If not,
     # it will try to create an square almost centered. By doing this we allow
     # pooling when using encoders/unets.
-    patches = []
-    list_of_tuples = all([isinstance(center, tuple) for center in centers])
-    sizes_match = [len(center) == len(patch_size) for center in centers]
-
-    if list_of_tuples and sizes_match:
-        # apply padding to the input image and re-compute the voxel coordenates
-        # according to the new dimension
-        padded_image = apply_padding(input_data, patch_size)
-        patch_half = tuple([idx // 2 for idx in patch_size])
-        new_centers = [map(add, center, patch_half) for center in centers[:-1]]
-        # compute patch locations
-
-        slice_locations = [elem[2] for elem in centers]
+    # apply padding to the input image (only x and y). After padding, the first voxel of each
+    # patch coincides with the original center coordenates. Patches are (x, y, 1) windows
+    padded_image = apply_padding(input_data, patch_size)
 
-        slices = [[slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                   for (c_idx, p_idx, s_idx) in zip(center,
-                                                    patch_half,
-                                                    patch_size)]
-                  for center in new_centers]
-
-        # extact patches
-        patches = [padded_image[:,:,slice_idx][tuple(idx)] for idx,slice_idx in zip(slices, slice_locations)]
-
-    return np.array(patches)
+    return gather_patches(padded_image, centers, tuple(patch_size[:2]) + (1,))[..., 0]
 
 
 def build_image(infer_patches, lesion_model, device, num_classes, options):
@@ -795,7 +698,7 @@ def build_image(infer_patches, lesion_model, device, num_classes, options):
 
 
 
-def reconstruct_image(input_data, centers, output_size):
+def reconstruct_image(input_data, centers, output_size, gaussian_sigma=None):
     """
     Reconstruct image based on several ovelapping patch samples
 
@@ -803,47 +706,23 @@ def reconstruct_image(input_data, centers, output_size):
     - input_data: a np.array list with patches
     - centers: center voxel coordenates for each patch
     - output_size: output image size (x,y,z)
+    - gaussian_sigma: optional Gaussian weighting of the patches (see patch_reconstruction.get_patch_weights)
 
     outputs:
     - reconstructed image
     """
 
-    # apply a padding around edges before writing the results
-    # recompute the voxel dimensions
-    patch_size = input_data[0, :].shape
-    out_image = apply_padding(np.zeros(output_size), patch_size)
-    patch_half = tuple([idx // 2 for idx in patch_size])
-    new_centers = [map(add, center, patch_half) for center in centers[:-1]]
-    # compute patch locations
-
-    slice_locations = [elem[2] for elem in centers]
-
-    slices = [[slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                for (c_idx, p_idx, s_idx) in zip(center,
-                                                patch_half,
-                                                patch_size)]
-                  for center in new_centers]
-
-    # for each patch, sum it to the output patch and
-    # then update the frequency matrix
-
-    freq_count = np.zeros_like(out_image)
+    # 2D patches are written as (px, py, 1) patches with the same engine used for 3D reconstruction
+    patch_size = input_data[0, :].shape + (1,)
+    padded_size = (output_size[0] + patch_size[0], output_size[1] + patch_size[1], output_size[2])
 
-
-    for patch, slide, sl in zip(input_data, slices, slice_locations):
-        out_image[:,:,sl][tuple(slide)] += patch
-        freq_count[:,:,sl][tuple(slide)] += np.ones(patch_size)
+    # after padding, the first voxel of each patch is its original center (in x and y)
+    corners = np.asarray(centers, dtype=np.int64).reshape(-1, 3)
+    out_image = overlap_add(input_data[:, np.newaxis, ..., np.newaxis], corners, padded_size,
+                            gaussian_sigma=gaussian_sigma)[0]
 
     # invert the padding applied for patch writing
-    out_image = invert_padding(out_image, patch_size)
-    freq_count = invert_padding(freq_count, patch_size)
-
-    # the reconstructed image is the mean of all the patches
-    #out_image /= freq_count
-    out_image[freq_count!=0] = out_image[freq_count!=0]/freq_count[freq_count!=0]
-    out_image[np.isnan(out_image)] = 0
-
-    return out_image
+    return invert_padding(out_image, patch_size[:2])
 
 
 def apply_padding(input_data, patch_size, mode='constant', value=0):
@@ -4,14 +4,18 @@ import numpy as np
 import torch
 import random 
 from scipy import ndimage
-import SimpleITK as sitk
 from os.path import join as jp
 from torch.utils.data import Dataset
-from operator import add 
-from ..general.general import list_folders, list_files_with_name_containing, get_dictionary_with_paths, save_image 
+from itertools import groupby
+from ..general.general import list_folders, list_files_with_name_containing, get_dictionary_with_paths, save_image, save_this, load_this
 from .transforms3D import RandomFlipX, RandomFlipY, RandomFlipZ, RandomRotationXY, RandomRotationXZ, RandomRotationYZ, ToTensor3DPatch
+from .volume_cache import VolumeCache, CachedVolumeLoader
+from .preprocessing_cache import load_volume, get_file_hash
+from .patch_extraction import pad_block, gather_patches
+from .patch_reconstruction import overlap_add
+from .intensity_normalization import get_quantile_table, match_quantile_table, load_matched_volume
 
-class PatchLoader3D(Dataset):
+class PatchLoader3D(CachedVolumeLoader, Dataset):
     """
     Dataset class for loading MRI patches from multiple modalities. Based on script utils.py provided by Sergi Valverde. 
 
@@ -30,7 +34,8 @@ class PatchLoader3D(Dataset):
                  min_sampling_th=0,
                  num_pos_samples=5000,
                  resample_epoch=False,
-                 transform=None):
+                 transform=None,
+                 cache_max_bytes=2*1024**3):
         """
         Arguments:
         - input_data: dict containing a list of inputs for each training scan
@@ -45,6 +50,7 @@ class PatchLoader3D(Dataset):
         - min_sampling_th: Minimum value to extract samples (0 default)
         - num_pos_samples used when hybrid sampling
         - transform
+        - cache_max_bytes: memory budget (bytes) of the LRU cache of padded and normalized volumes
         """
         self.input_data = list(input_data.values())
         self.input_labels = list(labels.values())
@@ -61,9 +67,8 @@ class PatchLoader3D(Dataset):
         self.resample_epoch = resample_epoch
         self.transform = transform
         self.num_pos_samples = num_pos_samples
-        self.prev_im_ = None
-        self.prev_input_data = None
-        self.prev_labels = None
+        self.volume_cache = VolumeCache(max_bytes=cache_max_bytes)
+        self.normalize_function = normalize_data # used by read_volume (see CachedVolumeLoader)
 
         #Check that number of images coincide 
         if not len(input_data) == len(labels) == len(rois):
@@ -99,33 +104,10 @@ class PatchLoader3D(Dataset):
                                                    self.patch_half,
                                                    self.patch_size)]
 
-        #Read images -> Super slow, reads image for every patch
-        if self.pad_or_not:
-            if self.prev_im_ == im_:
-                s = self.prev_input_data
-                l = self.prev_labels
-            else:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[im_][k]).get_data().astype('float32'))
-                                for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[im_][0]).get_data().astype('float32'))]
-        else:
-            if self.prev_im_ == im_:
-                s = self.prev_input_data
-                l = self.prev_labels
-            else:
-                s = [nib.load(
-                        self.input_data[im_][k]).get_data().astype('float32')
-                                for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[im_][0]).get_data().astype('float32')]
-
-        if self.normalize:
-            s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
-
-        self.prev_input_data = s.copy()
-        self.prev_labels = l.copy()
+        #Read images through the volume cache (only read from disk if not cached)
+        s = [self.read_volume(self.input_data[im_][k], (im_, 0, k), normalize=self.normalize)
+                        for k in range(self.num_modalities)]
+        l = [self.read_volume(self.input_labels[im_][0], (im_, 0, 'label'))]
 
         # get current patches for both training data and labels
         input_train = np.stack([s[m][tuple(slice_)]
@@ -145,8 +127,6 @@ class PatchLoader3D(Dataset):
             input_train, input_label = self.transform([input_train,
                                                        input_label])
 
-        self.prev_im_ = im_
-
         return input_train, input_label
             
 
@@ -179,22 +159,16 @@ class PatchLoader3D(Dataset):
         for i in range(len(self.input_data)): # Process one image at a time
             #Padding
             if self.pad_or_not:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[i][k]).get_data().astype('float32'))
+                s = [load_volume(self.input_data[i][k], 'float32', self.patch_size)
                               for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32'))]
-                r = [self.apply_padding(nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32'))]
+                l = [load_volume(self.input_labels[i][0], 'float32', self.patch_size)]
+                r = [load_volume(self.input_rois[i][0], 'float32', self.patch_size)]
             #No pading
             else:
-                s = [nib.load(
-                        self.input_data[i][k]).get_data().astype('float32')
+                s = [load_volume(self.input_data[i][k], 'float32')
                               for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[i][0]).get_data().astype('float32')]
-                r = [nib.load(
-                        self.input_rois[i][0]).get_data().astype('float32')]                
+                l = [load_volume(self.input_labels[i][0], 'float32')]
+                r = [load_volume(self.input_rois[i][0], 'float32')]                
 
 
             candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -355,9 +329,6 @@ class PatchLoader3DLoadAll(Dataset):
         self.resample_epoch = resample_epoch
         self.transform = transform
         self.num_pos_samples = num_pos_samples
-        self.prev_im_ = None
-        self.prev_input_data = None
-        self.prev_labels = None
 
         #Check that number of images coincide 
         if not len(input_data) == len(labels) == len(rois):
@@ -394,63 +365,30 @@ class PatchLoader3DLoadAll(Dataset):
 
         all_patches = np.zeros((len(self.patch_indexes), self.num_modalities, self.patch_size[0], self.patch_size[1], self.patch_size[2]), dtype='float32')
         all_labels = np.zeros((len(self.patch_indexes), len(list(self.input_labels.values())[0][0]), self.patch_size[0], self.patch_size[1], self.patch_size[2]), dtype='float32')
-        prev_pat = None
-        prev_tp = None
-        for idx in range(len(self.patch_indexes)):
-            print(idx, "/", len(self.patch_indexes))
-
-            im_ = self.patch_indexes[idx][0] # patient number
-            tp = self.patch_indexes[idx][1] #Timepoint
-            center = self.patch_indexes[idx][2] #Center of the patch
-
-            slice_ = [slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                    for (c_idx, p_idx, s_idx) in zip(center,
-                                                    self.patch_half,
-                                                    self.patch_size)]
-
-            #Read images only if different image index
-            if (prev_pat != im_ or prev_tp != tp):
-                if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            self.input_data[im_][tp][k]).get_data().astype('float32'))
-                                    for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[im_][tp][0]).get_data().astype('float32'))]
-                else:
-                    s = [nib.load(
-                            self.input_data[im_][tp][k]).get_data().astype('float32')
-                                    for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[im_][tp][0]).get_data().astype('float32')]
 
-                if self.normalize:
-                    s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
+        # Patches of the same image are consecutive, so all patches of an image are extracted at once
+        for (im_, tp), group in groupby(range(len(self.patch_indexes)), key=lambda i: self.patch_indexes[i][:2]):
+            group = list(group)
+            print(group[-1]+1, "/", len(self.patch_indexes))
 
-                prev_pat = im_
-                prev_tp = tp
+            # decoded, padded and normalized volumes are read through the preprocessing cache
+            padding = self.patch_size if self.pad_or_not else None
+            s = [load_volume(self.input_data[im_][tp][k], 'float32', padding, normalize_data if self.normalize else None, self.norm_type)
+                            for k in range(self.num_modalities)]
+            l = [load_volume(self.input_labels[im_][tp][0], 'float32', padding)]
 
             # get current patches for both training data and labels
-            input_train = np.stack([s[m][tuple(slice_)]
-                                    for m in range(self.num_modalities)], axis=0)
-            input_label = np.expand_dims(
-                l[0][tuple(slice_)], axis=0)
-
-            # check dimensions and put zeros if necessary
-            if input_train.shape != self.input_train_dim:
-                print('error in patch', input_train.shape, self.input_train_dim)
-                input_train = np.zeros(self.input_train_dim).astype('float32')
-            if input_label.shape != self.input_label_dim:
-                print('error in label', input_label.shape, self.input_label_dim)
-                input_label = np.zeros(self.input_label_dim).astype('float32')
+            corners = np.array([self.patch_indexes[i][2] for i in group]) - np.array(self.patch_half)
+            input_train = gather_patches(np.stack(s), corners, self.patch_size) # (patches, modalities, x, y, z)
+            input_label = gather_patches(l[0], corners, self.patch_size)[:, np.newaxis]
 
             if self.transform:
-                input_train, input_label = self.transform([input_train,
-                                                        input_label])
+                for i_p in range(len(group)):
+                    input_train[i_p], input_label[i_p] = self.transform([input_train[i_p],
+                                                                        input_label[i_p]])
 
-            #self.prev_im_ = im_
-
-            all_patches[idx, :, :, :, :] = input_train.astype('float32')
-            all_labels[idx, 0, :, :, :] = input_label.astype('float32')
+            all_patches[group[0]:group[-1]+1, :, :, :, :] = input_train
+            all_labels[group[0]:group[-1]+1, 0, :, :, :] = input_label[:, 0]
 
         return all_patches, all_labels
 
@@ -483,22 +421,16 @@ class PatchLoader3DLoadAll(Dataset):
                 #Padding
                 print(">>Analyzing patient", patient_number, ", timepoint", tp+1)
                 if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            timepoints_list[tp][k]).get_data().astype('float32')) #Take first timepoint as reference for the patches
+                    s = [load_volume(timepoints_list[tp][k], 'float32', self.patch_size) #Take first timepoint as reference for the patches
                                 for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[patient_number][tp][0]).get_data().astype('float32'))] #Take GT of last timepoint
-                    r = [self.apply_padding(nib.load(
-                            self.input_rois[patient_number][tp][0]).get_data().astype('float32'))] #Take last brain mask 
+                    l = [load_volume(self.input_labels[patient_number][tp][0], 'float32', self.patch_size)] #Take GT of last timepoint
+                    r = [load_volume(self.input_rois[patient_number][tp][0], 'float32', self.patch_size)] #Take last brain mask 
                 #No pading
                 else:
-                    s = [nib.load(
-                            timepoints_list[tp][k]).get_data().astype('float32')
+                    s = [load_volume(timepoints_list[tp][k], 'float32')
                                 for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[patient_number][tp][0]).get_data().astype('float32')]
-                    r = [nib.load(
-                            self.input_rois[patient_number][tp][0]).get_data().astype('float32')]              
+                    l = [load_volume(self.input_labels[patient_number][tp][0], 'float32')]
+                    r = [load_volume(self.input_rois[patient_number][tp][0], 'float32')]              
 
 
                 candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -608,7 +540,7 @@ class PatchLoader3DLoadAll(Dataset):
         return sampled_mask
 
 
-class PatchLoader3DTime(Dataset):
+class PatchLoader3DTime(CachedVolumeLoader, Dataset):
     """
     Dataset class for loading MRI patches from multiple modalities. Based on script utils.py provided by Sergi Valverde. 
     Difference with respect to PatchLoader3DTime: Timepoints are sliced so that more patches can be taken
@@ -629,7 +561,8 @@ class PatchLoader3DTime(Dataset):
                  num_pos_samples=5000,
                  resample_epoch=False,
                  transform=None,
-                 num_timepoints = 4):
+                 num_timepoints = 4,
+                 cache_max_bytes=2*1024**3):
         """
         Arguments:
         - input_data: dict containing a list of inputs for each training scan
@@ -644,6 +577,8 @@ class PatchLoader3DTime(Dataset):
         - min_sampling_th: Minimum value to extract samples (0 default)
         - num_pos_samples used when hybrid sampling
         - transform
+        - num_timepoints: number of consecutive timepoints per sample
+        - cache_max_bytes: memory budget (bytes) of the LRU cache of padded and normalized volumes
         """
         self.input_data = input_data
         self.input_labels = labels
@@ -660,10 +595,9 @@ class PatchLoader3DTime(Dataset):
         self.resample_epoch = resample_epoch
         self.transform = transform
         self.num_pos_samples = num_pos_samples
-        self.prev_im_ = None
-        self.prev_input_data = None
-        self.prev_labels = None
         self.num_timepoints = num_timepoints
+        self.volume_cache = VolumeCache(max_bytes=cache_max_bytes)
+        self.normalize_function = normalize_data # used by read_volume (see CachedVolumeLoader)
 
         #Check that number of images coincide 
         if not len(input_data) == len(labels) == len(rois):
@@ -704,22 +638,10 @@ class PatchLoader3DTime(Dataset):
         output_label = np.zeros(self.input_label_dim, dtype = 'float32') #Array to store output labels
         ind = 0
         for i_t in slice_indexes: #For each timepoint
-            #Read images -> Super slow, reads image for every patch
-            if self.pad_or_not:
-                s = [self.apply_padding(nib.load(
-                        self.input_data[im_][i_t][k]).get_data().astype('float32'))
-                                for k in range(self.num_modalities)]
-                l = [self.apply_padding(nib.load(
-                        self.input_labels[im_][i_t][0]).get_data().astype('float32'))]
-            else:
-                s = [nib.load(
-                        self.input_data[im_][i_t][k]).get_data().astype('float32')
-                                for k in range(self.num_modalities)]
-                l = [nib.load(
-                        self.input_labels[im_][i_t][0]).get_data().astype('float32')]
-
-            if self.normalize:
-                s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
+            #Read images through the volume cache (only read from disk if not cached)
+            s = [self.read_volume(self.input_data[im_][i_t][k], (im_, i_t, k), normalize=self.normalize)
+                            for k in range(self.num_modalities)]
+            l = [self.read_volume(self.input_labels[im_][i_t][0], (im_, i_t, 'label'))]
 
 
             # get current patches for both training data and labels
@@ -783,22 +705,16 @@ class PatchLoader3DTime(Dataset):
             for i in range(len(timepoints_list) - self.num_timepoints + 1):
                 #Padding
                 if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            timepoints_list[i][k]).get_data().astype('float32')) #Take first timepoint as reference for the patches
+                    s = [load_volume(timepoints_list[i][k], 'float32', self.patch_size) #Take first timepoint as reference for the patches
                                 for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[patient_number][i][0]).get_data().astype('float32'))] #Take GT of last timepoint
-                    r = [self.apply_padding(nib.load(
-                            self.input_rois[patient_number][i][0]).get_data().astype('float32'))] #Take last brain mask 
+                    l = [load_volume(self.input_labels[patient_number][i][0], 'float32', self.patch_size)] #Take GT of last timepoint
+                    r = [load_volume(self.input_rois[patient_number][i][0], 'float32', self.patch_size)] #Take last brain mask 
                 #No pading
                 else:
-                    s = [nib.load(
-                            timepoints_list[i][k]).get_data().astype('float32')
+                    s = [load_volume(timepoints_list[i][k], 'float32')
                                 for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[patient_number][i][0]).get_data().astype('float32')]
-                    r = [nib.load(
-                            self.input_rois[patient_number][i][0]).get_data().astype('float32')]                
+                    l = [load_volume(self.input_labels[patient_number][i][0], 'float32')]
+                    r = [load_volume(self.input_rois[patient_number][i][0], 'float32')]                
 
 
                 candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -932,7 +848,8 @@ class PatchLoader3DTimeLoadAll(Dataset):
                  transform=None,
                  num_timepoints = 4,
                  labels_mode = 'mask',
-                 histogram_matching = False): # 'mask' 'center' or 'lesion_patch'
+                 histogram_matching = False,
+                 patch_store = None): # 'mask' 'center' or 'lesion_patch'
         """
         Arguments:
         - input_data: dict containing a list of inputs for each training scan
@@ -951,6 +868,11 @@ class PatchLoader3DTimeLoadAll(Dataset):
         - labels_mode: Type of label for the patches. If 'mask', the whole mask of the patch is returned
                         if 'center', only the value of the center pixel is returned as label. If 'lesion_patch'
                         then a label is returned which indicates whether or not the patch contains a lesion voxel.
+        - histogram_matching: Match histograms of all timepoints to the first timepoint of the patient, as in inference
+                        (see read_input_block). Matched volumes are memoized (see intensity_normalization.load_matched_volume)
+        - patch_store: Folder where patches are stored as .npy files. If given, patches are written once and read back
+                        as read-only memory maps. The store is reused if it was built with the same configuration and
+                        the same file contents. Not compatible with transform (transformed patches would be stored)
         """
         self.input_data = input_data
         self.input_labels = labels
@@ -967,31 +889,39 @@ class PatchLoader3DTimeLoadAll(Dataset):
         self.resample_epoch = resample_epoch
         self.transform = transform
         self.num_pos_samples = num_pos_samples
-        self.prev_im_ = None
-        self.prev_input_data = None
-        self.prev_labels = None
         self.num_timepoints = num_timepoints
         self.labels_mode = labels_mode #To decide what the GT of the patches is: "mask", "lesion_patch" (if patch contains lesion), or "TODO"
         self.histogram_matching = histogram_matching
+        self.patch_store = patch_store
 
         #Check that number of images coincide 
         if not len(input_data) == len(labels) == len(rois):
             raise ValueError("Number of input samples, input labels and input rois does not coincide")
+        if self.patch_store is not None and self.transform is not None:
+            raise ValueError("patch_store cannot be used with transform (transformed patches would be stored and reused)")
 
         self.num_modalities = len(list(input_data.values())[0][0])
         self.input_train_dim = (self.num_timepoints, self.num_modalities, ) + self.patch_size
         self.input_label_dim = (self.num_timepoints, 1, ) + self.patch_size
 
-        self.patch_indexes = self.generate_patch_indexes()
-        self.all_patches, self.all_labels = self.load_all_patches()
+        if self.patch_store is not None and self.patch_store_is_valid():
+            print("Reading patches from store", self.patch_store)
+            if self.sampling_type in ['balanced', 'balanced+roi', 'hybrid'] or any(self.random_pad):
+                print("Warning: patch sampling is random, the patches drawn when the store was built are reused")
+            self.patch_indexes = load_this(self.patch_store, "patch_store_info")["patch_indexes"]
+            self.all_patches, self.all_labels = self.open_patch_store()
+        else:
+            self.patch_indexes = self.generate_patch_indexes()
+            self.all_patches, self.all_labels = self.load_all_patches()
+        self.sample_indexes = np.arange(len(self.all_patches)) # Samples that are used (all, unless data is balanced)
         if self.labels_mode == 'lesion_patch':
-            self.all_patches, self.all_labels = self.balance_data()
+            self.sample_indexes = self.balance_data()
 
     def __len__(self):
         """
         Get the legnth of the training set
         """
-        return len(self.all_patches)
+        return len(self.sample_indexes)
 
     def __getitem__(self, idx):
         """
@@ -1000,9 +930,14 @@ class PatchLoader3DTimeLoadAll(Dataset):
         """
 
         if idx == 0 and self.resample_epoch:
+            self.all_patches, self.all_labels = None, None # Release memory maps before rewriting the store
             self.patch_indexes = self.generate_patch_indexes()
             self.all_patches, self.all_labels = self.load_all_patches()
-        
+            self.sample_indexes = np.arange(len(self.all_patches))
+            if self.labels_mode == 'lesion_patch':
+                self.sample_indexes = self.balance_data()
+
+        idx = self.sample_indexes[idx]
         patches = self.all_patches[idx, :, :, :, :, :]
         if self.labels_mode == 'lesion_patch':
             labels = self.all_labels[idx]
@@ -1017,117 +952,134 @@ class PatchLoader3DTimeLoadAll(Dataset):
                 patches, labels = self.transform((patches, labels))
 
         return patches, labels
+
+    def init_worker(self, worker_id, num_workers):
+        """
+        Called in every DataLoader worker (see sampling.worker_init_fn). Resampling would only happen in the worker that
+        gets index 0, and with a patch store it would rewrite the files that the other workers have memory-mapped
+        """
+        if self.resample_epoch:
+            raise ValueError("resample_epoch is not supported with num_workers > 0 (patches would only be resampled in one worker)")
             
 
     def balance_data(self):
+        """
+        Return the indexes of the samples to be used so that the number of negative and positive patches is the same
+        """
         num_samples = len(self.all_labels)
         num_pos = np.count_nonzero(self.all_labels)
         num_neg = num_samples - num_pos
-        negative_indexes = np.where(self.all_labels == 0)[0]
+        negative_indexes = np.where(np.asarray(self.all_labels) == 0)[0]
         random.shuffle(negative_indexes) #Shuffle samples
         negative_indexes_to_remove = negative_indexes[:num_neg-num_pos] # Remove first num_neg-num_pos elements
-        return np.delete(self.all_patches, negative_indexes_to_remove, 0), np.delete(self.all_labels, negative_indexes_to_remove, 0)
-        
+        return np.delete(np.arange(num_samples), negative_indexes_to_remove)
+
+    def get_store_config(self):
+        """
+        Parameters that determine the content of the patch store
+        """
+        return {"input_data": self.input_data,
+                "labels": self.input_labels,
+                "rois": self.input_rois,
+                "patch_size": self.patch_size,
+                "sampling_step": self.sampling_step,
+                "sampling_type": self.sampling_type,
+                "random_pad": self.random_pad,
+                "normalize": self.normalize,
+                "norm_type": self.norm_type,
+                "num_timepoints": self.num_timepoints,
+                "labels_mode": self.labels_mode,
+                "histogram_matching": "quantiles_first_timepoint" if self.histogram_matching else False,
+                "file_hashes": self.get_file_hashes()}
+
+    def get_file_hashes(self):
+        """
+        Hash of the content of every input, label and roi file (see preprocessing_cache.get_file_hash)
+        """
+        return {path: get_file_hash(path) for data in [self.input_data, self.input_labels, self.input_rois]
+                                            for timepoints in data.values() for paths in timepoints for path in paths}
+
+    def patch_store_is_valid(self):
+        """
+        Check whether the patch store exists and was built with the current configuration
+        """
+        if not all(os.path.exists(jp(self.patch_store, f)) for f in ["patch_store_info.pkl", "patches.npy", "labels.npy"]):
+            return False
+        return load_this(self.patch_store, "patch_store_info")["config"] == self.get_store_config()
+
+    def open_patch_store(self):
+        """
+        Open patches and labels of the store as read-only memory maps
+        """
+        return np.load(jp(self.patch_store, "patches.npy"), mmap_mode='r'), np.load(jp(self.patch_store, "labels.npy"), mmap_mode='r')
+
+    def allocate(self, name, shape, dtype):
+        """
+        Allocate an output array, either in RAM or as a writable memory map in the patch store
+        """
+        if self.patch_store is None:
+            return np.zeros(shape, dtype=dtype)
+        if not os.path.exists(self.patch_store):
+            os.makedirs(self.patch_store)
+        return np.lib.format.open_memmap(jp(self.patch_store, name + ".npy"), mode='w+', dtype=dtype, shape=shape)
 
     def load_all_patches(self):
 
-        all_patches = np.zeros((len(self.patch_indexes), self.num_timepoints, self.num_modalities, self.patch_size[0], self.patch_size[1], self.patch_size[2]), dtype='float32')
-        if self.labels_mode == 'lesion_patch':
-            output_labels = np.zeros((len(self.patch_indexes), ), dtype = np.uint8)
+        if self.patch_store is not None and os.path.exists(jp(self.patch_store, "patch_store_info.pkl")):
+            os.remove(jp(self.patch_store, "patch_store_info.pkl")) # Invalidate store while it is being rewritten
 
-        all_labels = np.zeros((len(self.patch_indexes), 1, self.patch_size[0],self.patch_size[1],self.patch_size[2]), dtype=np.uint8)
+        all_patches = self.allocate("patches", (len(self.patch_indexes), self.num_timepoints, self.num_modalities, self.patch_size[0], self.patch_size[1], self.patch_size[2]), 'float32')
+        if self.labels_mode == 'lesion_patch':
+            # only one flag per patch is kept, label patches are reduced group by group
+            all_labels = self.allocate("labels", (len(self.patch_indexes), ), np.uint8)
+        else:
+            all_labels = self.allocate("labels", (len(self.patch_indexes), 1, self.patch_size[0],self.patch_size[1],self.patch_size[2]), np.uint8)
         
-        all_s = [] #To store images from all x timepoints required
-        all_l = []
-        prev_im_ = None
-        prev_slice_indexes = None
-
-        for idx in range(len(self.patch_indexes)):
-            print(idx+1, "/", len(self.patch_indexes))
-            im_ = self.patch_indexes[idx][0] #Patient
-            slice_indexes = self.patch_indexes[idx][1] #Time slices
-            center = self.patch_indexes[idx][2] #Center of the patch
-
-            slice_ = [slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                    for (c_idx, p_idx, s_idx) in zip(center,
-                                                    self.patch_half,
-                                                    self.patch_size)]
-
-            output_patch = np.zeros(self.input_train_dim, dtype = 'float32') #Array to store output patches
-            output_label = np.zeros(self.input_label_dim, dtype = np.uint8) #Array to store output labels
-            ind = 0
-
-            #Condition to load new images only if they are different as compared to those for previous idx
-            if prev_im_ != im_ or prev_slice_indexes != slice_indexes: # If image or timepoints change
-                all_s = []
-                all_l = []
-
-                for i_t in slice_indexes: #For each timepoint
-                    #Read images -> Super slow, reads image for every patch
-
-                    if self.pad_or_not:
-                        all_s.append([self.apply_padding(nib.load(
-                                self.input_data[im_][i_t][k]).get_data().astype('float32'))
-                                        for k in range(self.num_modalities)])
-                        all_l.append([self.apply_padding(nib.load(
-                                self.input_labels[im_][i_t][0]).get_data().astype(np.uint8))])
-                    else:
-                        all_s.append([nib.load(
-                                self.input_data[im_][i_t][k]).get_data().astype('float32')
-                                        for k in range(self.num_modalities)])
-                        all_l.append([nib.load(
-                                self.input_labels[im_][i_t][0]).get_data().astype(np.uint8)])
-
-                if self.normalize:
-                    #Apply intensity normalization
-                    for i_tp in range(len(all_s)):
-                        all_s[i_tp] = [normalize_data(all_s[i_tp][m], norm_type = self.norm_type) for m in range(len(all_s[i_tp]))]
-
-                    #Apply histogram matching
-                    if self.histogram_matching:
-                        for i_mod in range(len(all_s[0])): # for all modalities
-                            img_ref = all_s[0][i_mod] # take first timepoint as reference
-                            for i_tp in range(1, len(all_s)): #for every timepoint (except the one used as ref)
-                                all_s[i_tp][i_mod] = match_histograms(all_s[i_tp][i_mod], img_ref) # target, ref
-                        
-                prev_im_ = im_
-                prev_slice_indexes = slice_indexes
-
-            for i_t in range(len(all_s)):    
-
-                # get current patches for both training data and labels
-                input_train = np.stack([all_s[i_t][m][tuple(slice_)]
-                                        for m in range(self.num_modalities)], axis=0)
-                input_label = np.expand_dims(
-                    all_l[i_t][0][tuple(slice_)], axis=0)
-
-                # check dimensions and put zeros if necessary
-                if (self.num_timepoints,)+input_train.shape != self.input_train_dim:
-                    print('error in patch', input_train.shape, self.input_train_dim)
-                    input_train = np.zeros(self.input_train_dim).astype('float32')
-                if (self.num_timepoints,)+input_label.shape != self.input_label_dim:
-                    print('error in label', input_label.shape, self.input_label_dim)
-                    input_label = np.zeros(self.input_label_dim).astype(np.uint8)
-
-                if self.transform:
-                    input_train, input_label = self.transform([input_train,
-                                                            input_label])
-
-
-
-                output_patch[ind,:,:,:,:] = input_train 
-                output_label[ind,:,:,:,:] = input_label
-
-                ind+=1
-
-            all_patches[idx,:,:,:,:,:] = output_patch 
-            all_labels[idx,0,:,:,:] = output_label[1,0,:,:,:] # TIMEPOINT IN THE MIDDLE
+        # Patches of the same patient and timepoints are consecutive, so all patches of a group are extracted at once
+        for (im_, slice_indexes), group in groupby(range(len(self.patch_indexes)), key=lambda i: self.patch_indexes[i][:2]):
+            group = list(group)
+            print(group[-1]+1, "/", len(self.patch_indexes))
+
+            all_s = [] #To store images from all x timepoints required
+            all_l = []
+            # decoded, padded and normalized volumes are read through the preprocessing cache
+            padding = self.patch_size if self.pad_or_not else None
+            for i_t in slice_indexes: #For each timepoint
+                if self.normalize and self.histogram_matching:
+                    # histogram matching: take first timepoint of the patient as reference, as in inference (read_input_block)
+                    all_s.append([load_matched_volume(self.input_data[im_][i_t][k], self.input_data[im_][0][k], 'float32', padding, self.norm_type)
+                                    for k in range(self.num_modalities)])
+                else:
+                    all_s.append([load_volume(self.input_data[im_][i_t][k], 'float32', padding, normalize_data if self.normalize else None, self.norm_type)
+                                    for k in range(self.num_modalities)])
+                all_l.append([load_volume(self.input_labels[im_][i_t][0], np.uint8, padding)])
 
+            # get current patches for both training data and labels from (timepoints, modalities, x, y, z) blocks
+            corners = np.array([self.patch_indexes[i][2] for i in group]) - np.array(self.patch_half)
+            input_train = gather_patches(np.stack([np.stack(s_tp) for s_tp in all_s]), corners, self.patch_size)
+            input_label = gather_patches(np.stack([l_tp[0] for l_tp in all_l]), corners, self.patch_size)[:, :, np.newaxis]
+            del all_s, all_l
+
+            if self.transform:
+                for i_p in range(len(group)):
+                    for i_t in range(self.num_timepoints):
+                        input_train[i_p, i_t], input_label[i_p, i_t] = self.transform([input_train[i_p, i_t],
+                                                                                      input_label[i_p, i_t]])
+
+            all_patches[group[0]:group[-1]+1,:,:,:,:,:] = input_train
             if self.labels_mode == 'lesion_patch':
-                output_labels[idx] = int(np.any(all_labels[idx,-1,:,:,:]>0)) #If patch contains any positive voxel, return 1
-        
-        if self.labels_mode == 'lesion_patch':
-            return all_patches, output_labels        
+                all_labels[group[0]:group[-1]+1] = np.any(input_label[:,1,0,:,:,:]>0, axis=(1,2,3)) #If patch contains any positive voxel (TIMEPOINT IN THE MIDDLE), return 1
+            else:
+                all_labels[group[0]:group[-1]+1,0,:,:,:] = input_label[:,1,0,:,:,:] # TIMEPOINT IN THE MIDDLE
+
+        if self.patch_store is not None:
+            # Write store to disk and reopen it read-only
+            all_patches.flush()
+            all_labels.flush()
+            del all_patches, all_labels
+            save_this({"config": self.get_store_config(), "patch_indexes": self.patch_indexes}, self.patch_store, "patch_store_info")
+            return self.open_patch_store()
+
         return all_patches, all_labels
 
     def apply_padding(self, input_data, mode='constant', value=0):
@@ -1163,22 +1115,16 @@ class PatchLoader3DTimeLoadAll(Dataset):
             for i in range(len(timepoints_list) - self.num_timepoints + 1):
                 #Padding
                 if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            timepoints_list[i][k]).get_data().astype('float32')) #Take first timepoint as reference for the patches
+                    s = [load_volume(timepoints_list[i][k], 'float32', self.patch_size) #Take first timepoint as reference for the patches
                                 for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[patient_number][i][0]).get_data().astype('float32'))] #Take GT of last timepoint
-                    r = [self.apply_padding(nib.load(
-                            self.input_rois[patient_number][i][0]).get_data().astype('float32'))] #Take last brain mask 
+                    l = [load_volume(self.input_labels[patient_number][i][0], 'float32', self.patch_size)] #Take GT of last timepoint
+                    r = [load_volume(self.input_rois[patient_number][i][0], 'float32', self.patch_size)] #Take last brain mask 
                 #No pading
                 else:
-                    s = [nib.load(
-                            timepoints_list[i][k]).get_data().astype('float32')
+                    s = [load_volume(timepoints_list[i][k], 'float32')
                                 for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[patient_number][i][0]).get_data().astype('float32')]
-                    r = [nib.load(
-                            self.input_rois[patient_number][i][0]).get_data().astype('float32')]                
+                    l = [load_volume(self.input_labels[patient_number][i][0], 'float32')]
+                    r = [load_volume(self.input_rois[patient_number][i][0], 'float32')]                
 
 
                 candidate_voxels = self.get_candidate_voxels(s[0], l[0], r[0]) #FLAIR, labels, brain mask
@@ -1343,7 +1289,7 @@ def get_voxel_coordenates(input_data,
     - random_pad: initial random padding applied to indexes
 
     output:
-    - list of voxel coordenates
+    - (N, 3) np.array of voxel coordenates
     """
 
     # compute initial padding
@@ -1351,19 +1297,14 @@ def get_voxel_coordenates(input_data,
     c_pad = np.random.randint(random_pad[1]+1) if random_pad[1] > 0 else 0
     s_pad = np.random.randint(random_pad[2]+1) if random_pad[2] > 0 else 0
 
-    # precompute the sampling points based on the input
-    sampled_data = np.zeros_like(input_data)
-    for r in range(r_pad, input_data.shape[0], step_size[0]):
-        for c in range(c_pad, input_data.shape[1], step_size[1]):
-            for s in range(s_pad, input_data.shape[2], step_size[2]):
-                sampled_data[r, c, s] = 1
-
-    # apply sampled points to roi and extract sample coordenates
-    # [x, y, z] = np.where(input_data * roi * sampled_data)
-    [x, y, z] = np.where(roi * sampled_data)
+    # the sampling grid is a strided view of the roi: only the grid points are checked
+    # and their indexes are mapped back to volume coordenates
+    offset = np.array([r_pad, c_pad, s_pad])
+    step = np.array(step_size[:3])
+    sampled_roi = np.asarray(roi)[r_pad::step[0], c_pad::step[1], s_pad::step[2]]
 
-    # return as a list of tuples
-    return [(x_, y_, z_) for x_, y_, z_ in zip(x, y, z)]
+    # return as an (N, 3) array of coordenates
+    return np.stack(np.nonzero(sampled_roi), axis=1)*step + offset
 
 
 def get_patches(input_data, centers, patch_size=(15, 15, 15)):
@@ -1381,30 +1322,13 @@ def get_patches(input_data, centers, patch_size=(15, 15, 15)):
     # If the size has even numbers, the patch will be centered. If not,
     # it will try to create an square almost centered. By doing this we allow
     # pooling when using encoders/unets.
-    patches = []
-    list_of_tuples = all([isinstance(center, tuple) for center in centers])
-    sizes_match = [len(center) == len(patch_size) for center in centers]
-
-    if list_of_tuples and sizes_match:
-        # apply padding to the input image and re-compute the voxel coordenates
-        # according to the new dimension
-        padded_image = apply_padding(input_data, patch_size)
-        patch_half = tuple([idx // 2 for idx in patch_size])
-        new_centers = [map(add, center, patch_half) for center in centers]
-        # compute patch locations
-        slices = [[slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                   for (c_idx, p_idx, s_idx) in zip(center,
-                                                    patch_half,
-                                                    patch_size)]
-                  for center in new_centers]
-
-        # extact patches
-        patches = [padded_image[tuple(idx)] for idx in slices]
-
-    return np.array(patches)
-
-
-def reconstruct_image(input_data, centers, output_size):
+    # After padding, the first voxel of each patch coincides with the original center coordenates
+    padded_image = apply_padding(input_data, patch_size)
+
+    return gather_patches(padded_image, centers, patch_size)
+
+
+def reconstruct_image(input_data, centers, output_size, gaussian_sigma=None):
     """
     Reconstruct image based on several ovelapping patch samples
 
@@ -1412,42 +1336,38 @@ def reconstruct_image(input_data, centers, output_size):
     - input_data: a np.array list with patches
     - centers: center voxel coordenates for each patch
     - output_size: output image size (x,y,z)
+    - gaussian_sigma: optional Gaussian weighting of the patches (sigma relative to the patch size)
 
     outputs:
     - reconstructed image
     """
+    return reconstruct_image_multiclass(input_data[:, np.newaxis], centers, output_size, gaussian_sigma=gaussian_sigma)[..., 0]
 
-    # apply a padding around edges before writing the results
-    # recompute the voxel dimensions
-    patch_size = input_data[0, :].shape
-    out_image = apply_padding(np.zeros(output_size), patch_size)
-    patch_half = tuple([idx // 2 for idx in patch_size])
-    new_centers = [map(add, center, patch_half) for center in centers]
-    # compute patch locations
-    slices = [[slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-               for (c_idx, p_idx, s_idx) in zip(center,
-                                                patch_half,
-                                                patch_size)]
-              for center in new_centers]
 
-    # for each patch, sum it to the output patch and
-    # then update the frequency matrix
+def reconstruct_image_multiclass(input_data, centers, output_size, gaussian_sigma=None):
+    """
+    Reconstruct the image of every class in a single pass over the overlapping patches
 
-    freq_count = np.zeros_like(out_image)
+    inputs:
+    - input_data: np.array (patches, classes, x, y, z), e.g. the output of build_image
+    - centers: center voxel coordenates for each patch
+    - output_size: output image size (x,y,z)
+    - gaussian_sigma: optional Gaussian weighting of the patches (sigma relative to the patch size)
 
-    for patch, slide in zip(input_data, slices):
-        out_image[tuple(slide)] += patch
-        freq_count[tuple(slide)] += np.ones(patch_size)
+    outputs:
+    - reconstructed probabilities (x, y, z, classes)
+    """
+    # apply a padding around edges before writing the results. After padding,
+    # the first voxel of each patch coincides with the original center coordenates
+    patch_size = input_data.shape[2:]
+    padded_size = tuple(o + p for o, p in zip(output_size, patch_size))
+    out_image = overlap_add(input_data, centers, padded_size, gaussian_sigma=gaussian_sigma)
 
     # invert the padding applied for patch writing
-    out_image = invert_padding(out_image, patch_size)
-    freq_count = invert_padding(freq_count, patch_size)
-
-    # the reconstructed image is the mean of all the patches
-    out_image[freq_count!=0] = out_image[freq_count!=0]/freq_count[freq_count!=0]
-    out_image[np.isnan(out_image)] = 0
+    patch_half = tuple([idx // 2 for idx in patch_size])
+    out_image = out_image[(slice(None),) + tuple(slice(h, h+o) for h, o in zip(patch_half, output_size))]
 
-    return out_image
+    return np.moveaxis(out_image, 0, -1)
 
 
 def apply_padding(input_data, patch_size, mode='constant', value=0):
@@ -1523,15 +1443,25 @@ def normalize_data(im,
     return im
 
 
-def match_histograms(target, ref):
-    # Matches histogram of <target> to histogram of <ref> using SimpleITK
-    target_itk = sitk.GetImageFromArray(target)
-    ref_itk = sitk.GetImageFromArray(ref)
-    hist_matcher = sitk.HistogramMatchingImageFilter()
-    matched = hist_matcher.Execute(target_itk, ref_itk)
-    return sitk.GetArrayFromImage(matched)
+def match_histograms(target, ref, ref_table=None, target_table=None, num_quantiles=1024, threshold=0):
+    """
+    Matches histogram of <target> to histogram of <ref> with quantile tables (see intensity_normalization)
 
-def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, normalize=True, norm_type = "zero_one", mode = "cs", num_timepoints = None):
+    inputs:
+    - target: volume to modify
+    - ref: reference volume. Not used if ref_table is given
+    - ref_table, target_table: precomputed quantile tables (see get_quantile_table). Computed if None
+    - num_quantiles: size of the quantile tables
+    - threshold: voxels <= threshold (background) are ignored and keep their value
+
+    outputs:
+    - matched volume (float32)
+    """
+    if ref_table is None:
+        ref_table = get_quantile_table(ref, num_quantiles, threshold)
+    return match_quantile_table(target, ref_table, target_table, threshold)
+
+def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, normalize=True, norm_type = "zero_one", mode = "cs", num_timepoints = None, histogram_matching = False):
     """
     Get patches for inference
 
@@ -1544,6 +1474,8 @@ def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, n
     - normalize = zero mean normalization
     - norm_type: Type of normalization to be applied
     - mode: cross-sectional (cs) or longitudinal (l)
+    - histogram_matching: (l mode, with normalize) match histograms of all timepoints to the first timepoint of the case, with the
+                          memoized volumes used by PatchLoader3DTimeLoadAll (see intensity_normalization.load_matched_volume)
 
     outputs:
     - test patches (samples, channels, x, y, z)
@@ -1558,9 +1490,9 @@ def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, n
         output_patches = []
         all_ref_voxels = []
         for tp in range(len(timepoints)):
-            mask_image = nib.load(os.path.join(scan_path, timepoints[tp], roi))
+            mask_image = load_volume(os.path.join(scan_path, timepoints[tp], roi), None)
 
-            _, ref_voxels = get_candidate_voxels(mask_image.get_data(),
+            _, ref_voxels = get_candidate_voxels(mask_image,
                                                         step,
                                                         sel_method='all')
             all_ref_voxels.append(ref_voxels)
@@ -1581,9 +1513,9 @@ def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, n
         list_rois = get_dictionary_with_paths([case], path_test, roi)
 
         brain_mask = list_rois[case][num_timepoints-1][0]   #ROI of last timepoint chosen
-        mask_image = nib.load(os.path.join(scan_path, brain_mask))
+        mask_image = load_volume(os.path.join(scan_path, brain_mask), None)
 
-        _, ref_voxels = get_candidate_voxels(mask_image.get_data(),
+        _, ref_voxels = get_candidate_voxels(mask_image,
                                                     step,
                                                     sel_method='all')
 
@@ -1595,7 +1527,8 @@ def get_inference_patches(path_test, case, input_data, roi, patch_shape, step, n
                                         patch_shape,
                                         step,
                                         normalize=normalize,
-                                        norm_type = norm_type)
+                                        norm_type = norm_type,
+                                        histogram_matching = histogram_matching)
         return test_patches, ref_voxels
 
     else:
@@ -1609,25 +1542,19 @@ def get_data_channels_time( list_images,
                             patch_shape,
                             step,
                             normalize=False,
-                            norm_type = "zero_one"):
+                            norm_type = "zero_one",
+                            histogram_matching = False):
     """
-    Get data for each of the channels
+    Get data for each of the channels and timepoints. All patches are extracted at once
+    from a (timepoints, modalities, x, y, z) block
+
+    outputs:
+    - patches (samples, timepoints, modalities, x, y, z)
     """
-    super_out_patches = []
-    for i in range(len(list_images[case])):
-        out_patches = []
-        for s in list_images[case][i]:
-            current_scan = s
-            patches, _ = get_input_patches(current_scan,
-                                        ref_voxels,
-                                        patch_shape,
-                                        step,
-                                        normalize=normalize,
-                                        norm_type = norm_type)
-            out_patches.append(np.expand_dims(patches, axis = 1 ))
+    block = read_input_block(list_images[case], normalize=normalize, norm_type=norm_type, histogram_matching=histogram_matching,
+                             patch_size=patch_shape)
 
-        super_out_patches.append(np.concatenate(out_patches, axis=2))
-    return np.concatenate(super_out_patches, axis=1)
+    return gather_patches(block, ref_voxels, patch_shape)
 
 
 def get_data_channels(image_path,
@@ -1638,20 +1565,37 @@ def get_data_channels(image_path,
                       normalize=False,
                       norm_type = "zero_one"):
     """
-    Get data for each of the channels
+    Get data for each of the channels. All patches are extracted at once from a (modalities, x, y, z) block
+
+    outputs:
+    - patches (samples, modalities, x, y, z)
     """
-    out_patches = []
-    for s in scan_names:
-        current_scan = os.path.join(image_path, s)
-        patches, _ = get_input_patches(current_scan,
-                                       ref_voxels,
-                                       patch_shape,
-                                       step,
-                                       normalize=normalize,
-                                       norm_type = norm_type)
-        out_patches.append(patches)
+    block = np.stack([read_input_scan(os.path.join(image_path, s), normalize=normalize, norm_type=norm_type)
+                        for s in scan_names])
 
-    return np.concatenate(out_patches, axis=1)
+    return gather_patches(pad_block(block, patch_shape), ref_voxels, patch_shape)
+
+
+def read_input_scan(scan_path, normalize=False, norm_type='zero_one'):
+    """
+    Read a scan for inference and optionally normalize it
+    """
+    return load_volume(scan_path, None, normalize_function=normalize_data if normalize else None, norm_type=norm_type)
+
+
+def read_input_block(timepoint_paths, normalize=False, norm_type='zero_one', histogram_matching=False, patch_size=None):
+    """
+    Read all timepoints and modalities of a case for inference as a (timepoints, modalities, x, y, z) block. If
+    histogram_matching (and normalize), every timepoint is matched to the first timepoint of the case, as in
+    PatchLoader3DTimeLoadAll. If patch_size is not None, the block is padded (see pad_block)
+    """
+    if normalize and histogram_matching:
+        # volumes are padded before normalization and matching, as in PatchLoader3DTimeLoadAll, so that both read the same memoized volumes
+        return np.stack([np.stack([load_matched_volume(s, s_ref, 'float32', patch_size, norm_type) for s, s_ref in zip(tp_paths, timepoint_paths[0])])
+                            for tp_paths in timepoint_paths])
+    block = np.stack([np.stack([read_input_scan(s, normalize=normalize, norm_type=norm_type) for s in tp_paths])
+                        for tp_paths in timepoint_paths])
+    return block if patch_size is None else pad_block(block, patch_size)
 
 
 def get_input_patches(scan_path,
@@ -1665,10 +1609,7 @@ def get_input_patches(scan_path,
     get current patches for a given scan
     """
     # current_scan = nib.as_closest_canonical(nib.load(scan_path)).get_data()
-    current_scan = nib.load(scan_path).get_data()
-
-    if normalize:
-        current_scan = normalize_data(current_scan, norm_type = norm_type)
+    current_scan = load_volume(scan_path, None, normalize_function=normalize_data if normalize else None, norm_type=norm_type)
 
     patches, ref_voxels = extract_patches(current_scan,
                                           voxel_coords=ref_voxels,
@@ -9,6 +9,8 @@ from torch.utils.data import Dataset
 from operator import add 
 from cc3d import connected_components as cc
 from ..general.general import list_folders, list_files_with_name_containing, get_dictionary_with_paths_cs 
+from .preprocessing_cache import load_volume
+from .patch_extraction import gather_patches
 from .transforms3D import RandomFlipX, RandomFlipY, RandomFlipZ, RandomRotationXY, RandomRotationXZ, RandomRotationYZ, ToTensor3DPatch
 
 
@@ -115,17 +117,9 @@ class PatchLoader3DCenter(Dataset):
             #output_patch = np.zeros(self.input_train_dim, dtype = 'float32') #Array to store output patches
             
             if(prev_pat != im_ or prev_tp != tp): #Load new image only if it´s another patient or another timepoint
-                if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            self.input_data[im_][tp][k]).get_data().astype('float32'))
-                                    for k in range(self.num_modalities)]
-                else:
-                    s = [nib.load(
-                            self.input_data[im_][tp][k]).get_data().astype('float32')
-                                    for k in range(self.num_modalities)]
-
-                if self.normalize:
-                    s = [normalize_data(s[m], norm_type = self.norm_type) for m in range(len(s))]
+                s = [load_volume(self.input_data[im_][tp][k], 'float32', self.patch_size if self.pad_or_not else None,
+                                    normalize_data if self.normalize else None, self.norm_type)
+                                for k in range(self.num_modalities)]
 
                 prev_pat = im_
                 prev_tp = tp
@@ -177,22 +171,16 @@ class PatchLoader3DCenter(Dataset):
                 #Padding
                 print(">>Analyzing patient", patient_number, ", timepoint", tp+1)
                 if self.pad_or_not:
-                    s = [self.apply_padding(nib.load(
-                            timepoints_list[tp][k]).get_data().astype('float32')) #Take first timepoint as reference for the patches
+                    s = [load_volume(timepoints_list[tp][k], 'float32', self.patch_size) #Take first timepoint as reference for the patches
                                 for k in range(self.num_modalities)]
-                    l = [self.apply_padding(nib.load(
-                            self.input_labels[patient_number][tp][0]).get_data().astype('float32'))] #Take GT of last timepoint
-                    r = [self.apply_padding(nib.load(
-                            self.input_rois[patient_number][tp][0]).get_data().astype('float32'))] #Take last brain mask 
+                    l = [load_volume(self.input_labels[patient_number][tp][0], 'float32', self.patch_size)] #Take GT of last timepoint
+                    r = [load_volume(self.input_rois[patient_number][tp][0], 'float32', self.patch_size)] #Take last brain mask 
                 #No pading
                 else:
-                    s = [nib.load(
-                            timepoints_list[tp][k]).get_data().astype('float32')
+                    s = [load_volume(timepoints_list[tp][k], 'float32')
                                 for k in range(self.num_modalities)]
-                    l = [nib.load(
-                            self.input_labels[patient_number][tp][0]).get_data().astype('float32')]
-                    r = [nib.load(
-                            self.input_rois[patient_number][tp][0]).get_data().astype('float32')]                
+                    l = [load_volume(self.input_labels[patient_number][tp][0], 'float32')]
+                    r = [load_volume(self.input_rois[patient_number][tp][0], 'float32')]                
 
 
                 base_img = np.zeros_like(l[0], dtype=np.uint8)
@@ -396,29 +384,11 @@ def get_candidate_voxels(input_mask, sel_method='all'):
 
 def get_data_channels(input_data, tp, case, patch_indexes, num_modalities, patch_size, patch_half, normalize, norm_type):
 
-    all_patches = np.zeros((len(patch_indexes), num_modalities, patch_size[0], patch_size[1], patch_size[2]), dtype='float32')
-    s = [nib.load(
-            input_data[case][tp][k]).get_data().astype('float32')
+    s = [load_volume(input_data[case][tp][k], 'float32', normalize_function=normalize_data if normalize else None, norm_type=norm_type)
                     for k in range(num_modalities)]
-    if normalize:
-        s = [normalize_data(s[m], norm_type = norm_type) for m in range(len(s))]
-    for idx in range(len(patch_indexes)):
-        #print(idx+1, "/", len(patch_indexes))
-        center = patch_indexes[idx,:] #Center of the patch
-        slice_ = [slice(c_idx-p_idx, c_idx+s_idx-p_idx)
-                for (c_idx, p_idx, s_idx) in zip(center,
-                                                patch_half,
-                                                patch_size)]
-
-        #output_patch = np.zeros(self.input_train_dim, dtype = 'float32') #Array to store output patches
-
-        # get current patches for both training data and labels
-        input_train = np.stack([s[m][tuple(slice_)]
-                                for m in range(num_modalities)], axis=0)
-
-        all_patches[idx,:,:,:] = input_train 
-        
-    return all_patches
+
+    # get all patches at once from the (modalities, x, y, z) block
+    return gather_patches(np.stack(s), np.asarray(patch_indexes) - np.array(patch_half), patch_size)
 
 
 
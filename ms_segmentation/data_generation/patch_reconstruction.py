@@ -0,0 +1,129 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with the reconstruction of volumes from overlapping patches (weighted overlap-add)
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      All classes are accumulated in the same pass. The frequency (weight) map only depends on the patch
+#               locations, the patch size and the volume size, so it is cached and shared by all classes and timepoints
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import hashlib
+import numpy as np
+from .volume_cache import VolumeCache
+
+# Frequency maps of the last reconstructed cases
+frequency_maps = VolumeCache(max_bytes=512*1024**2)
+
+
+def get_patch_weights(patch_size, gaussian_sigma=None):
+    """
+    Weight of every voxel of a patch for the overlap-add
+
+    inputs:
+    - patch_size: patch size (x,y,z)
+    - gaussian_sigma: if None, all voxels have weight 1. Otherwise, Gaussian weighting centered in the patch
+                      with sigma = gaussian_sigma*patch_size (e.g. 0.125), so that patch borders count less
+
+    outputs:
+    - weights: np.array with shape patch_size
+    """
+    if gaussian_sigma is None:
+        return np.ones(patch_size, dtype=np.float32)
+
+    grids = np.meshgrid(*[(np.arange(size) - (size - 1)/2.0)/(gaussian_sigma*size) for size in patch_size], indexing='ij')
+    weights = np.exp(-0.5*sum(g**2 for g in grids))
+    return (weights/weights.max()).astype(np.float32)
+
+
+def get_frequency_map(corners, patch_size, padded_size, gaussian_sigma=None):
+    """
+    Sum of patch weights for every voxel of the (padded) volume. Results are cached
+
+    inputs:
+    - corners: (N, len(patch_size)) array with the first voxel of each patch in the padded volume
+    - patch_size: patch size (x,y,z)
+    - padded_size: size of the padded volume
+    - gaussian_sigma: see get_patch_weights
+
+    outputs:
+    - frequency map with shape padded_size
+    """
+    corners = np.ascontiguousarray(corners, dtype=np.int64)
+    key = (hashlib.sha1(corners.tobytes()).hexdigest(), tuple(patch_size), tuple(padded_size), gaussian_sigma)
+
+    def compute():
+        weights = get_patch_weights(patch_size, gaussian_sigma)
+        freq_count = np.zeros(padded_size, dtype=np.float32)
+        for corner in corners:
+            freq_count[tuple(slice(c, c+s) for c, s in zip(corner, patch_size))] += weights
+        return freq_count
+
+    return frequency_maps.get(key, compute)
+
+
+def accumulate_patches(out_image, patches, corners, weights=None):
+    """
+    Add (weighted) patches to an accumulation buffer in place. Used by overlap_add and by streaming inference,
+    where the buffer is filled batch by batch
+
+    inputs:
+    - out_image: np.array (C, x, y, z) with the padded accumulation buffer
+    - patches: np.array (N, C, px, py, pz)
+    - corners: (N, 3) array with the first voxel of each patch in the padded volume
+    - weights: None or np.array with shape (px, py, pz) (see get_patch_weights)
+    """
+    patch_size = patches.shape[2:]
+    for patch, corner in zip(patches, corners):
+        slide = (slice(None),) + tuple(slice(c, c+s) for c, s in zip(corner, patch_size))
+        if weights is None:
+            out_image[slide] += patch
+        else:
+            out_image[slide] += patch*weights
+
+
+def normalize_accumulation(out_image, corners, patch_size, gaussian_sigma=None):
+    """
+    Divide an accumulation buffer by the (cached) frequency map in place, so that every voxel is the weighted mean
+    of all the patches that contain it
+
+    inputs:
+    - out_image: np.array (C, x, y, z) filled with accumulate_patches
+    - corners: (N, 3) array with the first voxel of all patches that were accumulated
+    - patch_size: patch size (x,y,z)
+    - gaussian_sigma: see get_patch_weights
+
+    outputs:
+    - out_image
+    """
+    freq_count = get_frequency_map(corners, patch_size, out_image.shape[1:], gaussian_sigma)
+    np.divide(out_image, freq_count, out=out_image, where=freq_count != 0)
+    out_image[np.isnan(out_image)] = 0
+    return out_image
+
+
+def overlap_add(patches, corners, padded_size, gaussian_sigma=None):
+    """
+    Weighted mean of overlapping patches. All classes are accumulated in the same pass
+
+    inputs:
+    - patches: np.array (N, C, x, y, z) with C channels (e.g. class probabilities) per patch
+    - corners: (N, 3) array with the first voxel of each patch in the padded volume
+    - padded_size: size of the padded volume (x,y,z)
+    - gaussian_sigma: see get_patch_weights
+
+    outputs:
+    - np.array (C, x, y, z) with the padded reconstruction of every channel
+    """
+    patch_size = patches.shape[2:]
+    corners = np.asarray(corners, dtype=np.int64).reshape(-1, len(patch_size))
+    weights = None if gaussian_sigma is None else get_patch_weights(patch_size, gaussian_sigma)
+
+    out_image = np.zeros((patches.shape[1],) + tuple(padded_size), dtype=np.float32)
+    accumulate_patches(out_image, patches, corners, weights)
+
+    # the reconstructed image is the (weighted) mean of all the patches
+    return normalize_accumulation(out_image, corners, patch_size, gaussian_sigma)
@@ -0,0 +1,136 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with a content-addressed on-disk cache of decoded, normalized and padded volumes
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Volumes are stored as uncompressed .npy files named after the hash of the input file and the
+#               preprocessing parameters, and read back as memory maps. All folds of a cross-validation therefore
+#               decode each NIfTI file once. The cache is disabled unless a folder is set with set_cache_dir or with
+#               the environment variable MS_PREPROCESSING_CACHE. Other derived arrays (e.g. histogram-matched volumes)
+#               are stored in the same folder with load_cached_array
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+
+CACHE_VERSION = 1 # Increase to invalidate all cached volumes if the preprocessing changes
+
+cache_dir = os.environ.get("MS_PREPROCESSING_CACHE", None)
+file_hashes = {} # (path, size, modification time) -> hash of the file content
+
+
+def set_cache_dir(the_path):
+    """
+    Set the folder of the cache. If None, the cache is disabled and volumes are always computed
+    """
+    global cache_dir
+    if the_path is not None and not os.path.exists(the_path):
+        os.makedirs(the_path)
+    cache_dir = the_path
+
+
+def get_file_hash(path):
+    """
+    sha1 of the content of a file. Hashes are memoized while the size and modification time of the file do not change
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in file_hashes:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                sha.update(chunk)
+        file_hashes[memo_key] = sha.hexdigest()
+    return file_hashes[memo_key]
+
+
+def get_array_key(params):
+    """
+    Name of a cached array: hash of a JSON-serializable dictionary with its inputs (e.g. file hashes) and parameters
+    """
+    return hashlib.sha1(json.dumps(dict(params, version=CACHE_VERSION), sort_keys=True).encode()).hexdigest()
+
+
+def get_volume_key(path, dtype, patch_size, normalize_function, norm_type, fdata):
+    """
+    Name of the cached volume: hash of the input file and of all preprocessing parameters
+    """
+    params = {"file": get_file_hash(path),
+              "dtype": None if dtype is None else np.dtype(dtype).str,
+              "patch_size": None if patch_size is None else [int(s) for s in patch_size],
+              "normalize": None if normalize_function is None else normalize_function.__module__ + "." + normalize_function.__qualname__,
+              "norm_type": norm_type,
+              "fdata": fdata}
+    return get_array_key(params)
+
+
+def preprocess_volume(path, dtype='float32', patch_size=None, normalize_function=None, norm_type='zero_one', fdata=False):
+    """
+    Read a NIfTI volume and preprocess it (without cache)
+
+    inputs:
+    - path: path to the NIfTI file
+    - dtype: type the volume is cast to after decoding (None to keep the type of the file)
+    - patch_size: if not None, the first len(patch_size) axes are padded with zeros by (size//2, size - size//2), as
+                  the apply_padding method of the loaders
+    - normalize_function: if not None, function applied after padding as normalize_function(volume, norm_type=norm_type)
+    - norm_type: type of normalization
+    - fdata: if True, the volume is decoded with get_fdata (float64) instead of keeping the type stored in the file
+
+    outputs:
+    - preprocessed volume
+    """
+    image = nib.load(path)
+    volume = image.get_fdata() if fdata else np.asanyarray(image.dataobj) # get_data was removed in nibabel 5
+    if dtype is not None:
+        volume = volume.astype(dtype)
+    if patch_size is not None:
+        padding = tuple((size // 2, size - size // 2) for size in patch_size) + ((0, 0),) * (volume.ndim - len(patch_size))
+        volume = np.pad(volume, padding, mode='constant', constant_values=0)
+    if normalize_function is not None:
+        volume = normalize_function(volume, norm_type=norm_type)
+    return volume
+
+
+def load_cached_array(key, compute_function):
+    """
+    Read an array from the cache, or compute it with <compute_function> (without arguments) and store it
+
+    inputs:
+    - key: name of the array in the cache (e.g. the hash of its inputs and parameters). Ignored if the cache is disabled
+    - compute_function: function that produces the array
+
+    outputs:
+    - array. If the cache is enabled, it is a copy-on-write memory map of the cached .npy file, so it can be modified
+      in place without changing the cache
+    """
+    if cache_dir is None:
+        return compute_function()
+
+    cache_path = os.path.join(cache_dir, key + ".npy")
+    if not os.path.exists(cache_path):
+        array = compute_function()
+        # write to a temporary file first, so that other processes never read a partial array
+        tmp_path = cache_path[:-4] + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='c')
+
+
+def load_volume(path, dtype='float32', patch_size=None, normalize_function=None, norm_type='zero_one', fdata=False):
+    """
+    Read a preprocessed volume through the cache. Same arguments as preprocess_volume
+
+    outputs:
+    - preprocessed volume (see load_cached_array)
+    """
+    return load_cached_array(get_volume_key(path, dtype, patch_size, normalize_function, norm_type, fdata) if cache_dir is not None else None,
+                             lambda: preprocess_volume(path, dtype, patch_size, normalize_function, norm_type, fdata))
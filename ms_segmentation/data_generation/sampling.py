@@ -0,0 +1,154 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with a case-affinity batch sampler and worker initialization for DataLoaders with num_workers>0
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Patches are grouped by case (or case and timepoints). Every epoch the order of the groups and the order of
+#               the patches inside each group are shuffled. Groups are distributed among the workers, so that each worker
+#               streams one volume at a time and its volume cache is reused for all patches of the group
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import random
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler, get_worker_info
+
+
+def get_group_key(patch_index):
+    """
+    Default group of a patch index. Patch indexes of the loaders end with the center of the patch, e.g. (case, center)
+    or (case, timepoints, center), so all elements but the last one identify the volume(s) the patch is read from
+    """
+    return patch_index[:-1]
+
+
+def get_patch_groups(dataset, group_key=get_group_key):
+    """
+    Group the samples of a dataset by volume
+
+    inputs:
+    - dataset: dataset with attribute patch_indexes and, optionally, sample_indexes (samples used after balancing)
+    - group_key: function that maps a patch index to its group
+
+    outputs:
+    - list of np.arrays with the dataset indexes of each group, in order of first appearance
+    """
+    patch_indexes = dataset.patch_indexes
+    sample_indexes = getattr(dataset, "sample_indexes", None)
+    if sample_indexes is None:
+        sample_indexes = range(len(patch_indexes))
+
+    groups = {}
+    for i_sample, i_patch in enumerate(sample_indexes):
+        groups.setdefault(group_key(patch_indexes[i_patch]), []).append(i_sample)
+    return [np.array(g, dtype=np.int64) for g in groups.values()]
+
+
+class CaseAffinityBatchSampler(Sampler):
+    """
+    Batch sampler that shuffles at group level and then inside each group. To be used as batch_sampler of a DataLoader.
+
+    The groups of an epoch are assigned to <num_workers> streams (least loaded stream first) and the batches of the
+    streams are interleaved. The DataLoader sends batch i to worker i % num_workers, so each worker receives the batches
+    of one stream and only reads the volumes of its own groups.
+    """
+
+    def __init__(self, dataset, batch_size, num_workers=0, drop_last=False, seed=None, group_key=get_group_key):
+        """
+        Arguments:
+        - dataset: dataset with attribute patch_indexes (see get_patch_groups)
+        - batch_size: number of samples per batch
+        - num_workers: number of workers of the DataLoader (0 for loading in the main process)
+        - drop_last: if True, incomplete batches of every stream are dropped
+        - seed: seed of the shuffling. If None, a seed is drawn from torch, so that torch.manual_seed makes it deterministic
+        - group_key: function that maps a patch index to its group
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_streams = max(1, num_workers)
+        self.drop_last = drop_last
+        self.seed = int(torch.randint(0, 2**31 - 1, (1,)).item()) if seed is None else seed
+        self.group_key = group_key
+        self.epoch = 0
+
+    def build_batches(self, epoch):
+        """
+        Build the list of batches of an epoch
+        """
+        rng = np.random.RandomState(self.seed + epoch)
+        groups = get_patch_groups(self.dataset, self.group_key)
+
+        streams = [[] for _ in range(self.num_streams)]
+        stream_sizes = np.zeros(self.num_streams, dtype=np.int64)
+        for i_group in rng.permutation(len(groups)):
+            i_stream = int(np.argmin(stream_sizes))
+            streams[i_stream].append(rng.permutation(groups[i_group]))
+            stream_sizes[i_stream] += len(groups[i_group])
+
+        stream_batches = []
+        for stream in streams:
+            if len(stream) == 0:
+                continue
+            indexes = np.concatenate(stream)
+            batches = [indexes[b:b+self.batch_size].tolist() for b in range(0, len(indexes), self.batch_size)]
+            if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+                batches = batches[:-1]
+            stream_batches.append(batches)
+
+        # interleave streams: batch i goes to worker i % num_workers
+        all_batches = []
+        for i_batch in range(max([len(b) for b in stream_batches] + [0])):
+            all_batches += [batches[i_batch] for batches in stream_batches if i_batch < len(batches)]
+        return all_batches
+
+    def __iter__(self):
+        # generator: the epoch only advances when iteration starts (DataLoader may create iterators that are not used)
+        batches = self.build_batches(self.epoch)
+        self.epoch += 1
+        yield from batches
+
+    def __len__(self):
+        return len(self.build_batches(self.epoch))
+
+
+def worker_init_fn(worker_id):
+    """
+    Initialization of DataLoader workers. Seeds numpy and random from the torch seed of the worker (different for every
+    worker and deterministic if torch.manual_seed was set in the main process) and resets the per-worker state of the
+    dataset (see init_worker of the loaders)
+    """
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+    worker_info = get_worker_info()
+    if worker_info is not None and hasattr(worker_info.dataset, "init_worker"):
+        worker_info.dataset.init_worker(worker_info.id, worker_info.num_workers)
+
+
+def get_dataloader(dataset, batch_size, shuffle=True, num_workers=0, drop_last=False, case_affinity=False, seed=None):
+    """
+    Build a DataLoader whose workers are seeded and initialized with worker_init_fn
+
+    inputs:
+    - dataset: dataset to load
+    - batch_size: number of samples per batch
+    - shuffle: whether to shuffle the samples every epoch
+    - num_workers: number of worker processes (0 for loading in the main process)
+    - drop_last: whether to drop the last incomplete batch(es)
+    - case_affinity: if True (and shuffle), samples are shuffled with CaseAffinityBatchSampler. Recommended for the
+                     lazy loaders (PatchLoader3D, PatchLoader3DTime, PatchLoader2D_slow)
+    - seed: seed of the CaseAffinityBatchSampler
+
+    outputs:
+    - torch DataLoader
+    """
+    if case_affinity and shuffle:
+        batch_sampler = CaseAffinityBatchSampler(dataset, batch_size, num_workers=num_workers, drop_last=drop_last, seed=seed)
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers, worker_init_fn=worker_init_fn)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
+                      worker_init_fn=worker_init_fn)
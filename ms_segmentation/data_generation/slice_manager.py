@@ -5,6 +5,7 @@ import nibabel as nib
 import numpy as np
 from scipy import ndimage
 from .patch_manager_2d import normalize_data
+from .preprocessing_cache import load_volume
 from torch.utils.data import Dataset
 from ..general.general import list_folders, cls, get_dictionary_with_paths
 from os.path import join as jp
@@ -50,15 +51,14 @@ class SlicesGroupLoader(Dataset):
             idx = idx.tolist()
 
         if self.normalize: #Normalize whole image
-            s = [normalize_data( nib.load(self.data[idx][0][k]).get_fdata().astype('float32'), norm_type = self.norm_type)
+            s = [load_volume(self.data[idx][0][k], 'float32', normalize_function=normalize_data, norm_type=self.norm_type, fdata=True)
                         for k in range(self.num_modalities)]
         else:
-            s = [nib.load(self.data[idx][0][k]).get_fdata().astype('float32')
+            s = [load_volume(self.data[idx][0][k], 'float32', fdata=True)
                         for k in range(self.num_modalities)]
 
 
-        l = [nib.load(
-                self.data[idx][1][0]).get_fdata()[:,:,self.data[idx][2]].astype('float32')]
+        l = [load_volume(self.data[idx][1][0], 'float32', fdata=True)[:,:,self.data[idx][2]]]
 
         images = np.zeros((self.num_slices, self.num_modalities, l[0].shape[0], l[0].shape[1]))
         pivot = self.num_slices // 2
@@ -96,7 +96,7 @@ class SlicesGroupLoader(Dataset):
         all_elements = []
         for i in range(len(self.input_data)): # Process one image at a time
             # read first image to get number of slices
-            roi = nib.load(self.input_rois[i][0]).get_fdata()
+            roi = load_volume(self.input_rois[i][0], None, fdata=True)
             #total_slices = roi.shape[2]
             #total_slices = nib.load(self.input_data[i][0]).get_fdata().shape[2]
             lower_limit, upper_limit = self.get_limits(roi)
@@ -185,16 +185,14 @@ class SlicesLoader(Dataset):
             idx = idx.tolist()
 
         if self.normalize: #Wrong: Normalize whole image, not slice. AND DONT NORMALIZE LABELS
-            s = [normalize_data( nib.load(self.data[idx][0][k]).get_fdata().astype('float32'), norm_type = self.norm_type)[:,:,self.data[idx][2]]
+            s = [load_volume(self.data[idx][0][k], 'float32', normalize_function=normalize_data, norm_type=self.norm_type, fdata=True)[:,:,self.data[idx][2]]
                         for k in range(self.num_modalities)]
-            l = [normalize_data( nib.load(
-                    self.data[idx][1][0]).get_fdata()[:,:,self.data[idx][2]].astype('float32'), norm_type = self.norm_type)]
+            l = [normalize_data( load_volume(self.data[idx][1][0], 'float32', fdata=True)[:,:,self.data[idx][2]], norm_type = self.norm_type)]
 
         else:
-            s = [nib.load(self.data[idx][0][k]).get_fdata().astype('float32')[:,:,self.data[idx][2]]
+            s = [load_volume(self.data[idx][0][k], 'float32', fdata=True)[:,:,self.data[idx][2]]
                         for k in range(self.num_modalities)]
-            l = [nib.load(
-                    self.data[idx][1][0]).get_fdata()[:,:,self.data[idx][2]].astype('float32')]
+            l = [load_volume(self.data[idx][1][0], 'float32', fdata=True)[:,:,self.data[idx][2]]]
 
 
         images = np.zeros((self.num_modalities, l[0].shape[0], l[0].shape[1]))
@@ -207,7 +205,7 @@ class SlicesLoader(Dataset):
         all_elements = []
         for i in range(len(self.input_data)): # Process one image at a time
             # read first image to get number of slices
-            roi = nib.load(self.input_rois[i][0]).get_fdata()
+            roi = load_volume(self.input_rois[i][0], None, fdata=True)
             #total_slices = roi.shape[2]
             #total_slices = nib.load(self.input_data[i][0]).get_fdata().shape[2]
             lower_limit, upper_limit = self.get_limits(roi)
@@ -283,7 +281,7 @@ class SlicesLoaderLoadAll(Dataset):
         all_elements = []
         for i in range(len(self.input_data)): # Process one image at a time
             # read first image to get number of slices
-            roi = nib.load(self.input_rois[i][0]).get_fdata()
+            roi = load_volume(self.input_rois[i][0], None, fdata=True)
             #total_slices = roi.shape[2]
             #total_slices = nib.load(self.input_data[i][0]).get_fdata().shape[2]
             lower_limit, upper_limit = self.get_limits(roi)
@@ -297,14 +295,13 @@ class SlicesLoaderLoadAll(Dataset):
         for idx in range(len(all_elements)):
             print("loading element ", idx+1, "/", len(all_elements))
             if self.normalize: #Wrong: Normalize whole image, not slice. AND DONT NORMALIZE LABELS
-                s = [normalize_data( nib.load(all_elements[idx][0][k]).get_fdata().astype('float32'), norm_type = self.norm_type)[:,:,all_elements[idx][2]]
+                s = [load_volume(all_elements[idx][0][k], 'float32', normalize_function=normalize_data, norm_type=self.norm_type, fdata=True)[:,:,all_elements[idx][2]]
                             for k in range(self.num_modalities)]
             else:
-                s = [nib.load(all_elements[idx][0][k]).get_fdata().astype('float32')[:,:,all_elements[idx][2]]
+                s = [load_volume(all_elements[idx][0][k], 'float32', fdata=True)[:,:,all_elements[idx][2]]
                             for k in range(self.num_modalities)]
 
-            l = [nib.load(
-                    all_elements[idx][1][0]).get_fdata()[:,:,all_elements[idx][2]].astype('float32')]
+            l = [load_volume(all_elements[idx][1][0], 'float32', fdata=True)[:,:,all_elements[idx][2]]]
 
             images = np.zeros((self.num_modalities, l[0].shape[0], l[0].shape[1]))
             for i_mod in range(self.num_modalities):
@@ -381,19 +378,18 @@ class SlicesGroupLoaderTime(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
-        l = [nib.load(
-                self.data[idx][2]).get_fdata()[:,:,self.data[idx][-1]].astype('float32')]
+        l = [load_volume(self.data[idx][2], 'float32', fdata=True)[:,:,self.data[idx][-1]]]
 
         images = np.zeros((self.num_timepoints, self.num_modalities, l[0].shape[0], l[0].shape[1]))
 
         if self.normalize:
             for i_t in range(self.num_timepoints):
                 for i_m in range(self.num_modalities):
-                    images[i_t, i_m, :, :] = normalize_data(nib.load(self.data[idx][1][i_t][i_m]).get_fdata().astype('float32'), norm_type = self.norm_type)[:,:,self.data[idx][-1]]
+                    images[i_t, i_m, :, :] = load_volume(self.data[idx][1][i_t][i_m], 'float32', normalize_function=normalize_data, norm_type=self.norm_type, fdata=True)[:,:,self.data[idx][-1]]
         else:
             for i_t in range(self.num_timepoints):
                 for i_m in range(self.num_modalities):
-                    images[i_t, i_m, :, :] = nib.load(self.data[idx][1][i_t][i_m]).get_fdata().astype('float32')[:,:,self.data[idx][-1]]
+                    images[i_t, i_m, :, :] = load_volume(self.data[idx][1][i_t][i_m], 'float32', fdata=True)[:,:,self.data[idx][-1]]
 
 
         cropped_images, cropped_labels = self.crop_images(images, l[0][np.newaxis, :, :])
@@ -429,7 +425,7 @@ class SlicesGroupLoaderTime(Dataset):
             
             for i in range(len(timepoints_list) - self.num_timepoints + 1): #For every possible combination of consecutive timepoints
                 # read first image to get number of slices
-                roi = nib.load(self.input_rois[patient][i + self.num_timepoints - 1][0]).get_fdata() #ROI of last timepoint of the group
+                roi = load_volume(self.input_rois[patient][i + self.num_timepoints - 1][0], None, fdata=True) #ROI of last timepoint of the group
 
                 lower_limit, upper_limit = self.get_limits(roi)
                 for j in range(lower_limit,upper_limit):    
@@ -588,19 +584,18 @@ class SlicesGroupLoaderTimeLoadAll(Dataset):
             cls()
             print("Loading all patches...")
             print(idx, "/", len(self.data))
-            l = [nib.load(
-                    self.data[idx][2]).get_fdata()[:,:,self.data[idx][-1]].astype('float32')]
+            l = [load_volume(self.data[idx][2], 'float32', fdata=True)[:,:,self.data[idx][-1]]]
 
             images = np.zeros((self.num_timepoints, self.num_modalities, l[0].shape[0], l[0].shape[1]))
 
             if self.normalize:
                 for i_t in range(self.num_timepoints):
                     for i_m in range(self.num_modalities):
-                        images[i_t, i_m, :, :] = normalize_data(nib.load(self.data[idx][1][i_t][i_m]).get_fdata().astype('float32'), norm_type = self.norm_type)[:,:,self.data[idx][-1]]
+                        images[i_t, i_m, :, :] = load_volume(self.data[idx][1][i_t][i_m], 'float32', normalize_function=normalize_data, norm_type=self.norm_type, fdata=True)[:,:,self.data[idx][-1]]
             else:
                 for i_t in range(self.num_timepoints):
                     for i_m in range(self.num_modalities):
-                        images[i_t, i_m, :, :] = nib.load(self.data[idx][1][i_t][i_m]).get_fdata().astype('float32')[:,:,self.data[idx][-1]]
+                        images[i_t, i_m, :, :] = load_volume(self.data[idx][1][i_t][i_m], 'float32', fdata=True)[:,:,self.data[idx][-1]]
 
 
             all_patches[idx], all_labels[idx] = self.crop_images(images, l[0][np.newaxis, :, :])
@@ -636,7 +631,7 @@ class SlicesGroupLoaderTimeLoadAll(Dataset):
             
             for i in range(len(timepoints_list) - self.num_timepoints + 1): #For every possible combination of consecutive timepoints
                 # read first image to get number of slices
-                roi = nib.load(self.input_rois[patient][i + self.num_timepoints - 1][0]).get_fdata() #ROI of last timepoint of the group
+                roi = load_volume(self.input_rois[patient][i + self.num_timepoints - 1][0], None, fdata=True) #ROI of last timepoint of the group
 
                 lower_limit, upper_limit = self.get_limits(roi)
                 for j in range(lower_limit,upper_limit):    
@@ -694,10 +689,10 @@ class SlicesGroupLoaderTimeLoadAll(Dataset):
 def get_inference_slices(scan_path, input_data, normalize=True, norm_type = 'zero_one'):
 
     if normalize: 
-        s = [normalize_data( nib.load(jp(scan_path, mod)).get_fdata().astype('float32'), norm_type = norm_type)
+        s = [load_volume(jp(scan_path, mod), 'float32', normalize_function=normalize_data, norm_type=norm_type, fdata=True)
                     for mod in input_data]
     else:
-        s = [nib.load(jp(scan_path, mod)).get_fdata().astype('float32')
+        s = [load_volume(jp(scan_path, mod), 'float32', fdata=True)
                     for mod in input_data]
 
     num_modalities = len(input_data)
@@ -738,15 +733,15 @@ def get_inference_slices_time(the_path, the_case, input_data, out_size, crop = T
     num_timepoints = len(list_images[the_case])
 
     #Get number of slices from first image of first time point
-    dim_x, dim_y, num_slices = nib.load(list_images[the_case][0][0]).get_fdata().shape
+    dim_x, dim_y, num_slices = nib.load(list_images[the_case][0][0]).shape
 
     all_slices = np.zeros((num_slices, num_timepoints, len(input_data), dim_x, dim_y), dtype = "float32")
     for t in range(len(list_images[the_case])): #Iterate in tmepoints
         for mod in range(len(list_images[the_case][t])): #Iterate in modalities
             if normalize:
-                all_slices[:,t, mod,:,:] = np.transpose(normalize_data(nib.load(list_images[the_case][t][mod]).get_fdata(), norm_type=norm_type), (2,0,1))
+                all_slices[:,t, mod,:,:] = np.transpose(load_volume(list_images[the_case][t][mod], None, normalize_function=normalize_data, norm_type=norm_type, fdata=True), (2,0,1))
             else:
-                all_slices[:,t, mod,:,:] = np.transpose(nib.load(list_images[the_case][t][mod]).get_fdata(), (2,0,1))
+                all_slices[:,t, mod,:,:] = np.transpose(load_volume(list_images[the_case][t][mod], None, fdata=True), (2,0,1))
 
     if crop:
         all_slices = crop_images(all_slices, out_size)
@@ -0,0 +1,185 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with streaming sliding-window inference (patches are never materialized for a whole case)
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      The padded (timepoints, modalities, x, y, z) block of a case is loaded once. Batches of patch corners
+#               are gathered from it, passed through the model and accumulated directly into the reconstruction
+#               buffer, so peak memory is bounded by the size of the volumes plus one batch
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+import torch
+from os.path import join as jp
+from ..general.general import list_folders, get_dictionary_with_paths
+from .patch_extraction import pad_block, gather_patches
+from .patch_reconstruction import get_patch_weights, accumulate_patches, normalize_accumulation
+from .patch_manager_3d import get_candidate_voxels, read_input_scan, read_input_block
+from .preprocessing_cache import load_volume
+
+
+def load_inference_block(path_test, case, input_data, roi, patch_shape, step, normalize=True, norm_type="zero_one", mode="cs", num_timepoints=None,
+                         histogram_matching=False):
+    """
+    Load the volumes of a case for streaming inference. Same arguments as get_inference_patches
+
+    inputs:
+    - path_test: path to the test cases
+    - case: case to infer
+    - input_data: list containing the input modality names
+    - roi: ROI mask name
+    - patch_shape: patch size
+    - step: sampling step
+    - normalize: whether to normalize the images
+    - norm_type: Type of normalization to be applied
+    - mode: cross-sectional (cs) or longitudinal (l)
+    - num_timepoints: number of timepoints of the case (longitudinal mode). The ROI of the last timepoint is used
+    - histogram_matching: (longitudinal mode) match histograms of all timepoints to the first timepoint of the case, as
+                          PatchLoader3DTimeLoadAll (see read_input_block)
+
+    outputs:
+    - cs: list with one padded block (modalities, x, y, z) per timepoint and list with the reference voxels of each timepoint
+    - l: padded block (timepoints, modalities, x, y, z) and reference voxels
+    """
+    if mode == "cs":
+        scan_path = jp(path_test, case)
+        timepoints = list_folders(scan_path)
+        blocks = []
+        all_ref_voxels = []
+        for tp in range(len(timepoints)):
+            mask_image = load_volume(os.path.join(scan_path, timepoints[tp], roi), None)
+            _, ref_voxels = get_candidate_voxels(mask_image, step, sel_method='all')
+            all_ref_voxels.append(ref_voxels)
+            block = np.stack([read_input_scan(os.path.join(scan_path, timepoints[tp], s), normalize=normalize, norm_type=norm_type)
+                                for s in input_data]).astype(np.float32)
+            blocks.append(pad_block(block, patch_shape))
+        return blocks, all_ref_voxels
+
+    elif mode == "l":
+        scan_path = jp(path_test, case)
+        list_images = get_dictionary_with_paths([case], path_test, input_data)
+        list_rois = get_dictionary_with_paths([case], path_test, roi)
+
+        brain_mask = list_rois[case][num_timepoints-1][0]   #ROI of last timepoint chosen
+        mask_image = load_volume(os.path.join(scan_path, brain_mask), None)
+        _, ref_voxels = get_candidate_voxels(mask_image, step, sel_method='all')
+
+        block = read_input_block(list_images[case], normalize=normalize, norm_type=norm_type,
+                                 histogram_matching=histogram_matching, patch_size=patch_shape).astype(np.float32)
+        return block, ref_voxels
+
+    else:
+        raise ValueError("Unknown mode.")
+
+
+def get_time_window(i_timepoint, total_timepoints, desired_timepoints=3):
+    """
+    Timepoints used to predict timepoint <i_timepoint>. First and last timepoints are replicated, as in get_groups
+
+    outputs:
+    - list of timepoint indexes, e.g. [0, 0, 1] for the first timepoint
+    """
+    half = desired_timepoints // 2
+    return [min(max(i_tp, 0), total_timepoints-1) for i_tp in range(i_timepoint-half, i_timepoint-half+desired_timepoints)]
+
+
+def iterate_patch_batches(block, corners, patch_shape, batch_size, time_indexes=None, both_time_and_seq=True):
+    """
+    Generator of batches of patches gathered straight from a padded block
+
+    inputs:
+    - block: padded block (modalities, x, y, z) or (timepoints, modalities, x, y, z)
+    - corners: (N, 3) array with the first voxel of each patch in the padded block (= original center coordenates)
+    - patch_shape: patch size
+    - batch_size: number of patches per batch
+    - time_indexes: None or list of timepoints to take from a longitudinal block (see get_time_window)
+    - both_time_and_seq: if False, the modality axis is dropped (single modality, as get_groups does)
+
+    outputs:
+    - yields (corners of the batch, patches of the batch)
+    """
+    corners = np.asarray(corners, dtype=np.int64).reshape(-1, len(patch_shape))
+    for b in range(0, len(corners), batch_size):
+        batch_corners = corners[b:b+batch_size]
+        patches = gather_patches(block, batch_corners, patch_shape)
+        if time_indexes is not None:
+            patches = patches[:, time_indexes]
+            if not both_time_and_seq:
+                patches = patches[:, :, 0]
+        yield batch_corners, patches
+
+
+def stream_inference(lesion_model, device, block, corners, patch_shape, num_classes, batch_size, time_indexes=None,
+                     both_time_and_seq=True, gaussian_sigma=None):
+    """
+    Segment a volume batch by batch. Predictions are accumulated directly into the reconstruction buffer
+
+    inputs:
+    - lesion_model: model to use
+    - device: torch device
+    - block, corners, patch_shape, batch_size, time_indexes, both_time_and_seq: see iterate_patch_batches
+    - num_classes: number of output channels of the model
+    - gaussian_sigma: optional Gaussian weighting of the patches (see patch_reconstruction.get_patch_weights)
+
+    outputs:
+    - np.array (x, y, z, num_classes) with the probabilities of every class, as reconstruct_image_multiclass
+    """
+    patch_half = [idx // 2 for idx in patch_shape]
+    padded_size = block.shape[-3:]
+    weights = None if gaussian_sigma is None else get_patch_weights(patch_shape, gaussian_sigma)
+    out_image = np.zeros((num_classes,) + tuple(padded_size), dtype=np.float32)
+
+    lesion_model.eval()
+    with torch.no_grad():
+        for batch_corners, patches in iterate_patch_batches(block, corners, patch_shape, batch_size, time_indexes, both_time_and_seq):
+            pred = lesion_model(torch.from_numpy(np.ascontiguousarray(patches)).to(device))
+            accumulate_patches(out_image, pred.detach().cpu().numpy().astype('float32'), batch_corners, weights)
+
+    out_image = normalize_accumulation(out_image, np.asarray(corners, dtype=np.int64).reshape(-1, 3), patch_shape, gaussian_sigma)
+
+    # invert the padding applied for patch writing
+    crop = tuple(slice(h, h + s - p) for h, s, p in zip(patch_half, padded_size, patch_shape))
+    return np.moveaxis(out_image[(slice(None),) + crop], 0, -1)
+
+
+def stream_inference_windows(lesion_model, device, block, corners, patch_shape, num_classes, batch_size, time_windows,
+                             both_time_and_seq=True, gaussian_sigma=None):
+    """
+    Segment all timepoints of a longitudinal case. Each batch of patches is gathered once for all timepoints. If the
+    model provides forward_windows, every timepoint also goes through the encoder only once and its features are shared
+    by all windows; otherwise the model is called once per window
+
+    inputs:
+    - lesion_model, device, block, corners, patch_shape, num_classes, batch_size, both_time_and_seq, gaussian_sigma: see stream_inference
+    - time_windows: list with the timepoint indexes of each window (see get_time_window)
+
+    outputs:
+    - list with one np.array (x, y, z, num_classes) per window
+    """
+    patch_half = [idx // 2 for idx in patch_shape]
+    padded_size = block.shape[-3:]
+    weights = None if gaussian_sigma is None else get_patch_weights(patch_shape, gaussian_sigma)
+    out_images = [np.zeros((num_classes,) + tuple(padded_size), dtype=np.float32) for _ in time_windows]
+
+    lesion_model.eval()
+    with torch.no_grad():
+        for batch_corners, patches in iterate_patch_batches(block, corners, patch_shape, batch_size):
+            if not both_time_and_seq:
+                patches = patches[:, :, 0]
+            patches = torch.from_numpy(np.ascontiguousarray(patches)).to(device)
+            if hasattr(lesion_model, "forward_windows"):
+                preds = lesion_model.forward_windows(patches, time_windows)
+            else:
+                preds = [lesion_model(patches[:, time_indexes]) for time_indexes in time_windows]
+            for out_image, pred in zip(out_images, preds):
+                accumulate_patches(out_image, pred.detach().cpu().numpy().astype('float32'), batch_corners, weights)
+
+    corners = np.asarray(corners, dtype=np.int64).reshape(-1, 3)
+    crop = (slice(None),) + tuple(slice(h, h + s - p) for h, s, p in zip(patch_half, padded_size, patch_shape))
+    return [np.moveaxis(normalize_accumulation(out_image, corners, patch_shape, gaussian_sigma)[crop], 0, -1)
+                for out_image in out_images]
@@ -0,0 +1,256 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script to generate synthetic longitudinal MS cohorts, to test how loaders, cross-validation and
+#               inference scale with the number of cases, timepoints and the size of the volumes
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Cases are written with the folder and file names of the ISBI datasets:
+#                   - longitudinal ("l"):      <cohort>/<case>/flair_01.nii.gz, ..., brain_mask_01.nii.gz, mask1_01.nii.gz
+#                   - cross-sectional ("cs"):  <cohort>/<case>/01/flair.nii.gz, ..., brain_mask.nii.gz, mask1.nii.gz
+#               so they can be read with get_dictionary_with_paths and get_dictionary_with_paths_cs. Each case has an
+#               ellipsoidal brain with WM/GM-like tissue, and lesions that appear, grow or shrink across timepoints.
+#               mask1 and mask2 simulate two raters. Every case has its own random seed, so a cohort is the same
+#               regardless of the number of processes used to write it (generate_cohort)
+#
+#               Usage: python -m ms_segmentation.data_generation.synthetic_cohort <output folder> --cases 100
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import argparse
+import numpy as np
+import nibabel as nib
+from os.path import join as jp
+from multiprocessing import Pool
+
+modalities = ["flair", "mprage", "pd", "t2"]
+
+# mean intensity of (background tissue, lesions) per modality, relative to white matter. Lesions are hyperintense
+# in FLAIR, PD and T2 and hypointense in MPRAGE
+tissue_contrast = {"flair": (0.8, 1.6), "mprage": (0.75, 0.6), "pd": (1.1, 1.4), "t2": (1.3, 1.8)}
+
+
+def get_case_name(i_case, num_cases):
+    """
+    Name of case <i_case> (starting at 0): index starting at 1 with at least two digits, so that folders are sorted
+    """
+    return str(i_case+1).zfill(max(2, len(str(num_cases))))
+
+
+def get_brain_mask(volume_shape):
+    """
+    Ellipsoidal brain mask that fills 80 % of each dimension
+    """
+    grid = np.ogrid[tuple(slice(0, s) for s in volume_shape)]
+    return sum(((g - s/2) / (0.4*s))**2 for g, s in zip(grid, volume_shape)) <= 1
+
+
+def get_lesions(rng, brain_mask, num_lesions, num_timepoints, radius_range=(1.5, 6), new_fraction=0.2, growth_range=(-0.5, 1)):
+    """
+    Sample lesions inside the brain and their evolution
+
+    inputs:
+    - rng: np.random.RandomState
+    - brain_mask: boolean brain mask
+    - num_lesions: number of lesions of the case
+    - num_timepoints: number of timepoints
+    - radius_range: range of the initial radius of the lesions (voxels)
+    - new_fraction: fraction of lesions that appear after the first timepoint
+    - growth_range: range of the change of radius per timepoint (voxels). Negative values shrink lesions, that disappear
+                    when their radius is below 1
+
+    outputs:
+    - list of dictionaries with the "center", the "radius" of the lesion at each timepoint (0 if it is not present)
+      and its "shape" (relative radius along each axis)
+    """
+    brain_voxels = np.flatnonzero(brain_mask)
+    lesions = []
+    for center in rng.choice(brain_voxels, size=num_lesions):
+        first_tp = rng.randint(1, num_timepoints) if num_timepoints > 1 and rng.rand() < new_fraction else 0
+        radius, growth = rng.uniform(*radius_range), rng.uniform(*growth_range)
+        radii = [0.0 if tp < first_tp else radius + growth*(tp - first_tp) for tp in range(num_timepoints)]
+        lesions.append({"center": np.unravel_index(center, brain_mask.shape),
+                        "radius": [r if r >= 1 else 0.0 for r in radii],
+                        "shape": rng.uniform(0.7, 1.3, 3)})
+    return lesions
+
+
+def draw_lesions(volume_shape, lesions, timepoint, scale=1.0):
+    """
+    Lesion mask of a timepoint. Each lesion is only drawn in its bounding box
+
+    inputs:
+    - volume_shape: shape of the mask
+    - lesions: list of lesions (see get_lesions)
+    - timepoint: index of the timepoint
+    - scale: factor applied to all radii (e.g. to simulate a second rater)
+
+    outputs:
+    - boolean mask
+    """
+    mask = np.zeros(volume_shape, dtype=bool)
+    for lesion in lesions:
+        if lesion["radius"][timepoint] == 0:
+            continue
+        radii = lesion["radius"][timepoint] * scale * lesion["shape"]
+        box = tuple(slice(max(0, int(c - r)), min(s, int(c + r) + 1)) for c, r, s in zip(lesion["center"], radii, volume_shape))
+        grid = np.ogrid[box]
+        mask[box] |= sum(((g - c) / r)**2 for g, c, r in zip(grid, lesion["center"], radii)) <= 1
+    return mask
+
+
+def get_tissue(rng, brain_mask):
+    """
+    Smooth WM/GM-like tissue map in [0, 1] (1: white matter), built from upsampled low-resolution noise
+    """
+    coarse = rng.rand(*[max(2, s // 16) for s in brain_mask.shape])
+    indexes = np.ix_(*[np.minimum((np.arange(s) * c) // s, c - 1) for s, c in zip(brain_mask.shape, coarse.shape)])
+    return np.clip(coarse[indexes] * 1.5 - 0.25, 0, 1) * brain_mask
+
+
+def get_image(rng, modality, brain_mask, tissue, lesion_mask, drift):
+    """
+    Synthetic image of a modality
+
+    inputs:
+    - rng: np.random.RandomState
+    - modality: one of the keys of tissue_contrast
+    - brain_mask, tissue, lesion_mask: see get_brain_mask, get_tissue, draw_lesions
+    - drift: global intensity factor of the timepoint (scanner drift, to be corrected by intensity normalization)
+
+    outputs:
+    - image (float32), 0 outside the brain
+    """
+    background, lesion = tissue_contrast[modality]
+    image = (background + (1 - background) * tissue).astype(np.float32)
+    image[lesion_mask] = lesion
+    image += rng.normal(0, 0.05, brain_mask.shape).astype(np.float32)
+    image *= np.float32(500 * drift)
+    image[~brain_mask] = 0
+    return np.clip(image, 0, None)
+
+
+def get_file_path(path_case, name, timepoint, layout):
+    """
+    Path of an image of a case, for the longitudinal ("l") or cross-sectional ("cs") layout
+    """
+    if layout == "l":
+        return jp(path_case, name + "_" + str(timepoint+1).zfill(2) + ".nii.gz")
+    return jp(path_case, str(timepoint+1).zfill(2), name + ".nii.gz")
+
+
+def generate_case(work_item):
+    """
+    Generate and write a synthetic case
+
+    inputs:
+    - work_item: dictionary with
+        - "key": name of the case
+        - "path_case": folder of the case
+        - "layout": "l" or "cs"
+        - "volume_shape": shape of all volumes
+        - "num_timepoints": number of timepoints
+        - "num_lesions": number of lesions
+        - "seed": random seed of the case
+        - "lesion_options" (optional): other arguments of get_lesions
+
+    outputs:
+    - key of the work item
+    """
+    rng = np.random.RandomState(work_item["seed"])
+    volume_shape = tuple(work_item["volume_shape"])
+    affine = np.eye(4)
+    brain_mask = get_brain_mask(volume_shape)
+    tissue = get_tissue(rng, brain_mask)
+    lesions = get_lesions(rng, brain_mask, work_item["num_lesions"], work_item["num_timepoints"], **work_item.get("lesion_options", {}))
+
+    for tp in range(work_item["num_timepoints"]):
+        if work_item["layout"] == "cs":
+            os.makedirs(jp(work_item["path_case"], str(tp+1).zfill(2)), exist_ok=True)
+        else:
+            os.makedirs(work_item["path_case"], exist_ok=True)
+        lesion_mask = draw_lesions(volume_shape, lesions, tp) & brain_mask
+        drift = rng.uniform(0.8, 1.2)
+        for modality in modalities:
+            nib.save(nib.Nifti1Image(get_image(rng, modality, brain_mask, tissue, lesion_mask, drift), affine),
+                     get_file_path(work_item["path_case"], modality, tp, work_item["layout"]))
+        nib.save(nib.Nifti1Image(brain_mask.astype(np.uint8), affine), get_file_path(work_item["path_case"], "brain_mask", tp, work_item["layout"]))
+        nib.save(nib.Nifti1Image(lesion_mask.astype(np.uint8), affine), get_file_path(work_item["path_case"], "mask1", tp, work_item["layout"]))
+        # second rater: slightly smaller lesions
+        nib.save(nib.Nifti1Image((draw_lesions(volume_shape, lesions, tp, scale=0.85) & brain_mask).astype(np.uint8), affine),
+                 get_file_path(work_item["path_case"], "mask2", tp, work_item["layout"]))
+    return work_item["key"]
+
+
+def generate_cohort(path_cohort, num_cases, num_timepoints=4, volume_shape=(181, 217, 181), num_lesions=(5, 30), layout="l",
+                    seed=0, num_workers=None, lesion_options=None):
+    """
+    Generate a synthetic cohort with a pool of processes
+
+    inputs:
+    - path_cohort: output folder
+    - num_cases: number of cases
+    - num_timepoints: number of timepoints of every case, or (min, max) to sample it per case
+    - volume_shape: shape of all volumes
+    - num_lesions: number of lesions of every case, or (min, max) to sample it per case
+    - layout: "l" (longitudinal) or "cs" (cross-sectional), see header
+    - seed: seed of the cohort. Case i uses seed + i
+    - num_workers: number of processes. If None, the number of CPUs is used. If 1, cases are generated serially
+    - lesion_options: other arguments of get_lesions (e.g. radius_range, new_fraction, growth_range)
+
+    outputs:
+    - list with the names of all cases
+    """
+    if layout not in ["l", "cs"]:
+        raise ValueError("Unknown layout: " + str(layout))
+    rng = np.random.RandomState(seed)
+    def sample(value):
+        return int(value) if np.isscalar(value) else int(rng.randint(value[0], value[1] + 1))
+
+    work_items = []
+    for i_case in range(num_cases):
+        case = get_case_name(i_case, num_cases)
+        work_items.append({"key": case,
+                           "path_case": jp(path_cohort, case),
+                           "layout": layout,
+                           "volume_shape": volume_shape,
+                           "num_timepoints": sample(num_timepoints),
+                           "num_lesions": sample(num_lesions),
+                           "seed": seed + i_case,
+                           "lesion_options": lesion_options or {}})
+
+    num_workers = num_workers or os.cpu_count()
+    if num_workers == 1:
+        for i_item, work_item in enumerate(work_items):
+            print("Generated", i_item+1, "/", len(work_items), generate_case(work_item))
+    else:
+        with Pool(num_workers) as pool:
+            for i_item, key in enumerate(pool.imap_unordered(generate_case, work_items)):
+                print("Generated", i_item+1, "/", len(work_items), key)
+    return [work_item["key"] for work_item in work_items]
+
+
+def parse_range(value):
+    """
+    Parse "n" or "min,max" from the command line
+    """
+    values = [int(v) for v in value.split(",")]
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic longitudinal MS cohort")
+    parser.add_argument("path_cohort", help="output folder")
+    parser.add_argument("--cases", type=int, default=3, help="number of cases")
+    parser.add_argument("--timepoints", type=parse_range, default=4, help="timepoints per case, n or min,max")
+    parser.add_argument("--shape", type=int, nargs=3, default=[181, 217, 181], help="shape of the volumes")
+    parser.add_argument("--lesions", type=parse_range, default=(5, 30), help="lesions per case, n or min,max")
+    parser.add_argument("--layout", default="l", choices=["l", "cs"], help="longitudinal or cross-sectional layout")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the cohort")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args()
+
+    generate_cohort(args.path_cohort, args.cases, args.timepoints, tuple(args.shape), args.lesions, args.layout, args.seed, args.workers)
@@ -0,0 +1,105 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with a bounded in-memory cache of preprocessed (padded and normalized) volumes
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Volumes are evicted by least-recent use once the byte budget is exceeded. CachedVolumeLoader provides the
+#               volume reading and worker initialization shared by the lazy patch loaders
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+from collections import OrderedDict
+from .preprocessing_cache import load_volume
+
+
+class VolumeCache(object):
+    """
+    Least-recently-used cache of numpy volumes with a maximum size in bytes.
+    Keys are usually tuples (case, timepoint, modality).
+    """
+
+    def __init__(self, max_bytes=2*1024**3):
+        """
+        Arguments:
+        - max_bytes: memory budget of the cache in bytes. Volumes larger than the budget are never stored
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.volumes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def __contains__(self, key):
+        return key in self.volumes
+
+    def get(self, key, load_function):
+        """
+        Return the volume stored under <key>. If it is not in the cache, <load_function> is called
+        (without arguments) to produce it and the result is stored.
+        """
+        if key in self.volumes:
+            self.hits += 1
+            self.volumes.move_to_end(key)
+            return self.volumes[key]
+
+        self.misses += 1
+        volume = load_function()
+        self.put(key, volume)
+        return volume
+
+    def put(self, key, volume):
+        """
+        Store <volume> under <key>, evicting least recently used volumes until it fits in the budget
+        """
+        if key in self.volumes:
+            self.current_bytes -= self.volumes.pop(key).nbytes
+
+        if volume.nbytes > self.max_bytes:
+            return
+
+        while self.current_bytes + volume.nbytes > self.max_bytes:
+            _, evicted = self.volumes.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+
+        self.volumes[key] = volume
+        self.current_bytes += volume.nbytes
+
+    def clear(self):
+        """
+        Remove all volumes from the cache
+        """
+        self.volumes.clear()
+        self.current_bytes = 0
+
+
+class CachedVolumeLoader(object):
+    """
+    Mixin of the lazy patch loaders (PatchLoader3D, PatchLoader3DTime, PatchLoader2D_slow). The loader sets the
+    attributes volume_cache (VolumeCache), normalize_function, patch_size, pad_or_not, norm_type and resample_epoch
+    """
+
+    def read_volume(self, path, key, normalize=False):
+        """
+        Read a volume, pad it and optionally normalize it. Results are kept in an LRU cache
+        indexed by <key> = (case, timepoint, modality)
+        """
+        def load():
+            return load_volume(path, 'float32', self.patch_size if self.pad_or_not else None,
+                               self.normalize_function if normalize else None, self.norm_type)
+
+        return self.volume_cache.get(key, load)
+
+    def init_worker(self, worker_id, num_workers):
+        """
+        Called in every DataLoader worker (see sampling.worker_init_fn). Each worker gets its own empty volume cache
+        and the memory budget is split among the workers
+        """
+        if self.resample_epoch:
+            raise ValueError("resample_epoch is not supported with num_workers > 0 (indexes would only be resampled in one worker)")
+        self.volume_cache = VolumeCache(max_bytes=self.volume_cache.max_bytes // num_workers)
@@ -8,58 +8,108 @@
 # Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
 #
 # Details:      Script built based on SITK documentation https://simpleitk.readthedocs.io/en/master/link_N4BiasFieldCorrection_docs.html
+#               The bias field is estimated on a shrunk image and the log bias field is evaluated at full resolution.
+#               Cases are processed by a pool of processes. Finished cases are written to a journal, so that a restart
+#               skips them
 #
 # --------------------------------------------------------------------------------------------------------------------
 
-import os 
+import os
 from os.path import join as jp
+from multiprocessing import Pool
 import SimpleITK as sitk
 from general.general import list_files_with_extension, list_folders
 
 path_data = r'D:\dev\CROSS_SECTIONAL3'
 number_fitting_levels = 4
 num_iterations = 100
+shrink_spacing = 4.0 # Approximate voxel size (mm) of the images used to estimate the bias field
+num_workers = 4 # Number of cases processed in parallel
+threads_per_worker = 2 # ITK threads of each process
+journal_name = "n4_journal.txt" # File in path_data with the cases that are finished
 
-#For each case, apply N4
-cases_list = list_folders(path_data)
-for case in cases_list[14:]:          
-    print("-----------------------------------")      
-    print("Current case: ", case)     
-    print("-----------------------------------")  
-    #Read images
-    flair_img = sitk.ReadImage(jp(path_data, case, "FLAIR_masked.nii.gz"))
-    t1c_img = sitk.ReadImage(jp(path_data, case, "T1_c_masked.nii.gz"))
-    t1_img = sitk.ReadImage(jp(path_data, case, "T1_masked.nii.gz"))
-    brain_mask = sitk.ReadImage(jp(path_data, case, "T1_bet_mask.nii.gz"))
-
-    #Cast images to FLoat32 (required by library)
-    caster = sitk.CastImageFilter()
-    caster.SetOutputPixelType(sitk.sitkFloat32)
-    flair_img_casted = caster.Execute(flair_img)
-    t1c_img_casted = caster.Execute(t1c_img)
-    t1_img_casted = caster.Execute(t1_img)
-    caster_mask = sitk.CastImageFilter()
-    caster_mask.SetOutputPixelType(sitk.sitkUInt8)
-    brain_mask_casted = caster_mask.Execute(brain_mask)
-    brain_mask_casted.SetOrigin((0,0,0))
-    brain_mask_casted.SetSpacing((0.9375, 0.9375, 3))
-
-    #Apply bias field correction
+modalities = [("FLAIR_masked.nii.gz", "FLAIR_masked_n4.nii.gz"),
+              ("T1_c_masked.nii.gz", "T1_c_masked_n4.nii.gz"),
+              ("T1_masked.nii.gz", "T1_masked_n4.nii.gz")]
+mask_name = "T1_bet_mask.nii.gz"
+
+
+def get_shrink_factors(image, target_spacing=shrink_spacing):
+    """
+    Shrink factor of every axis so that the voxel size of the shrunk image is close to target_spacing (at least 1)
+    """
+    return [max(1, int(round(target_spacing / s))) for s in image.GetSpacing()]
+
+
+def correct_bias_field(image, mask, shrink_factors):
+    """
+    Apply N4 to an image. The bias field is estimated on the shrunk image and mask, and then evaluated at the full
+    resolution of the image
+
+    inputs:
+    - image: sitk image (float32)
+    - mask: sitk mask (uint8) with the same physical space as the image
+    - shrink_factors: shrink factor of every axis (see get_shrink_factors)
+
+    outputs:
+    - corrected image (float32)
+    """
     corrector = sitk.N4BiasFieldCorrectionImageFilter()
     #corrector.SetMaximumNumberOfIterations(num_iterations*number_fitting_levels)
-    print("Correcting FLAIR...")
-    flair_img_corrected = corrector.Execute(flair_img_casted, brain_mask_casted)
-    print("Correcting T1_c...")
-    t1c_img_corrected = corrector.Execute(t1c_img_casted, brain_mask_casted)
-    print("Correcting T1...")
-    t1_img_corrected = corrector.Execute(t1_img_casted, brain_mask_casted)
-
-    #Copy metadata and save
-    flair_img_corrected.CopyInformation(flair_img)
-    t1c_img_corrected.CopyInformation(t1c_img)
-    t1_img_corrected.CopyInformation(t1_img)
-    sitk.WriteImage(flair_img_corrected, jp(path_data, case, "FLAIR_masked_n4.nii.gz"))
-    sitk.WriteImage(t1c_img_corrected, jp(path_data, case, "T1_c_masked_n4.nii.gz"))
-    sitk.WriteImage(t1_img_corrected, jp(path_data, case, "T1_masked_n4.nii.gz"))
-
-    
+    corrector.Execute(sitk.Shrink(image, shrink_factors), sitk.Shrink(mask, shrink_factors))
+    log_bias_field = corrector.GetLogBiasFieldAsImage(image)
+    return sitk.Cast(image / sitk.Exp(log_bias_field), sitk.sitkFloat32)
+
+
+def init_worker(num_threads):
+    """
+    Limit the number of ITK threads of each process of the pool
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def process_case(case):
+    """
+    Correct all modalities of a case. The brain mask and the shrink factors are shared by all modalities
+    """
+    brain_mask = sitk.ReadImage(jp(path_data, case, mask_name))
+    brain_mask_casted = sitk.Cast(brain_mask, sitk.sitkUInt8)
+
+    for input_name, output_name in modalities:
+        #Cast images to FLoat32 (required by library)
+        img = sitk.ReadImage(jp(path_data, case, input_name))
+        img_casted = sitk.Cast(img, sitk.sitkFloat32)
+        brain_mask_casted.CopyInformation(img_casted)
+
+        #Apply bias field correction
+        img_corrected = correct_bias_field(img_casted, brain_mask_casted, get_shrink_factors(img_casted))
+
+        #Copy metadata and save
+        img_corrected.CopyInformation(img)
+        sitk.WriteImage(img_corrected, jp(path_data, case, output_name))
+    return case
+
+
+def read_journal(journal_path):
+    """
+    Cases already finished according to the journal
+    """
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path, "r") as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+if __name__ == "__main__":
+    journal_path = jp(path_data, journal_name)
+    finished = read_journal(journal_path)
+    cases_list = [case for case in list_folders(path_data) if case not in finished]
+    print("Cases to process: ", len(cases_list), "(", len(finished), "already finished )")
+
+    #For each case, apply N4. The journal is only written by this process, after all outputs of a case are saved
+    with Pool(num_workers, initializer=init_worker, initargs=(threads_per_worker,)) as pool, open(journal_path, "a") as journal:
+        for i_case, case in enumerate(pool.imap_unordered(process_case, cases_list)):
+            journal.write(case + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            print("Finished case", case, "(", i_case+1, "/", len(cases_list), ")")
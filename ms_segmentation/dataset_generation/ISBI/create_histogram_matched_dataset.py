@@ -9,6 +9,7 @@ from os.path import join as jp
 from ms_segmentation.plot.plot import shim_slice, shim_overlay_slice, shim, shim_overlay, plot_learning_curve
 from medpy.io import load
 from ms_segmentation.data_generation.patch_manager_3d import normalize_data
+from ms_segmentation.data_generation.intensity_normalization import get_quantile_table, match_quantile_table
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
@@ -23,22 +24,15 @@ import cc3d
 path_data = r'D:\dev\ms_data\Challenges\ISBI2015\Test_Images\cross_sectional'
 path_new_data = r'D:\dev\ms_data\Challenges\ISBI2015\Test_Images\histogram_matched'
 
-def _match_cumulative_cdf(source, template):
+num_quantiles = 1024 # Size of the quantile tables used for histogram matching
+
+def _match_cumulative_cdf(source, template_table):
     """
     Return modified source array so that the cumulative density function of
-    its values matches the cumulative density function of the template.
+    its values matches the cumulative density function of the template,
+    summarized by its quantile table (computed once per reference).
     """
-    src_values, src_unique_indices, src_counts = np.unique(source.ravel(),
-                                                           return_inverse=True,
-                                                           return_counts=True)
-    tmpl_values, tmpl_counts = np.unique(template.ravel(), return_counts=True)
-
-    # calculate normalized quantiles for each array
-    src_quantiles = np.cumsum(src_counts) / source.size
-    tmpl_quantiles = np.cumsum(tmpl_counts) / template.size
-
-    interp_a_values = np.interp(src_quantiles, tmpl_quantiles, tmpl_values)
-    return interp_a_values[src_unique_indices].reshape(source.shape)
+    return match_quantile_table(source, template_table)
 
 patients = list_folders(path_data)
 
@@ -52,6 +46,7 @@ for pat in patients: # for each patient
     ref_pd = normalize_data(nib.load(jp(path_data, pat, timepoints[0], 'pd.nii.gz')).get_fdata())
     ref_t2 = normalize_data(nib.load(jp(path_data, pat, timepoints[0], 't2.nii.gz')).get_fdata())
     brain_mask_ref = nib.load(jp(path_data, pat, timepoints[0], 'brain_mask.nii.gz')).get_fdata()
+    ref_flair_table, ref_mprage_table, ref_pd_table, ref_t2_table = [get_quantile_table(r, num_quantiles) for r in [ref_flair, ref_mprage, ref_pd, ref_t2]]
     #mask1 = nib.load(jp(path_data, pat, timepoints[0], 'mask1.nii.gz')).get_fdata()
     #mask2 = nib.load(jp(path_data, pat, timepoints[0], 'mask2.nii.gz')).get_fdata()
 
@@ -74,10 +69,10 @@ for pat in patients: # for each patient
         target_t2 = normalize_data(nib.load(jp(path_data, pat, tp, 't2.nii.gz')).get_fdata())
         target_brain_mask= nib.load(jp(path_data, pat, tp, 'brain_mask.nii.gz')).get_fdata()
 
-        matched_flair = _match_cumulative_cdf(target_flair, ref_flair)
-        matched_mprage = _match_cumulative_cdf(target_mprage, ref_mprage)
-        matched_pd = _match_cumulative_cdf(target_pd, ref_pd)
-        matched_t2 = _match_cumulative_cdf(target_t2, ref_t2)
+        matched_flair = _match_cumulative_cdf(target_flair, ref_flair_table)
+        matched_mprage = _match_cumulative_cdf(target_mprage, ref_mprage_table)
+        matched_pd = _match_cumulative_cdf(target_pd, ref_pd_table)
+        matched_t2 = _match_cumulative_cdf(target_t2, ref_t2_table)
         create_folder(jp(path_new_data, pat, tp))
         save_image(matched_flair, jp(path_new_data, pat, tp, "flair.nii.gz"))
         save_image(matched_mprage, jp(path_new_data, pat, tp, "mprage.nii.gz"))
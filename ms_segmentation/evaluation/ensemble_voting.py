@@ -0,0 +1,109 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with a parallel, memory-bounded majority voting of the masks predicted by several models
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Work items are cases (or case and timepoint). The masks of all models are read one at a time with
+#               their native type and added to a vote counter, and the voted mask is written as soon as it is ready.
+#               Memory per process is one counter and one mask, independently of the number of cases and models.
+#               Work items can also use stored probability maps (soft voting, see probability_maps)
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+import nibabel as nib
+from multiprocessing import Pool
+from ..general.general import save_image
+from .probability_maps import soft_vote
+
+
+def read_mask(the_path):
+    """
+    Read a binary mask without converting it to float (nibabel's get_fdata decodes to float64)
+
+    outputs:
+    - boolean np.array, True for voxels != 0
+    """
+    return np.asanyarray(nib.load(the_path).dataobj) != 0
+
+
+def get_vote_threshold(num_models):
+    """
+    Minimum number of votes for a voxel to be positive (majority)
+    """
+    return int(np.ceil(num_models / 2))
+
+
+def vote_masks(mask_paths, threshold=None):
+    """
+    Majority voting of several masks
+
+    inputs:
+    - mask_paths: paths to the masks of all models
+    - threshold: minimum number of votes. If None, majority (see get_vote_threshold)
+
+    outputs:
+    - voted mask (uint8)
+    """
+    threshold = get_vote_threshold(len(mask_paths)) if threshold is None else threshold
+    votes = None
+    for mask_path in mask_paths:
+        mask = read_mask(mask_path)
+        if votes is None:
+            votes = np.zeros(mask.shape, dtype=np.uint8 if len(mask_paths) < 256 else np.uint16)
+        votes += mask
+    return (votes >= threshold).astype(np.uint8)
+
+
+def vote_work_item(work_item):
+    """
+    Vote the masks of one work item and save the result
+
+    inputs:
+    - work_item: dictionary with
+        - "key": identifier of the work item, e.g. (fold, timepoint) or case name
+        - "mask_paths": paths to the masks predicted by all models
+        - "probability_paths": instead of "mask_paths", paths to the probability maps of all models (soft voting)
+        - "output_path": path where the voted mask is saved
+        - "threshold" (optional): minimum number of votes (majority by default) or, for soft voting, threshold of the
+                                  mean probability (0.5 by default)
+
+    outputs:
+    - key of the work item
+    """
+    if "probability_paths" in work_item:
+        voted = soft_vote(work_item["probability_paths"], work_item.get("threshold", 0.5))
+    else:
+        voted = vote_masks(work_item["mask_paths"], work_item.get("threshold", None))
+    save_image(voted, work_item["output_path"])
+    return work_item["key"]
+
+
+def run_ensemble(work_items, num_workers=None):
+    """
+    Vote all work items with a pool of processes
+
+    inputs:
+    - work_items: list of work items (see vote_work_item)
+    - num_workers: number of processes. If None, the number of CPUs is used. If 1, items are voted serially
+
+    outputs:
+    - list with the keys of the voted work items, in order of completion
+    """
+    num_workers = num_workers or os.cpu_count()
+    done = []
+    if num_workers == 1:
+        for i_item, work_item in enumerate(work_items):
+            done.append(vote_work_item(work_item))
+            print("Voted", i_item+1, "/", len(work_items), done[-1])
+        return done
+
+    with Pool(num_workers) as pool:
+        for i_item, key in enumerate(pool.imap_unordered(vote_work_item, work_items)):
+            done.append(key)
+            print("Voted", i_item+1, "/", len(work_items), key)
+    return done
@@ -0,0 +1,127 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with a parallel runner for the evaluation of several experiments against the ground truth
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Work items are (gt, patient, timepoint). Each GT volume is loaded once and all experiments are
+#               evaluated against it in the same worker. Results are written once per experiment and GT
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from multiprocessing import Pool
+from os.path import join as jp
+from .metrics import compute_metrics
+from .postprocessing import remove_small_regions, get_voxel_volume
+from .probability_maps import load_probability_map, threshold_probability_map
+
+
+def evaluate_work_item(work_item):
+    """
+    Evaluate all experiments of a work item against the same GT volume
+
+    inputs:
+    - work_item: dictionary with
+        - "key": identifier of the work item, e.g. (gt_name, patient, timepoint)
+        - "gt_path": path to the GT mask
+        - "predictions": list of (experiment, path to the predicted mask). Paths to stored probability maps (.npy, see
+                         probability_maps) are thresholded with "probability_threshold" (optional, 0.5 by default)
+        - "post_processing": None or 'remove_small'
+        - "min_area", "inclusive": parameters of the post-processing (see postprocessing.remove_small_regions)
+        - "min_area_mm3" (optional): if True, min_area is a volume in mm3 computed from the header of the prediction
+
+    outputs:
+    - key of the work item and list of (experiment, list with the values of all metrics)
+    """
+    gt_nifti = nib.load(work_item["gt_path"])
+    gt_img = gt_nifti.get_fdata().astype(np.uint8)
+
+    results = []
+    for experiment, pred_path in work_item["predictions"]:
+        if pred_path.endswith(".npy"):
+            pred_nifti = gt_nifti # probability maps have no header, the one of the GT is used
+            pred_img = threshold_probability_map(load_probability_map(pred_path), work_item.get("probability_threshold", 0.5))
+        else:
+            pred_nifti = nib.load(pred_path)
+            pred_img = pred_nifti.get_fdata().astype(np.uint8)
+        if work_item["post_processing"] is not None:
+            if work_item["post_processing"] == 'remove_small':
+                voxel_volume = get_voxel_volume(pred_nifti) if work_item.get("min_area_mm3", False) else None
+                pred_img = remove_small_regions(pred_img, work_item["min_area"], work_item["inclusive"], voxel_volume=voxel_volume)
+            else:
+                raise ValueError('Unknown post-processing type')
+        metrics = compute_metrics(gt_img, pred_img) #Dictionary with all metrics
+        results.append((experiment, list(metrics.values())))
+    return work_item["key"], results
+
+
+def run_evaluation(work_items, num_workers=None):
+    """
+    Evaluate all work items with a pool of processes
+
+    inputs:
+    - work_items: list of work items (see evaluate_work_item)
+    - num_workers: number of processes. If None, the number of CPUs is used. If 1, items are evaluated serially
+
+    outputs:
+    - dictionary {key of the work item: list of (experiment, metric values)}
+    """
+    num_workers = num_workers or os.cpu_count()
+    results = {}
+    if num_workers == 1:
+        for i_item, work_item in enumerate(work_items):
+            key, item_results = evaluate_work_item(work_item)
+            results[key] = item_results
+            print("Evaluated", i_item+1, "/", len(work_items), key)
+        return results
+
+    with Pool(num_workers) as pool:
+        for i_item, (key, item_results) in enumerate(pool.imap_unordered(evaluate_work_item, work_items)):
+            results[key] = item_results
+            print("Evaluated", i_item+1, "/", len(work_items), key)
+    return results
+
+
+def write_result_tables(results, work_items, exp_folders, gt_name, post_processing):
+    """
+    Write the csv files of all experiments for one GT. Each table is built once from the collected rows
+
+    inputs:
+    - results: output of run_evaluation
+    - work_items: work items used in run_evaluation. Keys must be (gt_name, patient, timepoint). Their order
+                  defines the order of the rows
+    - exp_folders: folder that contains all experiments
+    - gt_name: name of the GT (e.g. mask1), used for the file names
+    - post_processing: whether post-processing was applied (changes the file names)
+    """
+    labels_for_df = compute_metrics(None, None, labels_only = True)
+    if post_processing:
+        timepoint_filename = "results_postprocessed_" + gt_name + ".csv"
+    else:
+        timepoint_filename = "results_" + gt_name + ".csv"
+
+    # columnar collection: experiment -> patient -> rows, in work item order
+    rows = {}
+    for work_item in work_items:
+        gt_curr, patient, _ = work_item["key"]
+        if gt_curr != gt_name:
+            continue
+        for experiment, values in results[work_item["key"]]:
+            rows.setdefault(experiment, {}).setdefault(patient, []).append(values)
+
+    for experiment, patient_rows in rows.items():
+        experiment_folder = jp(exp_folders, experiment)
+        for patient, values in patient_rows.items():
+            patient_df = pd.DataFrame(values, columns = labels_for_df)
+            patient_df.loc[len(patient_df)] = list(patient_df.mean())
+            patient_df.to_csv(jp(experiment_folder, "fold"+patient, timepoint_filename), float_format = '%.5f', index = False)
+
+        global_df = pd.DataFrame([v for values in patient_rows.values() for v in values], columns = labels_for_df)
+        global_df.loc[len(global_df)] = list(global_df.mean())
+        global_df.to_csv(jp(experiment_folder, "all_" + timepoint_filename), float_format = '%.5f', index = False)
@@ -13,11 +13,64 @@
 
 import numpy as np 
 import SimpleITK as sitk
-from sklearn.metrics import jaccard_score as jsc
-from sklearn.metrics import confusion_matrix
 from scipy.ndimage import label
 from scipy.ndimage import labeled_comprehension as lc
 
+def compute_confusion_counts(gt, pred):
+  """Function to compute the voxel-wise confusion counts between two binary volumes in a single pass
+  
+  Parameters
+  ----------
+  gt : numpy array
+      Ground truth volume. Must have dtype=np.uint8
+  pred : numpy array
+      Predicted segmentation. Must have dtype=np.uint8
+  
+  Returns
+  -------
+  tuple
+      (tn, fp, fn, tp) as integers
+  """
+  # each voxel is encoded as 2*gt + pred, so that bins are 0: tn, 1: fp, 2: fn, 3: tp
+  codes = 2*(np.ravel(gt) > 0).astype(np.uint8) + (np.ravel(pred) > 0)
+  tn, fp, fn, tp = np.bincount(codes, minlength=4)
+  return int(tn), int(fp), int(fn), int(tp)
+
+
+def compute_lesion_counts(gt, pred):
+  """Function to compute the lesion-wise counts between two binary volumes. GT and prediction are labeled
+  only once
+  
+  Parameters
+  ----------
+  gt : numpy array
+      Ground truth volume. Must have dtype=np.uint8
+  pred : numpy array
+      Predicted segmentation. Must have dtype=np.uint8
+  
+  Returns
+  -------
+  dict
+      number of GT regions ("num_gt"), number of predicted regions ("num_pred"), GT regions that overlap with
+      the prediction ("ltp") and predicted regions that do not overlap with the GT ("lfp")
+  """
+  gt_bool = gt > 0
+  pred_bool = pred > 0
+  gt_regions, num_gt = label(gt_bool)
+  pred_regions, num_pred = label(pred_bool)
+
+  # regions hit by at least one voxel of the other mask
+  gt_hit = np.bincount(gt_regions[pred_bool], minlength=num_gt+1)[1:] > 0
+  pred_hit = np.bincount(pred_regions[gt_bool], minlength=num_pred+1)[1:] > 0
+
+  return {"num_gt": num_gt, "num_pred": num_pred, "ltp": int(np.sum(gt_hit)), "lfp": int(num_pred - np.sum(pred_hit))}
+
+
+def safe_division(num, den):
+  """Division that returns NaN instead of raising when the denominator is 0"""
+  return float(num)/den if den != 0 else float('nan')
+
+
 #Dice score
 def compute_dices(gt, pred):
   """Function to compute the Dice score (DSC) between two 3d binary volumes
@@ -95,8 +148,8 @@ def compute_jaccard(gt, pred):
   float
       Value of the Jaccard index
   """
-  jaccard = jsc(pred.flatten(), gt.flatten(), average = 'binary')
-  return jaccard
+  _, fp, fn, tp = compute_confusion_counts(gt, pred)
+  return float(tp)/(tp + fp + fn) if tp + fp + fn > 0 else 0.0
 
 def compute_tpr(gt, pred):
   """Function to compute voxel-wise TPR between two binary volumes
@@ -113,8 +166,8 @@ def compute_tpr(gt, pred):
   float
       TPR
   """
-  _, _, fn, tp = confusion_matrix(gt.flatten(), pred.flatten()).ravel()
-  return tp/(tp+fn)
+  _, _, fn, tp = compute_confusion_counts(gt, pred)
+  return safe_division(tp, tp+fn)
 
 def compute_fpr(gt, pred):
   """Function to compute voxel-wise FPR between two binary volumes
@@ -131,8 +184,8 @@ def compute_fpr(gt, pred):
   float
       FPR
   """
-  tn, fp, _, _ = confusion_matrix(gt.flatten(), pred.flatten()).ravel()
-  return fp/(fp+tn)
+  tn, fp, _, _ = compute_confusion_counts(gt, pred)
+  return safe_division(fp, fp+tn)
 
 def compute_ppv(gt, pred):
   """Function to compute the positive predictive value from two binary segmentations
@@ -149,8 +202,8 @@ def compute_ppv(gt, pred):
   [type]
       [description]
   """
-  _, fp, _, tp = confusion_matrix(gt.flatten(), pred.flatten()).ravel()
-  return tp/(tp+fp)
+  _, fp, _, tp = compute_confusion_counts(gt, pred)
+  return safe_division(tp, tp+fp)
 
 def compute_volumetric_difference(gt, pred):
   """Function to compute the volumetric difference between two segmentation results. Only for binary masks
@@ -187,8 +240,8 @@ def compute_f2_score(gt, pred):
   float
       Value of the F2 score
   """
-  tn, fp, fn, tp = confusion_matrix(gt.flatten(), pred.flatten()).ravel()
-  return 5*tp/(5*tp + 4*fn + fp)
+  _, fp, fn, tp = compute_confusion_counts(gt, pred)
+  return safe_division(5*tp, 5*tp + 4*fn + fp)
 
 
 def num_regions(mask):
@@ -273,10 +326,9 @@ def compute_ltpr(gt, pred):
       [description]
   """
 
-  TP = compute_ltp(gt, pred)
-  number_of_regions = num_regions(gt)
+  lesions = compute_lesion_counts(gt, pred)
 
-  return float(TP) / number_of_regions
+  return safe_division(lesions["ltp"], lesions["num_gt"])
 
 
 def compute_lfpr(gt, pred):
@@ -296,10 +348,9 @@ def compute_lfpr(gt, pred):
       [description]
   """
 
-  FP = compute_lfp(gt, pred)
-  number_of_regions = num_regions(pred)
+  lesions = compute_lesion_counts(gt, pred)
 
-  return float(FP) / number_of_regions if number_of_regions > 0 else 0
+  return float(lesions["lfp"]) / lesions["num_pred"] if lesions["num_pred"] > 0 else 0
 
 
 
@@ -323,16 +374,22 @@ def compute_metrics(gt, pred, labels_only = False):
   """
   if labels_only:
     return ["DSC","JACCARD","HD","TPR","FPR", "PPV", "AVD","F2","LTPR","LFPR"]
+  # shared intermediates: one confusion pass and one labeling of each volume
+  tn, fp, fn, tp = compute_confusion_counts(gt, pred)
+  lesions = compute_lesion_counts(gt, pred)
+  vol_gt = tp + fn
+  vol_pred = tp + fp
+
   metrics = {}
-  metrics["DSC"] = compute_dices(gt, pred)[0]
-  metrics["JACCARD"] = compute_jaccard(gt, pred)
+  metrics["DSC"] = safe_division(2*tp, vol_gt + vol_pred) if vol_gt > 0 else 0.0
+  metrics["JACCARD"] = float(tp)/(tp + fp + fn) if tp + fp + fn > 0 else 0.0
   metrics["HD"] = compute_hausdorf(gt, pred)[0]
-  metrics["TPR"] = compute_tpr(gt, pred)
-  metrics["FPR"] = compute_fpr(gt, pred)
-  metrics["PPV"] = compute_ppv(gt, pred)
-  metrics["AVD"] = compute_volumetric_difference(gt, pred)
-  metrics["F2"] = compute_f2_score(gt, pred)
-  metrics["LTPR"] = compute_ltpr(gt, pred)
-  metrics["LFPR"] = compute_lfpr(gt, pred)
+  metrics["TPR"] = safe_division(tp, tp+fn)
+  metrics["FPR"] = safe_division(fp, fp+tn)
+  metrics["PPV"] = safe_division(tp, tp+fp)
+  metrics["AVD"] = safe_division(100*np.abs(vol_pred - vol_gt), vol_gt)
+  metrics["F2"] = safe_division(5*tp, 5*tp + 4*fn + fp)
+  metrics["LTPR"] = safe_division(lesions["ltp"], lesions["num_gt"])
+  metrics["LFPR"] = float(lesions["lfp"]) / lesions["num_pred"] if lesions["num_pred"] > 0 else 0
 
   return metrics
\ No newline at end of file
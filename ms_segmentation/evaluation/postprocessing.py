@@ -0,0 +1,79 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script with post-processing of segmentation masks (removal of small lesions)
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      Component sizes are obtained with a single bincount over the label image and the mask of kept
+#               components is built with a lookup table, so the cost does not depend on the number of components
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import numpy as np
+import cc3d
+
+
+def get_voxel_volume(nifti_image):
+    """Function to get the volume of a voxel in mm3 from the header of a NIfTI image
+
+    Parameters
+    ----------
+    nifti_image : nibabel image
+        Image loaded with nib.load
+
+    Returns
+    -------
+    float
+        Volume of one voxel in mm3
+    """
+    return float(np.prod(nifti_image.header.get_zooms()[:3]))
+
+
+def get_component_sizes(labels_out):
+    """Function to get the number of voxels of every connected component
+
+    Parameters
+    ----------
+    labels_out : numpy array
+        Label image (e.g. output of cc3d.connected_components). 0 is background
+
+    Returns
+    -------
+    numpy array
+        Array with the size of component i at position i
+    """
+    return np.bincount(labels_out.ravel())
+
+
+def remove_small_regions(segmentation, min_area=3, inclusive=False, voxel_volume=None, connectivity=26):
+    """Function to remove connected components (lesions) smaller than a minimum size
+
+    Parameters
+    ----------
+    segmentation : numpy array
+        Binary segmentation. Must have dtype=np.uint8
+    min_area : int or float, optional
+        Minimum size of a lesion. Number of voxels, or mm3 if voxel_volume is provided, by default 3
+    inclusive : bool, optional
+        If True, lesions with a size equal to min_area are also removed, by default False
+    voxel_volume : float, optional
+        Volume of one voxel in mm3 (see get_voxel_volume). If None, min_area is a number of voxels
+    connectivity : int, optional
+        Connectivity of the components (6, 18 or 26), by default 26
+
+    Returns
+    -------
+    numpy array
+        Post-processed segmentation with the same dtype as the input
+    """
+    labels_out = cc3d.connected_components(segmentation, connectivity=connectivity)
+    sizes = get_component_sizes(labels_out).astype(np.float64)
+    if voxel_volume is not None:
+        sizes *= voxel_volume
+
+    # lookup table: 1 for components that are kept, 0 for removed ones and for the background
+    keep = (sizes > min_area) if inclusive else (sizes >= min_area)
+    keep[0] = False
+    return segmentation * keep.astype(segmentation.dtype)[labels_out]
@@ -0,0 +1,148 @@
+# --------------------------------------------------------------------------------------------------------------------
+#
+# Project:      MS lesion segmentation (master thesis)
+#
+# Description:  Script to persist lesion probability maps, so that ensembles and thresholds can be changed without
+#               running inference again
+#
+# Author:       Sergio Tascon Morales (Research intern at mediri GmbH, student of Master in Medical Imaging and Applications - MAIA)
+#
+# Details:      The probability of the lesion class is stored as a .npy file per case and timepoint, quantized to uint8
+#               (probability * 255) or stored as float16. Files are read back as memory maps. Thresholding and soft
+#               voting work directly on the stored values (for uint8 maps, with integer arithmetic)
+#
+# --------------------------------------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+from os.path import join as jp
+
+supported_dtypes = {"uint8": 255.0, "float16": 1.0} # stored type -> scale of the stored values (probability 1)
+
+
+def get_scale(dtype):
+    """
+    Value that represents probability 1 for maps stored with type <dtype>
+    """
+    dtype = np.dtype(dtype).name
+    if dtype not in supported_dtypes:
+        raise ValueError("Unsupported type for probability maps: " + dtype)
+    return supported_dtypes[dtype]
+
+
+def quantize_probabilities(probs, dtype="uint8"):
+    """
+    Convert probabilities in [0, 1] to the stored type
+
+    inputs:
+    - probs: np.array with probabilities (e.g. all_probs[..., 1] for the lesion class)
+    - dtype: 'uint8' (probability * 255, rounded) or 'float16'
+
+    outputs:
+    - quantized probabilities
+    """
+    scale = get_scale(dtype)
+    if np.dtype(dtype) == np.uint8:
+        return np.round(np.clip(probs, 0, 1) * scale).astype(np.uint8)
+    return np.asarray(probs).astype(dtype)
+
+
+def dequantize_probabilities(stored):
+    """
+    Convert stored probabilities back to float32 probabilities in [0, 1]
+    """
+    return stored.astype(np.float32) / np.float32(get_scale(stored.dtype))
+
+
+def get_probability_map_path(the_path, case, timepoint):
+    """
+    Path of the probability map of a case and timepoint in folder <the_path>
+    """
+    return jp(the_path, str(case) + "_" + str(timepoint).zfill(2) + "_probs.npy")
+
+
+def save_probability_map(probs, the_path, case, timepoint, dtype="uint8"):
+    """
+    Save the lesion probabilities of a case and timepoint
+
+    inputs:
+    - probs: np.array (x, y, z) with the probabilities of the lesion class
+    - the_path: folder where probability maps are stored
+    - case: case identifier
+    - timepoint: timepoint (int, starting at 1, or string)
+    - dtype: stored type (see quantize_probabilities)
+
+    outputs:
+    - path of the saved file
+    """
+    if not os.path.exists(the_path):
+        os.makedirs(the_path)
+    map_path = get_probability_map_path(the_path, case, timepoint)
+    # write to a temporary file first, so that readers never see a partial map
+    tmp_path = map_path[:-4] + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, quantize_probabilities(probs, dtype))
+    os.replace(tmp_path, map_path)
+    return map_path
+
+
+def save_member_probability_maps(all_probs, the_path, members, case, timepoint, dtype="uint8", num_classes=2):
+    """
+    Save the lesion probabilities of every member of an ensemble run with keep_members (see ModelEnsemble)
+
+    inputs:
+    - all_probs: np.array (x, y, z, num_members*num_classes) with the reconstructed outputs of all members
+    - the_path: folder where the probability maps of every member are stored, in subfolder <member>
+    - members: names of the members (e.g. folds)
+    - case, timepoint, dtype: see save_probability_map
+    - num_classes: number of classes of every member
+
+    outputs:
+    - np.array (x, y, z, num_classes) with the probabilities of the ensemble (average of the members)
+    """
+    member_probs = all_probs.reshape(all_probs.shape[:-1] + (len(members), num_classes))
+    for i_member, member in enumerate(members):
+        save_probability_map(member_probs[..., i_member, 1], jp(the_path, member), case, timepoint, dtype)
+    return member_probs.mean(axis=-2)
+
+
+def load_probability_map(map_path):
+    """
+    Read a stored probability map as a read-only memory map (stored type, see dequantize_probabilities)
+    """
+    return np.load(map_path, mmap_mode='r')
+
+
+def threshold_probability_map(stored, threshold=0.5):
+    """
+    Binary mask of the voxels with probability > threshold (threshold 0.5 is the argmax of two classes). The
+    comparison is done on the stored values
+
+    outputs:
+    - mask (uint8)
+    """
+    return (stored > np.float64(threshold * get_scale(stored.dtype))).astype(np.uint8) # not compared in float16
+
+
+def soft_vote(map_paths, threshold=0.5):
+    """
+    Soft voting: mask of the voxels whose mean probability over all maps is > threshold. Maps are read one at a time,
+    so memory does not depend on the number of maps
+
+    inputs:
+    - map_paths: paths to the probability maps of all models (same stored type)
+    - threshold: threshold for the mean probability
+
+    outputs:
+    - voted mask (uint8)
+    """
+    total = None
+    for map_path in map_paths:
+        stored = load_probability_map(map_path)
+        if total is None:
+            dtype = stored.dtype
+            total = np.zeros(stored.shape, dtype=np.uint16 if dtype == np.uint8 and len(map_paths) <= 257 else np.float32)
+        elif stored.dtype != dtype:
+            raise ValueError("All probability maps must have the same type")
+        total += stored
+    return (total > np.float64(threshold * get_scale(dtype) * len(map_paths))).astype(np.uint8)
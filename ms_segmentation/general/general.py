@@ -11,6 +11,7 @@
 # --------------------------------------------------------------------------------------------------------------------
 
 import os
+import sys
 import glob
 import nibabel as nib
 import numpy as np
@@ -248,9 +249,14 @@ def expand_dictionary(input_dict):
     return output_dict
 
 def cls():
-    """Function to clear the console
+    """Function to clear the console. Nothing is done if the output is not a console (e.g. redirected to a file)
     """
-    os.system('cls||clear')
+    if not sys.stdout.isatty():
+        return
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        print("\033[2J\033[H", end="", flush=True) # ANSI escape codes, no shell is started
 
 def save_this(elems_to_save, the_path, filename):
     """Function to save objects using pickle
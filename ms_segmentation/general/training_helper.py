@@ -10,6 +10,8 @@
 #
 # --------------------------------------------------------------------------------------------------------------------
 import os
+import json
+import time
 import torch
 import random
 import numpy as np
@@ -63,6 +65,159 @@ class EarlyStopping:
         self.val_loss_min = val_loss
 
 
+class TrainingTimer:
+    """Time spent in each stage of the training loop (data, host-to-device copy, forward, loss, backward, optimizer
+    step, metrics), with the number of patches per second of each epoch. One JSON line per epoch and phase is appended
+    to a log file, so it can be seen whether a configuration is I/O-bound or compute-bound.
+
+    Usage:
+        timer.start("training", fold=fold, epoch=epoch)
+        for b_t, (data, target) in enumerate(timer.iterate(training_dataloader)): # waiting time -> "data"
+            x = data.to(device)
+            timer.lap("to_device") # time since the previous lap
+            ...
+        timer.stop()
+    """
+    def __init__(self, log_path=None, device=None, synchronize=True, enabled=True):
+        """
+        Args:
+            log_path (str): JSON lines file where the results of every epoch and phase are appended. If None, results
+                            are only printed
+            device (torch.device): device of the model
+            synchronize (bool): If True and the device is a GPU, wait for all queued kernels at every lap, so that
+                            their time is assigned to the right stage
+            enabled (bool): If False, all methods do nothing
+        """
+        self.log_path = log_path
+        self.synchronize = synchronize and device is not None and torch.device(device).type == 'cuda'
+        self.enabled = enabled
+        self.phase = None
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self, phase, **info):
+        """Start timing a phase (e.g. training or validation) of an epoch. <info> is added to the log (e.g. fold, epoch)"""
+        if not self.enabled:
+            return
+        self.phase = phase
+        self.info = info
+        self.stages = {}
+        self.num_batches = 0
+        self.num_patches = 0
+        self.start_time = self.last_time = self.now()
+
+    def lap(self, stage):
+        """Add the time since the previous lap to <stage>"""
+        if not self.enabled:
+            return
+        current_time = self.now()
+        self.stages[stage] = self.stages.get(stage, 0.0) + current_time - self.last_time
+        self.last_time = current_time
+
+    def iterate(self, dataloader, last_stage="metrics"):
+        """Iterate over a dataloader. The time waiting for each batch is assigned to "data" and the time between the
+        last lap of a batch and the request of the next batch to <last_stage>. Patches are counted from the first
+        element of each batch"""
+        if not self.enabled:
+            yield from dataloader
+            return
+        iterator = iter(dataloader)
+        while True:
+            if self.num_batches > 0:
+                self.lap(last_stage)
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.lap("data")
+            self.num_batches += 1
+            self.num_patches += len(batch[0])
+            yield batch
+
+    def stop(self, **extra):
+        """Finish the current phase, print a summary and append it to the log. <extra> is added to the log
+
+        Returns:
+            dictionary with the results of the phase (None if disabled)
+        """
+        if not self.enabled or self.phase is None:
+            return None
+        total_time = self.now() - self.start_time
+        stages = dict(self.stages, other=max(0.0, total_time - sum(self.stages.values())))
+        record = dict(self.info, phase=self.phase, batches=self.num_batches, patches=self.num_patches, time=total_time,
+                      patches_per_second=self.num_patches / total_time if total_time > 0 else 0.0,
+                      stages=stages, percentages={k: 100 * v / total_time if total_time > 0 else 0.0 for k, v in stages.items()})
+        record.update(extra)
+        self.phase = None
+
+        print("{}: {:.1f} patches/s ({} patches, {:.1f} s) - ".format(record["phase"], record["patches_per_second"], record["patches"], total_time) +
+                ", ".join("{} {:.1f} %".format(k, v) for k, v in record["percentages"].items()))
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+
+class SegmentationMetrics:
+    """Accumulate the confusion counts (TP, FP, FN, TN) of binary segmentations over an epoch. Counts are kept as a
+    tensor on the device of the predictions and updated with tensor operations, so no batch is copied to the host.
+    Scores (Jaccard, Dice, ...) are computed from the counts of the whole epoch (not averaged over batches)."""
+    def __init__(self, device=None):
+        """
+        Args:
+            device (torch.device): device of the predictions. If None, it is taken from the first batch
+        """
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        """Set all counts to zero (e.g. at the beginning of every epoch)"""
+        self.counts = None if self.device is None else torch.zeros(4, dtype=torch.int64, device=self.device)
+
+    def update(self, pred, target):
+        """Add the counts of a batch
+
+        Args:
+            pred (tensor): class probabilities (batch_size, num_classes, ...). The predicted label is the argmax
+            target (tensor): ground truth with the same number of voxels (e.g. (batch_size, 1, ...)). Voxels != 0 are positive
+
+        Returns:
+            tensor with the counts (TP, FP, FN, TN) of the batch, on the device of the predictions
+        """
+        with torch.no_grad():
+            labels = pred.argmax(dim=1) != 0
+            target = target.reshape(labels.shape) != 0
+            tp = (labels & target).sum()
+            fp = labels.sum() - tp
+            fn = target.sum() - tp
+            batch_counts = torch.stack([tp, fp, fn, labels.numel() - tp - fp - fn])
+            if self.counts is None:
+                self.counts = torch.zeros(4, dtype=torch.int64, device=batch_counts.device)
+            self.counts += batch_counts
+        return batch_counts
+
+    def get_scores(self, counts=None):
+        """Scores computed from <counts> (by default, the accumulated counts). Only here are the counts copied to the host
+
+        Returns:
+            dictionary with jaccard, dice, tpr, ppv and accuracy. A score whose denominator is 0 is 0
+        """
+        counts = self.counts if counts is None else counts
+        if counts is None:
+            counts = torch.zeros(4, dtype=torch.int64)
+        tp, fp, fn, tn = [int(c) for c in counts.cpu()]
+        def division(num, den):
+            return num / den if den > 0 else 0.0
+        return {"jaccard": division(tp, tp + fp + fn),
+                "dice": division(2*tp, 2*tp + fp + fn),
+                "tpr": division(tp, tp + fn),
+                "ppv": division(tp, tp + fp),
+                "accuracy": division(tp + tn, tp + fp + fn + tn)}
+
+
 def exp_lr_scheduler(optimizer, epoch, init_lr=0.001, lr_decay_epoch=7):
     """Decay learning rate by a factor of 0.1 every lr_decay_epoch epochs."""
     lr = init_lr * (0.1**(epoch // lr_decay_epoch))
@@ -21,10 +21,11 @@ from ms_segmentation.general.general import get_groups, parse_log_file, create_f
 from os.path import join as jp
 from ms_segmentation.plot.plot import shim_slice, shim_overlay_slice, shim, shim_overlay, plot_learning_curve
 from medpy.io import load
-from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
+from ms_segmentation.data_generation.patch_manager_3d import PatchLoader3DLoadAll, build_image, get_inference_patches, reconstruct_image, reconstruct_image_multiclass, RandomFlipX, RandomFlipY, RandomFlipZ, ToTensor3DPatch
 from ms_segmentation.architectures.unet3d import UNet_3D_alt, UNet_3D_double_skip_hybrid
 from ms_segmentation.architectures.unet_c_gru import UNet_ConvGRU_3D_1, UNet_ConvLSTM_3D_alt, UNet_ConvLSTM_3D_alt_bidirectional
 from ms_segmentation.architectures.cnn1 import CNN1, CNN2
+from ms_segmentation.architectures.ensemble import load_ensemble
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 from torch.optim import Adadelta, Adam
@@ -34,7 +35,9 @@ from sklearn.metrics import jaccard_score as jsc
 from sklearn.metrics import accuracy_score as acc
 from ms_segmentation.evaluation.metrics import compute_metrics
 from torch.optim import Adadelta, Adam
-import cc3d
+from ms_segmentation.evaluation.postprocessing import remove_small_regions
+from ms_segmentation.data_generation.streaming_inference import load_inference_block, stream_inference, stream_inference_windows, get_time_window
+from ms_segmentation.evaluation.probability_maps import save_member_probability_maps
 
 # Name of experiment to evaluate
 experiment_name = 'CROSS_VALIDATION_UNet3D_2020-06-25_07_07_15[chi-square_norm_train]'
@@ -58,6 +61,9 @@ else:
 
 create_folder(path_results)
 use_gpu = True
+streaming_inference = True # gather patches batch by batch from the loaded volumes instead of extracting all patches of a case
+save_probabilities = None # type of the stored lesion probability maps of every fold (None, 'uint8' or 'float16'), to re-ensemble or re-threshold without inference. Maps are stored per fold, also with fold_ensemble
+fold_ensemble = False # if True, run all selected folds together on the same patches (probabilities averaged) instead of one pass per fold and majority voting
 
 def get_result_name(the_paths, the_base):
     accum = 0
@@ -79,7 +85,7 @@ case_index = 0
 post_processing = True
 min_area = 3
 selection = {"fold01": True, "fold02": True, "fold03": True, "fold04": True, "fold05": True}
-if list(selection.values()).count(True)%2 == 0:
+if list(selection.values()).count(True)%2 == 0 and not fold_ensemble:
     raise Exception("Number of folds to consider should be odd") 
 
 
@@ -128,17 +134,19 @@ if experiment_type == 'cs': # if experiment is cross-sectional
     parameters_dict = parse_log_file(jp(path_exp, folds[0])) # take file of first fold as reference
 
     all_folds = []
-    
-    for f in folds:
-        if selection[f] == False:
-            continue
-        fold_segmentations = []
-        # create model
-        lesion_model = eval(parameters_dict["model_name"])(n_channels=len(eval(parameters_dict['input_data'])), n_classes=2, bilinear = False)
-        lesion_model.cuda()
 
-        # try to load the weights
-        lesion_model.load_state_dict(torch.load(jp(path_exp, f, "models","checkpoint.pt")))
+    # groups of folds that are run together. With fold_ensemble, a single group with all selected folds
+    selected_folds = [f for f in folds if selection[f]]
+    model_groups = [selected_folds] if fold_ensemble else [[f] for f in selected_folds]
+
+    for group in model_groups:
+        f = group[0] if len(group) == 1 else "ensemble"
+        fold_segmentations = []
+        num_outputs = 2*len(group) if save_probabilities is not None else 2 # with stored maps, the outputs of every model of the group are kept
+        # create model(s) and load the weights. The outputs of all models of the group are averaged batch by batch
+        lesion_model = load_ensemble(eval(parameters_dict["model_name"]), [jp(path_exp, g, "models","checkpoint.pt") for g in group], device,
+                                     keep_members=save_probabilities is not None,
+                                     n_channels=len(eval(parameters_dict['input_data'])), n_classes=2, bilinear = False)
 
         test_images = list_folders(path_test_cs) # all test cases
 
@@ -155,36 +163,47 @@ if experiment_type == 'cs': # if experiment is cross-sectional
             timepoints = list_folders(path_timepoints)    
             
             # get candidate voxels
-            all_infer_patches, all_coordenates = get_inference_patches( path_test=path_test,
-                                                                case = case,
-                                                                input_data=eval(parameters_dict['input_data']),
-                                                                roi=parameters_dict['brain_mask'],
-                                                                patch_shape=eval(parameters_dict['patch_size']),
-                                                                step=eval(parameters_dict['sampling_step']),
-                                                                normalize=eval(parameters_dict['normalize']),
-                                                                norm_type = parameters_dict["norm_type"],
-                                                                mode = "cs"
-                                                                )
+            if streaming_inference:
+                all_blocks, all_coordenates = load_inference_block(path_test=path_test,
+                                                                   case = case,
+                                                                   input_data=eval(parameters_dict['input_data']),
+                                                                   roi=parameters_dict['brain_mask'],
+                                                                   patch_shape=eval(parameters_dict['patch_size']),
+                                                                   step=eval(parameters_dict['sampling_step']),
+                                                                   normalize=eval(parameters_dict['normalize']),
+                                                                   norm_type = parameters_dict["norm_type"],
+                                                                   mode = "cs")
+            else:
+                all_infer_patches, all_coordenates = get_inference_patches(path_test=path_test,
+                                                                           case = case,
+                                                                           input_data=eval(parameters_dict['input_data']),
+                                                                           roi=parameters_dict['brain_mask'],
+                                                                           patch_shape=eval(parameters_dict['patch_size']),
+                                                                           step=eval(parameters_dict['sampling_step']),
+                                                                           normalize=eval(parameters_dict['normalize']),
+                                                                           norm_type = parameters_dict["norm_type"],
+                                                                           mode = "cs")
                 
             for tp in range(len(timepoints)):
                 cls()
                 print("Fold: ", f)
                 print("Patient", cnt+1, "/", len(test_images))
                 print("Timepoint ", tp+1)
-                infer_patches = all_infer_patches[tp]
                 coordenates = all_coordenates[tp]
-                scan_path = jp(path_test, case, str(tp+1).zfill(2))
-                aux_dict = {'batch_size': eval(parameters_dict['batch_size'])}
-                lesion_out = build_image(infer_patches, lesion_model, device, 2, aux_dict)
-
-                scan_numpy = nib.load(jp(scan_path, parameters_dict['brain_mask'])).get_fdata()
-                all_probs = np.zeros((scan_numpy.shape[0], scan_numpy.shape[1], scan_numpy.shape[2], 2))
-
-                for i in range(2): #2 classes
-                    all_probs[:,:,:,i] = reconstruct_image(lesion_out[:,i], 
-                                                    coordenates, 
-                                                    scan_numpy.shape)
+                if streaming_inference:
+                    all_probs = stream_inference(lesion_model, device, all_blocks[tp], coordenates, eval(parameters_dict['patch_size']),
+                                                    num_outputs, eval(parameters_dict['batch_size']))
+                else:
+                    infer_patches = all_infer_patches[tp]
+                    scan_path = jp(path_test, case, str(tp+1).zfill(2))
+                    aux_dict = {'batch_size': eval(parameters_dict['batch_size'])}
+                    lesion_out = build_image(infer_patches, lesion_model, device, num_outputs, aux_dict)
+
+                    scan_numpy = nib.load(jp(scan_path, parameters_dict['brain_mask'])).get_fdata()
+                    all_probs = reconstruct_image_multiclass(lesion_out, coordenates, scan_numpy.shape)
                                         
+                if save_probabilities is not None:
+                    all_probs = save_member_probability_maps(all_probs, jp(path_results, experiment_name_folder, "probabilities"), group, case, tp+1, save_probabilities)
                 labels = np.argmax(all_probs, axis=3).astype(np.uint8)
                 fold_segmentations.append(labels) # Save segmentation for every timepoint and every patient for the current fold
 
@@ -197,26 +216,24 @@ if experiment_type == 'cs': # if experiment is cross-sectional
         
         all_folds.append(np.stack(fold_segmentations))
 
-    # ensemble segmentations of all 5 folds
+    # ensemble segmentations of all 5 folds (a single segmentation if folds were already ensembled)
     print("Ensembling models of all selected folds...")
     all_segmentations = np.stack(all_folds) # size  (5, 61, 181,217, 181)
     the_sum = np.sum(all_segmentations, axis = 0) # size should be (61, 181,217, 181)
-    results = the_sum >= np.ceil(list(selection.values()).count(True)/2) # boolean with size (61, 181,217, 181)
+    results = the_sum >= np.ceil(len(all_folds)/2) # boolean with size (61, 181,217, 181)
     
     # save images
     results = results.astype(np.uint8)
     for i_case in range(results.shape[0]):
         if post_processing: #Remove very small lesions (3 voxels)
-            labels_out = cc3d.connected_components(results[i_case,:,:,:])
-            for i_cc in np.unique(labels_out):
-                if len(labels_out[labels_out == i_cc]) <= min_area:
-                    results[i_case,:,:,:][labels_out == i_cc] = 0
+            results[i_case,:,:,:] = remove_small_regions(results[i_case,:,:,:], min_area, inclusive=True)
         save_image(results[i_case,:,:,:], jp(path_results, experiment_name_folder,"test"+all_indexes[i_case][0] + "_" + all_indexes[i_case][1] + "_qwertz.nii"))
 
     # Save dictionary that identifies which folds were considered
     selection["experiment"] = experiment_name
     selection["Postprocessing"] = post_processing
     selection["Min-area"] = min_area
+    selection["Fold-ensemble"] = fold_ensemble
     create_log(jp(path_results, experiment_name_folder), selection)
 
     z = 0
@@ -231,17 +248,19 @@ elif experiment_type == 'l':
 
     all_folds = []
 
-    for f in folds:
-        if selection[f] == False:
-            continue
+    # groups of folds that are run together. With fold_ensemble, a single group with all selected folds
+    selected_folds = [f for f in folds if selection[f]]
+    model_groups = [selected_folds] if fold_ensemble else [[f] for f in selected_folds]
+
+    for group in model_groups:
+        f = group[0] if len(group) == 1 else "ensemble"
         fold_segmentations = []
-        # create model
+        num_outputs = 2*len(group) if save_probabilities is not None else 2 # with stored maps, the outputs of every model of the group are kept
+        # create model(s) and load the weights. The outputs of all models of the group are averaged batch by batch
         #parameters_dict["model_name"] = 'UNet_ConvLSTM_3D_alt'
-        lesion_model = eval(parameters_dict["model_name"])(n_channels=len(eval(parameters_dict['input_data'])), n_classes=2, bilinear = False)
-        lesion_model.cuda()
-
-        # try to load the weights
-        lesion_model.load_state_dict(torch.load(jp(path_exp, f, "models","checkpoint.pt")))
+        lesion_model = load_ensemble(eval(parameters_dict["model_name"]), [jp(path_exp, g, "models","checkpoint.pt") for g in group], device,
+                                     keep_members=save_probabilities is not None,
+                                     n_channels=len(eval(parameters_dict['input_data'])), n_classes=2, bilinear = False)
 
         test_images = list_folders(path_test_cs) # all test cases    
 
@@ -253,42 +272,60 @@ elif experiment_type == 'l':
 
             tot_timepoints = len(list_files_with_name_containing(jp(path_test, case), "brain_mask", "nii.gz"))
 
-            infer_patches, coordenates = get_inference_patches(path_test=path_test,
-                                                    case = case,
-                                                    input_data=eval(parameters_dict['input_data']),
-                                                    roi=parameters_dict['brain_mask'],
-                                                    patch_shape=eval(parameters_dict['patch_size']),
-                                                    step=eval(parameters_dict['sampling_step']),
-                                                    normalize=eval(parameters_dict['normalize']),
-                                                    norm_type = parameters_dict["norm_type"],
-                                                    mode = "l",
-                                                    num_timepoints=tot_timepoints)
-
-            #if 'LSTM' in parameters_dict["model_name"]:
-            #    inf_patches_sets = divide_inference_slices(infer_patches, eval(parameters_dict['num_timepoints']))
-            #else:
-            inf_patches_sets = get_groups(infer_patches, tot_timepoints, eval(parameters_dict['num_timepoints']), both_time_and_seq=True) #group patches to predict every timepoint
+            if streaming_inference:
+                block, coordenates = load_inference_block(path_test=path_test,
+                                                          case = case,
+                                                          input_data=eval(parameters_dict['input_data']),
+                                                          roi=parameters_dict['brain_mask'],
+                                                          patch_shape=eval(parameters_dict['patch_size']),
+                                                          step=eval(parameters_dict['sampling_step']),
+                                                          normalize=eval(parameters_dict['normalize']),
+                                                          norm_type = parameters_dict["norm_type"],
+                                                          mode = "l",
+                                                          num_timepoints=tot_timepoints)
+            else:
+                infer_patches, coordenates = get_inference_patches(path_test=path_test,
+                                                                   case = case,
+                                                                   input_data=eval(parameters_dict['input_data']),
+                                                                   roi=parameters_dict['brain_mask'],
+                                                                   patch_shape=eval(parameters_dict['patch_size']),
+                                                                   step=eval(parameters_dict['sampling_step']),
+                                                                   normalize=eval(parameters_dict['normalize']),
+                                                                   norm_type = parameters_dict["norm_type"],
+                                                                   mode = "l",
+                                                                   num_timepoints=tot_timepoints)
+
+                #if 'LSTM' in parameters_dict["model_name"]:
+                #    inf_patches_sets = divide_inference_slices(infer_patches, eval(parameters_dict['num_timepoints']))
+                #else:
+                inf_patches_sets = get_groups(infer_patches, tot_timepoints, eval(parameters_dict['num_timepoints']), both_time_and_seq=True) #group patches to predict every timepoint
 
 
             batch_size = eval(parameters_dict['batch_size'])
 
-            for i_timepoint in range(len(inf_patches_sets)):
+            if streaming_inference:
+                # all windows of the case at once, so that each timepoint is encoded only once per patch
+                time_windows = [get_time_window(i_timepoint, tot_timepoints, eval(parameters_dict['num_timepoints'])) for i_timepoint in range(tot_timepoints)]
+                all_probs_windows = stream_inference_windows(lesion_model, device, block, coordenates, eval(parameters_dict['patch_size']), num_outputs, batch_size,
+                                                             time_windows)
+
+            for i_timepoint in range(tot_timepoints):
                 cls()
                 print("Fold: ", f)
                 print("Patient", cnt+1, "/", len(test_images))
                 print("Timepoint ", i_timepoint+1)
-                infer_patches = inf_patches_sets[i_timepoint]
-                aux_dict = {'batch_size': eval(parameters_dict['batch_size'])}
-                lesion_out = build_image(infer_patches, lesion_model, device, 2, aux_dict)
-
-                scan_numpy = nib.load(jp(path_test, case, os.listdir(scan_path)[0])).get_fdata()
-                all_probs = np.zeros((scan_numpy.shape[0], scan_numpy.shape[1], scan_numpy.shape[2], 2))
-
-                for i in range(2):
-                    all_probs[:,:,:,i] = reconstruct_image(lesion_out[:,i], 
-                                                    coordenates, 
-                                                    scan_numpy.shape)
+                if streaming_inference:
+                    all_probs = all_probs_windows[i_timepoint]
+                else:
+                    infer_patches = inf_patches_sets[i_timepoint]
+                    aux_dict = {'batch_size': eval(parameters_dict['batch_size'])}
+                    lesion_out = build_image(infer_patches, lesion_model, device, num_outputs, aux_dict)
+
+                    scan_numpy = nib.load(jp(path_test, case, os.listdir(scan_path)[0])).get_fdata()
+                    all_probs = reconstruct_image_multiclass(lesion_out, coordenates, scan_numpy.shape)
                                         
+                if save_probabilities is not None:
+                    all_probs = save_member_probability_maps(all_probs, jp(path_results, experiment_name_folder, "probabilities"), group, case, i_timepoint+1, save_probabilities)
                 labels = np.argmax(all_probs, axis=3).astype(np.uint8)
                 fold_segmentations.append(labels) # Save segmentation for every timepoint and every patient for the current fold
                 #Save result
@@ -301,26 +338,24 @@ elif experiment_type == 'l':
         all_folds.append(np.stack(fold_segmentations))
 
 
-    # ensemble segmentations of all 5 folds
+    # ensemble segmentations of all 5 folds (a single segmentation if folds were already ensembled)
     print("Ensembling models of all selected folds...")
     all_segmentations = np.stack(all_folds) # size  (5, 61, 181,217, 181)
     the_sum = np.sum(all_segmentations, axis = 0) # size should be (61, 181,217, 181)
-    results = the_sum >= np.ceil(list(selection.values()).count(True)/2) # boolean with size (61, 181,217, 181)
+    results = the_sum >= np.ceil(len(all_folds)/2) # boolean with size (61, 181,217, 181)
     
     # save images
     results = results.astype(np.uint8)
     for i_case in range(results.shape[0]):
         if post_processing: #Remove very small lesions (3 voxels)
-            labels_out = cc3d.connected_components(results[i_case,:,:,:])
-            for i_cc in np.unique(labels_out):
-                if len(labels_out[labels_out == i_cc]) <= min_area:
-                    results[i_case,:,:,:][labels_out == i_cc] = 0
+            results[i_case,:,:,:] = remove_small_regions(results[i_case,:,:,:], min_area, inclusive=True)
         save_image(results[i_case,:,:,:], jp(path_results, experiment_name_folder,"test"+all_indexes[i_case][0] + "_" + all_indexes[i_case][1] + "_qwertz.nii"))
 
     # Save dictionary that identifies which folds were considered
     selection["experiment"] = experiment_name
     selection["Postprocessing"] = post_processing
     selection["Min-area"] = min_area
+    selection["Fold-ensemble"] = fold_ensemble
     create_log(jp(path_results, experiment_name_folder), selection)        
 else:
     raise Exception("Unknown experiment_type!")